@@ -0,0 +1,130 @@
+import functools
+import logging
+import queue
+import threading
+import bson
+
+class PartitionedApplier:
+    def __init__(self, target_applier, workers=4, queue_size=1000, catch_up_workers=None):
+        """
+        Apply operations on several worker threads, partitioned by document
+        
+        Operations are routed by a hash of documentKey._id, so all events of
+        one document are applied in order by the same worker while different
+        documents are applied concurrently. Each worker writes through its own
+        lane of the target applier, so batching stays per worker. The bounded
+        queues block submitters when workers fall behind.
+        
+        Parameters:
+        -----------
+        target_applier : TargetApplier
+            Applier performing the writes
+        workers : int
+            Number of workers a collection's operations are spread over
+        queue_size : int
+            Maximum operations waiting per worker
+        catch_up_workers : int
+            Number of workers a collection is spread over while in catch-up
+            mode (see set_catch_up)
+        """
+        self.target_applier = target_applier
+        self.workers = max(1, int(workers))
+        self.catch_up_workers = max(self.workers, int(catch_up_workers or self.workers))
+        self.logger = logging.getLogger("iris.apply_workers")
+        
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(self.catch_up_workers)]
+        self.threads = []
+        
+        # A collection only changes its number of workers while none of its
+        # operations are in flight, so one document is never on two workers;
+        # submits wait on _drained for that
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)
+        self.catch_up_collections = set()
+        self.widths = {}  # Collection -> workers currently used
+        self.in_flight = {}  # Collection -> operations submitted but not completed
+        
+    def start(self):
+        """Start the worker threads"""
+        if self.threads:
+            return
+            
+        for index in range(len(self.queues)):
+            thread = threading.Thread(target=self._run_worker, args=(index,), name=f"iris-apply-{index}")
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            
+        self.logger.info(f"Started {len(self.queues)} apply workers ({self.workers} per collection, "
+                         f"{self.catch_up_workers} in catch-up mode)")
+                         
+    def stop(self):
+        """Drain the queues and stop the worker threads"""
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout=30)
+        self.threads = []
+        
+    def submit(self, collection_name, operation, callback):
+        """
+        Queue an operation on the worker owning its document
+        
+        Takes the same arguments as TargetApplier.submit and blocks while
+        that worker's queue is full. When the collection entered or left
+        catch-up mode, it also blocks until the operations in flight on the
+        old number of workers have completed.
+        """
+        with self._lock:
+            while True:
+                width = self.catch_up_workers if collection_name in self.catch_up_collections else self.workers
+                if self.widths.get(collection_name, width) == width or not self.in_flight.get(collection_name):
+                    break
+                self._drained.wait()
+            self.widths[collection_name] = width
+            self.in_flight[collection_name] = self.in_flight.get(collection_name, 0) + 1
+            
+        callback = functools.partial(self._completed, collection_name, callback)
+        self.queues[self._partition(operation, width)].put((collection_name, operation, callback))
+        
+    def set_catch_up(self, collection_name, enabled):
+        """Spread a collection over catch_up_workers workers while it lags"""
+        with self._lock:
+            if enabled:
+                self.catch_up_collections.add(collection_name)
+            else:
+                self.catch_up_collections.discard(collection_name)
+            # A submit waiting to switch may no longer need to
+            self._drained.notify_all()
+            
+    def _completed(self, collection_name, callback, result):
+        with self._lock:
+            self.in_flight[collection_name] -= 1
+            if not self.in_flight[collection_name]:
+                self._drained.notify_all()
+        callback(result)
+        
+    def _partition(self, operation, width):
+        """Worker index for the document an operation belongs to"""
+        document_id = operation.get('documentKey', {}).get('_id')
+        try:
+            key = hash(document_id)
+        except TypeError:
+            # Unhashable _id values (embedded documents, arrays)
+            key = hash(bson.encode({'_id': document_id}))
+        return key % width
+        
+    def _run_worker(self, index):
+        """Apply queued operations in order"""
+        worker_queue = self.queues[index]
+        while True:
+            item = worker_queue.get()
+            if item is None:
+                break
+                
+            collection_name, operation, callback = item
+            try:
+                self.target_applier.submit(collection_name, operation, callback, lane=index)
+            except Exception as e:
+                self.logger.error(f"Apply worker {index} failed: {str(e)}")
+                callback({'success': False, 'error': str(e)})
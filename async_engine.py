@@ -0,0 +1,366 @@
+import asyncio
+import logging
+import time
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+from .change_stream_listener import RESUME_TOKEN_LOST_CODES, DatabaseChangeStreamListener
+from .checkpoint_store import CheckpointTracker, resume_token_time
+from .client_registry import write_concern_from_config
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:  # PyMongo < 4.9 has no async API
+    AsyncMongoClient = None
+
+class AsyncReplicationEngine:
+    def __init__(self, config, operation_filter, operation_transformer, target_applier, checkpoint_store,
+                 monitoring_service, full_document_collections=None, clients=None):
+        """
+        Run all listeners, appliers and the monitoring endpoint on one event loop
+        
+        An alternative to one listener thread per collection. The filter,
+        transformer and write model construction of the threaded engine are
+        reused; only I/O moves to PyMongo's async API.
+        
+        Parameters:
+        -----------
+        config : dict
+            Application configuration
+        operation_filter : OperationFilter
+            Filter shared with the threaded engine
+        operation_transformer : OperationTransformer
+            Transformer shared with the threaded engine
+        target_applier : TargetApplier
+            Used to build write models for each operation
+        checkpoint_store : CheckpointStore
+            Store for resume tokens
+        monitoring_service : MonitoringService
+            Metrics and monitoring endpoint
+        full_document_collections : set
+            Collections whose updates need updateLookup
+        clients : ClientRegistry
+            Provides pool, compression and auth settings for the async clients
+        """
+        if AsyncMongoClient is None:
+            raise RuntimeError("The asyncio engine requires PyMongo 4.9 or later (pymongo.AsyncMongoClient)")
+            
+        self.config = config
+        self.logger = logging.getLogger("iris.async_engine")
+        
+        self.operation_filter = operation_filter
+        self.operation_transformer = operation_transformer
+        self.target_applier = target_applier
+        self.checkpoint_store = checkpoint_store
+        self.monitoring_service = monitoring_service
+        self.full_document_collections = set(full_document_collections or [])
+        self.clients = clients
+        
+        self.collection_names = [c['name'] for c in config['replication']['collections']]
+        self.stream_mode = config['replication'].get('stream_mode', 'collection')
+        self.batch_size = max(1, config['replication'].get('batch_size', 1))
+        self.max_delay = config['replication'].get('batch_max_delay_ms', 100) / 1000.0
+        self.queue_size = config['replication'].get('apply_queue_size', 1000)
+        
+        self.loop = None
+        self.stopping = None
+        self.target_db = None
+        self.apply_queues = {}  # Target collection -> asyncio.Queue
+        self.apply_tasks = []
+        
+    def run(self):
+        """Run the engine until stop() is called; blocks the calling thread"""
+        asyncio.run(self._main())
+        
+    def stop(self):
+        """Ask the engine to stop; safe to call from any thread"""
+        if self.loop and self.stopping:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        
+        source_client = AsyncMongoClient(self.config['source']['uri'], **self._client_options('source'))
+        target_client = AsyncMongoClient(self.config['target']['uri'], **self._client_options('target'))
+        source_db = source_client[self.config['source']['database']]
+        if self.config['replication'].get('raw_documents', False):
+            source_db = source_db.with_options(
+                codec_options=source_db.codec_options.with_options(document_class=RawBSONDocument)
+            )
+        self.target_db = target_client[self.config['target']['database']]
+        write_concern = self.config['replication'].get('write_concern')
+        if write_concern:
+            self.target_db = self.target_db.with_options(write_concern=write_concern_from_config(write_concern))
+            
+        server = await self.monitoring_service.serve_async()
+        
+        tasks = []
+        if self.stream_mode == 'database':
+            # Like the threaded engine, collections that need updateLookup
+            # get a stream of their own
+            shared_key = DatabaseChangeStreamListener.checkpoint_key_for(source_db.name)
+            for update_lookup in (False, True):
+                names = [name for name in self.collection_names
+                         if (name in self.full_document_collections) == update_lookup]
+                if not names:
+                    continue
+                tasks.append(asyncio.create_task(self._listen(
+                    source_db,
+                    DatabaseChangeStreamListener.checkpoint_key_for(source_db.name, update_lookup),
+                    [{'$match': {'ns.coll': {'$in': names}}}],
+                    update_lookup,
+                    fallback_key=shared_key if update_lookup else None
+                )))
+        else:
+            for collection_name in self.collection_names:
+                tasks.append(asyncio.create_task(self._listen(
+                    source_db[collection_name],
+                    collection_name,
+                    [],
+                    collection_name in self.full_document_collections
+                )))
+                
+        self.logger.info(f"Asyncio engine replicating {len(self.collection_names)} collections")
+        await self.stopping.wait()
+        
+        # Events still queued stay behind the checkpoint and are replayed
+        # on the next start
+        tasks.extend(self.apply_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        server.close()
+        await server.wait_closed()
+        await source_client.close()
+        await target_client.close()
+        self.logger.info("Asyncio engine stopped")
+        
+    def _client_options(self, side):
+        return self.clients.options(side) if self.clients else {}
+        
+    async def _listen(self, source, checkpoint_key, pipeline, update_lookup, fallback_key=None):
+        """
+        Consume one change stream and queue its events for apply
+        
+        fallback_key names the checkpoint to resume from while the stream
+        has none of its own yet.
+        """
+        # Checkpoint writes are blocking I/O; they run in the default executor
+        tracker = CheckpointTracker(
+            self.checkpoint_store,
+            checkpoint_key,
+            flush=lambda: self.loop.run_in_executor(None, self.checkpoint_store.flush)
+        )
+        checkpoint = self.checkpoint_store.load(checkpoint_key)
+        if checkpoint is None and fallback_key:
+            checkpoint = self.checkpoint_store.load(fallback_key)
+        resume_token = checkpoint['resume_token'] if checkpoint else None
+        
+        while True:
+            options = {
+                'pipeline': pipeline + self.operation_filter.pipeline(),
+                'max_await_time_ms': 1000
+            }
+            if update_lookup:
+                options['full_document'] = 'updateLookup'
+            if resume_token:
+                options['start_after'] = resume_token
+                
+            try:
+                async with await source.watch(**options) as stream:
+                    while stream.alive:
+                        change = await stream.try_next()
+                        if change is None:
+                            # try_next waited max_await_time_ms on the server
+                            resume_token = self._checkpoint_idle(stream, checkpoint_key, tracker, resume_token)
+                            continue
+                        resume_token = change['_id']
+                        await self._process_change(change, checkpoint_key, tracker)
+                        
+            except PyMongoError as e:
+                self.logger.error(f"Change stream error on {checkpoint_key}: {str(e)}")
+                self.monitoring_service.record_error(
+                    collection=checkpoint_key,
+                    error_type="change_stream",
+                    message=str(e)
+                )
+                if isinstance(e, OperationFailure) and e.code in RESUME_TOKEN_LOST_CODES:
+                    resume_token = None
+                await asyncio.sleep(5)  # Wait before reconnecting
+                
+    def _checkpoint_idle(self, stream, checkpoint_key, tracker, resume_token):
+        """Advance the checkpoint to the post-batch resume token of a quiet stream"""
+        token = stream.resume_token
+        if not token or token == resume_token:
+            return resume_token
+            
+        cluster_time = resume_token_time(token)
+        if not tracker.advance_idle(token, cluster_time):
+            return resume_token
+        if cluster_time:
+            self.monitoring_service.record_checkpoint(collection=checkpoint_key, cluster_time=cluster_time)
+        return token
+        
+    async def _process_change(self, change, checkpoint_key, tracker):
+        """Filter and transform an event, then queue it for its collection's applier"""
+        collection_name = change.get('ns', {}).get('coll', checkpoint_key)
+        seq = tracker.track(change['_id'], change.get('clusterTime'))
+        
+        try:
+            target_name, writes = await self._prepare(change, collection_name)
+        except Exception as e:
+            # As in the threaded listener's _process_captured, an event that
+            # fails to filter, transform or encode does not end the stream
+            self.logger.error(f"Failed to process {change.get('operationType')} event: {str(e)}")
+            self.monitoring_service.record_error(
+                collection=collection_name,
+                error_type="process_change",
+                message=str(e)
+            )
+            self._complete(checkpoint_key, tracker, seq)
+            return
+            
+        if target_name is None:
+            self._complete(checkpoint_key, tracker, seq)
+            return
+            
+        context = (collection_name, checkpoint_key, tracker, seq, time.monotonic(), change.get('clusterTime'))
+        await self._apply_queue(target_name).put((writes, context))
+        
+    async def _prepare(self, change, collection_name):
+        """
+        Target collection and write models of an event
+        
+        Returns:
+        --------
+        tuple
+            (target collection name, write models), or (None, None) when the
+            event is filtered out
+        """
+        self.monitoring_service.record_operation(
+            collection=collection_name,
+            operation_type=change['operationType']
+        )
+        
+        started = time.perf_counter()
+        keep = self.operation_filter.should_process(change)
+        filtered = time.perf_counter()
+        self.monitoring_service.record_stage(collection_name, 'filter', filtered - started)
+        if not keep or collection_name not in self.collection_names:
+            return None, None
+            
+        transformed_op = self.operation_transformer.transform(change)
+        self.monitoring_service.record_stage(collection_name, 'transform', time.perf_counter() - filtered)
+        if collection_name in self.target_applier.partitioners:
+            # Routing may create the bucket collection, its indexes and view
+            target_name = await self.loop.run_in_executor(
+                None, self.target_applier.route, collection_name, transformed_op
+            )
+        else:
+            target_name = self.target_applier.route(collection_name, transformed_op)
+        return target_name, self.target_applier.build_writes(collection_name, transformed_op)
+        
+    def _apply_queue(self, target_name):
+        """Queue of a target collection, starting its apply loop on first use"""
+        apply_queue = self.apply_queues.get(target_name)
+        if apply_queue is None:
+            apply_queue = self.apply_queues[target_name] = asyncio.Queue(maxsize=self.queue_size)
+            self.apply_tasks.append(asyncio.create_task(self._apply_loop(self.target_db[target_name])))
+        return apply_queue
+        
+    async def _apply_loop(self, target_collection):
+        """Collect queued writes into batches and apply them"""
+        apply_queue = self.apply_queues[target_collection.name]
+        while True:
+            entries = [await apply_queue.get()]
+            deadline = self.loop.time() + self.max_delay
+            while len(entries) < self.batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entries.append(await asyncio.wait_for(apply_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                    
+            try:
+                await self._execute(target_collection, entries)
+            except Exception as e:
+                # Ending the loop would leave the queue full and its
+                # listener blocked on put() for good
+                self.logger.error(f"Failed to apply batch to {target_collection.name}: {str(e)}")
+                self.monitoring_service.record_error(
+                    collection=target_collection.name,
+                    error_type="apply_operation",
+                    message=str(e)
+                )
+                for _, context in entries:
+                    self._complete(*context[1:4])
+                    
+    async def _execute(self, target_collection, entries):
+        """Async counterpart of TargetApplier._execute"""
+        start = 0
+        while start < len(entries):
+            writes = []
+            owners = []  # Write index -> entry index
+            for index in range(start, len(entries)):
+                writes.extend(entries[index][0])
+                owners.extend([index] * len(entries[index][0]))
+                
+            try:
+                if writes:
+                    await target_collection.bulk_write(writes, ordered=True)
+                    
+            except BulkWriteError as e:
+                write_errors = e.details.get('writeErrors', [])
+                if not write_errors:
+                    self._report(entries[start:], {'success': False, 'error': str(e)})
+                    return
+                    
+                failed = owners[write_errors[0]['index']]
+                self._report(entries[start:failed], {'success': True})
+                self._report(entries[failed:failed + 1], self.target_applier.write_error_result(write_errors[0], str(e)))
+                start = failed + 1
+                continue
+                
+            except PyMongoError as e:
+                self._report(entries[start:], {'success': False, 'error': str(e)})
+                return
+                
+            except Exception as e:
+                # Not a server error, e.g. DocumentTooLarge (a bson InvalidDocument)
+                self._report(entries[start:], {'success': False, 'error': f"{type(e).__name__}: {str(e)}"})
+                return
+                
+            self._report(entries[start:], {'success': True})
+            return
+            
+    def _report(self, entries, result):
+        for _, context in entries:
+            self._handle_apply_result(*context, result)
+            
+    def _handle_apply_result(self, collection_name, checkpoint_key, tracker, seq, submitted_at, cluster_time, result):
+        """Record the outcome of an apply and advance the checkpoint"""
+        if result.get('success'):
+            self.monitoring_service.record_apply(
+                collection=collection_name,
+                latency_seconds=time.monotonic() - submitted_at,
+                cluster_time=cluster_time
+            )
+        else:
+            self.logger.error(f"Failed to apply operation to {collection_name}: {result.get('error')}")
+            self.monitoring_service.record_error(
+                collection=collection_name,
+                error_type="apply_operation",
+                message=result.get('error')
+            )
+        self._complete(checkpoint_key, tracker, seq)
+        
+    def _complete(self, checkpoint_key, tracker, seq):
+        advanced = tracker.complete(seq)
+        if advanced and advanced[1]:
+            self.monitoring_service.record_checkpoint(
+                collection=checkpoint_key,
+                cluster_time=advanced[1]
+            )
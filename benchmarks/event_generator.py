@@ -0,0 +1,155 @@
+import datetime
+import random
+from bson import ObjectId
+from bson.timestamp import Timestamp
+
+class ChangeEventGenerator:
+    def __init__(self, collection_name='orders', mix=None, fields=20, depth=2, array_length=5,
+                 string_length=24, update_lookup=False, hot_documents=None, seed=42):
+        """
+        Generate realistic change stream events for benchmarks
+        
+        Updates, replaces and deletes refer to documents inserted earlier by
+        the same generator, so the stream can be applied to a real target.
+        
+        Parameters:
+        -----------
+        collection_name : str
+            Collection named in each event's ns
+        mix : dict
+            Operation type -> relative weight (insert, update, replace, delete)
+        fields : int
+            Top-level fields per document
+        depth : int
+            Nesting depth of sub-documents
+        array_length : int
+            Elements per array field
+        string_length : int
+            Length of string values
+        update_lookup : bool
+            Attach the current document to updates, as updateLookup does
+        hot_documents : int
+            Update only the most recently inserted documents, like orders
+            moving through status changes (None = any document)
+        seed : int
+            Random seed, so runs are comparable across commits
+        """
+        self.collection_name = collection_name
+        self.mix = mix or {'insert': 40, 'update': 45, 'replace': 10, 'delete': 5}
+        self.fields = fields
+        self.depth = depth
+        self.array_length = array_length
+        self.string_length = string_length
+        self.update_lookup = update_lookup
+        self.hot_documents = hot_documents
+        self.random = random.Random(seed)
+        
+        self.documents = {}  # _id -> current document
+        self.ids = []
+        self.sequence = 0
+        self.clock = 1700000000
+        
+    def events(self, count):
+        """Yield count change events"""
+        operation_types = list(self.mix)
+        weights = [self.mix[operation_type] for operation_type in operation_types]
+        for _ in range(count):
+            operation_type = self.random.choices(operation_types, weights)[0]
+            if operation_type != 'insert' and not self.ids:
+                operation_type = 'insert'
+            yield getattr(self, f"_{operation_type}")()
+            
+    def _insert(self):
+        document = self._document()
+        document['_id'] = ObjectId(self.random.randbytes(12))
+        self.documents[document['_id']] = document
+        self.ids.append(document['_id'])
+        return self._event('insert', document['_id'], fullDocument=document)
+        
+    def _update(self):
+        document_id = self.random.choice(self.ids[-self.hot_documents:] if self.hot_documents else self.ids)
+        document = self.documents[document_id]
+        
+        updated_fields = {}
+        fields = self.random.sample(range(self.fields), min(self.fields, self.random.randint(1, 3)))
+        for field in (f"field_{index}" for index in fields):
+            if self.random.random() < 0.3 and isinstance(document.get(field), dict):
+                # Dotted path into a sub-document, as the server reports it
+                key = self.random.choice(list(document[field]))
+                updated_fields[f"{field}.{key}"] = self._value(self.depth - 1)
+            else:
+                updated_fields[field] = self._value(self.depth - 1)
+        updated_fields['updated_at'] = self._now()
+        
+        description = {'updatedFields': updated_fields, 'removedFields': [], 'truncatedArrays': []}
+        unchanged = sorted(set(range(self.fields)) - set(fields))
+        if unchanged and self.random.random() < 0.1:
+            description['removedFields'].append(f"field_{self.random.choice(unchanged)}")
+        if self.random.random() < 0.05:
+            description['truncatedArrays'].append({'field': 'items', 'newSize': 1})
+            
+        # Track the new state without touching documents of earlier events
+        document = dict(document)
+        for key, value in updated_fields.items():
+            field, _, sub_key = key.partition('.')
+            if sub_key:
+                document[field] = dict(document[field], **{sub_key: value})
+            else:
+                document[field] = value
+        for field in description['removedFields']:
+            document.pop(field, None)
+        if description['truncatedArrays']:
+            document['items'] = document['items'][:1]
+        self.documents[document_id] = document
+        
+        if self.update_lookup:
+            return self._event('update', document_id, updateDescription=description, fullDocument=document)
+        return self._event('update', document_id, updateDescription=description)
+        
+    def _replace(self):
+        document_id = self.random.choice(self.ids)
+        document = self._document()
+        document['_id'] = document_id
+        self.documents[document_id] = document
+        return self._event('replace', document_id, fullDocument=document)
+        
+    def _delete(self):
+        document_id = self.ids.pop(self.random.randrange(len(self.ids)))
+        del self.documents[document_id]
+        return self._event('delete', document_id)
+        
+    def _event(self, operation_type, document_id, **fields):
+        self.sequence += 1
+        if self.sequence % 100 == 0:
+            self.clock += 1
+        event = {
+            '_id': {'_data': f"{self.sequence:032x}"},
+            'operationType': operation_type,
+            'clusterTime': Timestamp(self.clock, self.sequence % 100 + 1),
+            'wallTime': self._now(),
+            'ns': {'db': 'benchmark', 'coll': self.collection_name},
+            'documentKey': {'_id': document_id},
+            'lsid': {'id': self.sequence},
+            'txnNumber': self.sequence
+        }
+        event.update(fields)
+        return event
+        
+    def _document(self):
+        document = {f"field_{index}": self._value(self.depth) for index in range(self.fields)}
+        document['items'] = [self._value(0) for _ in range(self.array_length)]
+        document['created_at'] = self._now()
+        return document
+        
+    def _value(self, depth):
+        kind = self.random.random()
+        if depth > 0 and kind < 0.2:
+            return {f"sub_{index}": self._value(depth - 1) for index in range(4)}
+        if kind < 0.5:
+            return ''.join(self.random.choices('abcdefghijklmnopqrstuvwxyz', k=self.string_length))
+        if kind < 0.8:
+            return self.random.randint(0, 1000000)
+        return self.random.random()
+        
+    def _now(self):
+        return datetime.datetime(2026, 1, 1) + datetime.timedelta(seconds=self.sequence)
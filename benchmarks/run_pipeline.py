@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Benchmark the OperationFilter -> OperationTransformer -> TargetApplier path
+
+Each stage is timed on its own over the same pre-generated events, then the
+whole path runs end to end against an in-process fake target or a local
+mongod. Results are written as JSON so runs of different commits can be
+compared:
+
+    python benchmarks/run_pipeline.py --events 50000 --output before.json
+    python benchmarks/run_pipeline.py --events 50000 --output after.json --compare before.json
+    python benchmarks/run_pipeline.py --uri mongodb://localhost:27017 --batch-size 500
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+# The Iris modules import each other relatively, so they are loaded as
+# submodules of a package rooted at the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+package = types.ModuleType('iris')
+package.__path__ = [ROOT]
+sys.modules['iris'] = package
+
+from event_generator import ChangeEventGenerator
+from iris.metrics import Histogram
+from iris.operation_filter import OperationFilter
+from iris.operation_transformer import OperationTransformer
+from iris.target_applier import TargetApplier
+
+class FakeCollection:
+    def __init__(self, name):
+        self.name = name
+        self.writes = 0
+        
+    def bulk_write(self, requests, ordered=True):
+        # Encode what PyMongo would send, so serialization stays in the
+        # measurement while the network and server do not
+        for request in requests:
+            document = getattr(request, '_doc', None)
+            if document is not None:
+                bson.encode(document)
+        self.writes += len(requests)
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+        
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name)
+        return self.collections[name]
+
+
+def measure(items, function):
+    """Time a stage per item, then measure what its outputs keep allocated"""
+    histogram = Histogram()
+    outputs = []
+    started = time.perf_counter()
+    for item in items:
+        call_started = time.perf_counter()
+        outputs.append(function(item))
+        histogram.record(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    kept = [function(item) for item in items]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    
+    return outputs, {
+        'events': len(items),
+        'seconds': elapsed,
+        'events_per_second': len(items) / elapsed if elapsed else None,
+        'latency': _latency(histogram),
+        'retained_bytes_per_event': (retained - baseline) / len(items) if items else None,
+        'peak_bytes': peak - baseline
+    }
+
+
+def run_end_to_end(events, decode, operation_filter, operation_transformer, target_applier, collection_name):
+    """Feed every encoded event through decode, filter, transform and a batching applier"""
+    histogram = Histogram()
+    results = {'success': 0, 'failed': 0}
+    
+    def completed(submitted_at, result):
+        histogram.record(time.perf_counter() - submitted_at)
+        results['success' if result.get('success') else 'failed'] += 1
+        
+    target_applier.start()
+    started = time.perf_counter()
+    for encoded in events:
+        submitted_at = time.perf_counter()
+        event = decode(encoded)
+        if not operation_filter.should_process(event):
+            continue
+        target_applier.submit(
+            collection_name,
+            operation_transformer.transform(event),
+            functools.partial(completed, submitted_at)
+        )
+    target_applier.stop()
+    elapsed = time.perf_counter() - started
+    
+    return {
+        'events': len(events),
+        'applied': results['success'],
+        'failed': results['failed'],
+        'seconds': elapsed,
+        'events_per_second': len(events) / elapsed if elapsed else None,
+        'latency': _latency(histogram)
+    }
+
+
+def _latency(histogram):
+    summary = histogram.snapshot()
+    summary.pop('buckets', None)
+    return summary
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print throughput of each stage relative to an earlier result file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+        
+    print(f"Compared with {baseline.get('commit')} ({baseline_path}):")
+    for stage, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if not previous or not previous.get('events_per_second') or not current.get('events_per_second'):
+            continue
+        ratio = current['events_per_second'] / previous['events_per_second']
+        print(f"  {stage:12s} {current['events_per_second']:12.0f} ev/s  {ratio:6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Iris filter, transform and apply pipeline')
+    parser.add_argument('--events', type=int, default=20000, help='Number of change events')
+    parser.add_argument('--fields', type=int, default=20, help='Top-level fields per document')
+    parser.add_argument('--depth', type=int, default=2, help='Nesting depth of sub-documents')
+    parser.add_argument('--array-length', type=int, default=5, help='Elements per array field')
+    parser.add_argument('--mix', default='insert=40,update=45,replace=10,delete=5',
+                        help='Operation weights, e.g. insert=40,update=45,replace=10,delete=5')
+    parser.add_argument('--update-lookup', action='store_true', help='Attach full documents to updates')
+    parser.add_argument('--raw-documents', action='store_true',
+                        help='Feed events as RawBSONDocuments, as replication.raw_documents reads them')
+    parser.add_argument('--hot-documents', type=int, help='Update only the N most recently inserted documents')
+    parser.add_argument('--batch-size', type=int, default=500, help='TargetApplier batch size')
+    parser.add_argument('--coalesce', action='store_true', help='Coalesce same-document operations within a batch')
+    parser.add_argument('--uri', help='Apply to this mongod instead of the in-process fake target')
+    parser.add_argument('--database', default='iris_benchmark', help='Database used with --uri (dropped first)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the JSON results to this file')
+    parser.add_argument('--compare', help='Earlier JSON results to compare throughput against')
+    args = parser.parse_args()
+    
+    mix = {name: int(weight) for name, weight in (part.split('=') for part in args.mix.split(','))}
+    generator = ChangeEventGenerator(
+        mix=mix,
+        fields=args.fields,
+        depth=args.depth,
+        array_length=args.array_length,
+        update_lookup=args.update_lookup,
+        hot_documents=args.hot_documents,
+        seed=args.seed
+    )
+    # Events start out as the BSON a cursor receives, so decoding is
+    # measured the same way for both codecs
+    encoded_events = [bson.encode(event) for event in generator.events(args.events)]
+    if args.raw_documents:
+        decode = functools.partial(RawBSONDocument, codec_options=CodecOptions(document_class=RawBSONDocument))
+    else:
+        decode = bson.decode
+        
+    operation_filter = OperationFilter(['delete'], excluded_fields=['lsid', 'txnNumber'])
+    operation_transformer = OperationTransformer()
+    
+    if args.uri:
+        from pymongo import MongoClient
+        client = MongoClient(args.uri)
+        client.drop_database(args.database)
+        target_db = client[args.database]
+    else:
+        client = None
+        target_db = FakeDatabase()
+        
+    stages = {}
+    events, stages['decode'] = measure(encoded_events, decode)
+    filtered, stages['filter'] = measure(events, operation_filter.should_process)
+    kept = [event for event, keep in zip(events, filtered) if keep]
+    transformed, stages['transform'] = measure(kept, operation_transformer.transform)
+    
+    builder = TargetApplier(FakeDatabase())
+    _, stages['build_writes'] = measure(
+        transformed,
+        lambda operation: builder.build_writes(generator.collection_name, operation)
+    )
+    
+    stages['end_to_end'] = run_end_to_end(
+        encoded_events,
+        decode,
+        operation_filter,
+        operation_transformer,
+        TargetApplier(target_db, batch_size=args.batch_size, coalesce=args.coalesce),
+        generator.collection_name
+    )
+    if not client:
+        stages['end_to_end']['target_writes'] = sum(c.writes for c in target_db.collections.values())
+        
+    if client:
+        client.drop_database(args.database)
+        client.close()
+        
+    results = {
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'target': 'mongod' if args.uri else 'fake',
+        'parameters': {
+            'events': args.events,
+            'fields': args.fields,
+            'depth': args.depth,
+            'array_length': args.array_length,
+            'mix': mix,
+            'update_lookup': args.update_lookup,
+            'raw_documents': args.raw_documents,
+            'hot_documents': args.hot_documents,
+            'batch_size': args.batch_size,
+            'coalesce': args.coalesce,
+            'seed': args.seed
+        },
+        'stages': stages
+    }
+    
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,88 @@
+import functools
 import logging
+import queue
 import threading
 import time
-from pymongo.errors import PyMongoError
+from pymongo.errors import OperationFailure, PyMongoError
+from .checkpoint_store import CheckpointTracker, resume_token_time
+
+# Server error codes meaning the stored resume token can no longer be used
+# (InvalidResumeToken / ChangeStreamFatalError / ChangeStreamHistoryLost)
+RESUME_TOKEN_LOST_CODES = (260, 280, 286)
 
 class ChangeStreamListener(threading.Thread):
-    def __init__(self, source_collection, operation_filter, operation_transformer, target_applier, monitoring_service):
-        super().__init__()
+    def __init__(self, source_collection, operation_filter, operation_transformer, target_applier, monitoring_service,
+                 checkpoint_store=None, update_lookup=False, capture_queue_size=10000, max_idle_wait_ms=100):
+        super().__init__(name=f"iris-listener-{source_collection.name}")
         self.daemon = True
         self.source_collection = source_collection
         self.operation_filter = operation_filter
         self.operation_transformer = operation_transformer
         self.target_applier = target_applier
         self.monitoring_service = monitoring_service
+        self.checkpoint_store = checkpoint_store
+        # Only needed when updates are applied as full-document replaces
+        self.update_lookup = update_lookup
         self.logger = logging.getLogger(f"iris.listener.{source_collection.name}")
         self.running = False
         self.change_stream = None
         
+        # Checkpoints advance only past events that have been applied
+        self.checkpoint_key = source_collection.name
+        self.checkpoint_tracker = CheckpointTracker(checkpoint_store, self.checkpoint_key) if checkpoint_store else None
+        self.resume_token = None
+        
+        # Capture and apply run on separate threads joined by a bounded
+        # queue, so a slow target write does not stall reading the cursor.
+        # A size of 0 processes events on the capture thread.
+        self.capture_queue = queue.Queue(maxsize=capture_queue_size) if capture_queue_size > 0 else None
+        self.apply_thread = None
+        self.max_idle_wait = max_idle_wait_ms / 1000.0
+        self._queue_wait_avg = 0.0
+        
     def run(self):
         self.running = True
         self.logger.info(f"Starting change stream listener for {self.source_collection.name}")
         
+        # Resume from the persisted checkpoint after a restart
+        if self.checkpoint_store:
+            checkpoint = self._load_checkpoint()
+            if checkpoint:
+                self.resume_token = checkpoint['resume_token']
+                self.logger.info(f"Resuming {self.source_collection.name} from checkpoint of {checkpoint['updated_at']}")
+                
+        if self.capture_queue:
+            self.apply_thread = threading.Thread(target=self._run_apply, name=f"{self.name}-apply")
+            self.apply_thread.daemon = True
+            self.apply_thread.start()
+            
         while self.running:
             try:
                 # Open change stream
-                self.change_stream = self.source_collection.watch(
-                    full_document='updateLookup',
-                    max_await_time_ms=1000
-                )
+                self.change_stream = self._open_change_stream()
                 
                 # Process changes
+                idle_wait = 0.0
                 while self.running and self.change_stream.alive:
-                    change = next(self.change_stream, None)
+                    fetch_started = time.perf_counter()
+                    change = self.change_stream.try_next()
                     if change:
-                        self._process_change(change)
+                        # Includes decoding the batch when a getMore was needed
+                        self.monitoring_service.record_stage(
+                            self._collection_name(change), 'fetch', time.perf_counter() - fetch_started
+                        )
+                        # Events already handed to the applier are not lost on
+                        # reconnect, so resume right after the last one read
+                        self.resume_token = change['_id']
+                        self._dispatch(change)
+                        idle_wait = 0.0
                     else:
-                        time.sleep(0.1)  # Small sleep to prevent high CPU usage
+                        # try_next already waited max_await_time_ms on the
+                        # server; only back off when empty batches keep
+                        # coming back immediately
+                        self._checkpoint_idle()
+                        idle_wait = min(max(idle_wait * 2, 0.001), self.max_idle_wait)
+                        time.sleep(idle_wait)
                         
             except PyMongoError as e:
                 self.logger.error(f"Change stream error: {str(e)}")
@@ -43,50 +91,266 @@ class ChangeStreamListener(threading.Thread):
                     error_type="change_stream",
                     message=str(e)
                 )
+                
+                if isinstance(e, OperationFailure) and e.code in RESUME_TOKEN_LOST_CODES and self.resume_token:
+                    # The oplog no longer covers the checkpoint; events in the gap
+                    # have to be recovered with an initial sync
+                    self.logger.error(f"Resume token for {self.source_collection.name} is no longer valid, "
+                                      f"restarting the change stream from the current time")
+                    self.resume_token = None
+                    
                 time.sleep(5)  # Wait before reconnecting
                 
             finally:
                 if self.change_stream:
                     self.change_stream.close()
                     
+        # Let the apply thread finish the events already captured
+        if self.apply_thread:
+            self.apply_thread.join()
+            
         self.logger.info(f"Change stream listener stopped for {self.source_collection.name}")
         
-    def _process_change(self, change):
+    def _open_change_stream(self):
+        """Open the change stream, resuming after the last known event"""
+        options = {
+            'pipeline': self.operation_filter.pipeline(),
+            'max_await_time_ms': 1000
+        }
+        if self.update_lookup:
+            options['full_document'] = 'updateLookup'
+        if self.resume_token:
+            options['start_after'] = self.resume_token
+            
+        return self.source_collection.watch(**options)
+        
+    def _load_checkpoint(self):
+        """Last persisted checkpoint of the stream, or None"""
+        return self.checkpoint_store.load(self.checkpoint_key)
+        
+    def _dispatch(self, change):
+        """Hand a captured event to the apply thread, or process it inline"""
+        # Tracked at capture time so an idle checkpoint never skips events
+        # still waiting in the queue
+        seq = self.checkpoint_tracker.track(change['_id'], change.get('clusterTime')) if self.checkpoint_tracker else None
+        
+        if self.capture_queue:
+            # Blocks when the queue is full, bounding memory
+            self.capture_queue.put((change, seq, time.monotonic()))
+        else:
+            self._process_captured(change, seq)
+            
+    def _run_apply(self):
+        """Apply thread: process captured events in order"""
+        while self.running or not self.capture_queue.empty():
+            try:
+                change, seq, queued_at = self.capture_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+                
+            # Exponentially weighted average of the time spent queued
+            waited = time.monotonic() - queued_at
+            self._queue_wait_avg += 0.05 * (waited - self._queue_wait_avg)
+            self.monitoring_service.record_stage(self._collection_name(change), 'queue', waited)
+            self.monitoring_service.record_queue(
+                collection=self.checkpoint_key,
+                depth=self.capture_queue.qsize(),
+                wait_seconds=waited,
+                avg_wait_seconds=self._queue_wait_avg
+            )
+            
+            self._process_captured(change, seq)
+            
+    def _process_captured(self, change, seq):
+        """
+        Process an event, recording any failure instead of raising it
+        
+        Used by the apply thread and the inline path alike, so an event that
+        fails to filter, transform or encode does not end the thread.
+        """
+        try:
+            self._process_change(change, seq)
+        except Exception as e:
+            self.logger.error(f"Failed to process {change.get('operationType')} event: {str(e)}")
+            self.monitoring_service.record_error(
+                collection=self._collection_name(change),
+                error_type="process_change",
+                message=str(e)
+            )
+            self._complete(seq)
+            
+    def _checkpoint_idle(self):
+        """Advance the checkpoint to the post-batch resume token on a quiet stream"""
+        if not self.checkpoint_tracker:
+            return
+            
+        token = self.change_stream.resume_token
+        if not token or token == self.resume_token:
+            return
+            
+        cluster_time = resume_token_time(token)
+        if self.checkpoint_tracker.advance_idle(token, cluster_time):
+            self.resume_token = token
+            # Keeps the checkpoint lag of a quiet collection current
+            if cluster_time:
+                self.monitoring_service.record_checkpoint(collection=self.checkpoint_key, cluster_time=cluster_time)
+                
+    def _process_change(self, change, seq=None):
         """Process a single change event"""
         operation_type = change['operationType']
+        collection_name = self._collection_name(change)
         
         # Record operation
         self.monitoring_service.record_operation(
-            collection=self.source_collection.name,
+            collection=collection_name,
             operation_type=operation_type
         )
         
-        # Filter operation
-        if not self.operation_filter.should_process(change):
+        # Filter operation; every stage is timed, which costs a clock read
+        # and a histogram increment
+        started = time.perf_counter()
+        keep = self.operation_filter.should_process(change)
+        filtered = time.perf_counter()
+        self.monitoring_service.record_stage(collection_name, 'filter', filtered - started)
+        if not keep:
             self.logger.debug(f"Filtered out {operation_type} operation")
+            self._complete(seq)
             return
             
         # Transform operation
         transformed_op = self.operation_transformer.transform(change)
+        transformed = time.perf_counter()
+        self.monitoring_service.record_stage(collection_name, 'transform', transformed - filtered)
         
-        # Apply to target
-        result = self.target_applier.apply(
-            collection_name=self.source_collection.name,
-            operation=transformed_op
+        # Apply to target; the result is reported once the write completes,
+        # which may be later when the applier batches operations. Submitting
+        # only blocks when the applier writes inline or its queue is full;
+        # the write itself is timed as apply latency.
+        self.target_applier.submit(
+            collection_name=collection_name,
+            operation=transformed_op,
+            callback=functools.partial(
+                self._handle_apply_result,
+                collection_name,
+                operation_type,
+                seq,
+                time.monotonic(),
+                change.get('clusterTime')
+            )
         )
+        self.monitoring_service.record_stage(collection_name, 'submit', time.perf_counter() - transformed)
         
-        if result.get('success'):
+    def _collection_name(self, change):
+        """Name of the collection a change event belongs to"""
+        return self.source_collection.name
+        
+    def _handle_apply_result(self, collection_name, operation_type, seq, submitted_at, cluster_time, result):
+        """Record the outcome of applying an operation to the target"""
+        if result.get('spilled'):
+            # Durable in the spill log; it counts as applied, and for lag,
+            # once the drainer replays it
+            self.logger.debug(f"Spilled {operation_type} for a later replay")
+        elif result.get('success'):
             self.logger.debug(f"Successfully applied {operation_type} to target")
+            self.monitoring_service.record_apply(
+                collection=collection_name,
+                latency_seconds=time.monotonic() - submitted_at,
+                cluster_time=cluster_time
+            )
         else:
             self.logger.error(f"Failed to apply {operation_type}: {result.get('error')}")
             self.monitoring_service.record_error(
-                collection=self.source_collection.name,
+                collection=collection_name,
                 error_type="apply_operation",
                 message=result.get('error')
             )
+            
+        self._complete(seq)
         
+    def _complete(self, seq):
+        """Let the checkpoint advance past a finished event"""
+        if seq is None:
+            return
+            
+        advanced = self.checkpoint_tracker.complete(seq)
+        if advanced and advanced[1]:
+            self.monitoring_service.record_checkpoint(
+                collection=self.checkpoint_key,
+                cluster_time=advanced[1]
+            )
+            
     def stop(self):
         """Stop the change stream listener"""
         self.running = False
         if self.change_stream:
             self.change_stream.close()
+
+
+class DatabaseChangeStreamListener(ChangeStreamListener):
+    def __init__(self, source_db, collection_names, operation_filter, operation_transformer, target_applier,
+                 monitoring_service, checkpoint_store=None, update_lookup=False, capture_queue_size=10000,
+                 max_idle_wait_ms=100):
+        """
+        Listen to one database-level change stream and fan events out by collection
+        
+        A single server cursor and a single checkpoint cover every configured
+        collection; events are routed to the shared filter/transform/apply
+        pipeline using their ns.coll.
+        
+        Parameters:
+        -----------
+        source_db : pymongo.database.Database
+            Source MongoDB database to watch
+        collection_names : list
+            Collections whose events are replicated
+        """
+        # The database takes the place of the collection; it offers the same
+        # name attribute and watch() method
+        super().__init__(source_db, operation_filter, operation_transformer, target_applier, monitoring_service,
+                         checkpoint_store=checkpoint_store, update_lookup=update_lookup,
+                         capture_queue_size=capture_queue_size, max_idle_wait_ms=max_idle_wait_ms)
+        self.collection_names = list(collection_names)
+        self.logger = logging.getLogger(f"iris.listener.database.{source_db.name}{'.lookup' if update_lookup else ''}")
+        
+        self.checkpoint_key = self.checkpoint_key_for(source_db.name, update_lookup)
+        self.checkpoint_tracker = CheckpointTracker(checkpoint_store, self.checkpoint_key) if checkpoint_store else None
+        self.name = f"iris-listener-{self.checkpoint_key}"
+        
+    @staticmethod
+    def checkpoint_key_for(database_name, update_lookup=False):
+        """
+        Checkpoint key of a database-level stream
+        
+        Collections that need updateLookup are watched by a stream of their
+        own, which keeps a separate checkpoint.
+        """
+        if update_lookup:
+            return f"database:{database_name}:lookup"
+        return f"database:{database_name}"
+        
+    def _load_checkpoint(self):
+        """Checkpoint of the stream, falling back to the shared one for the lookup stream"""
+        checkpoint = super()._load_checkpoint()
+        if checkpoint is None and self.update_lookup:
+            # Initial sync, and versions that watched every collection with
+            # one stream, only record the shared checkpoint
+            checkpoint = self.checkpoint_store.load(self.checkpoint_key_for(self.source_collection.name))
+        return checkpoint
+        
+    def _open_change_stream(self):
+        """Open the database change stream restricted to the configured collections"""
+        options = {
+            'pipeline': [{'$match': {'ns.coll': {'$in': self.collection_names}}}] + self.operation_filter.pipeline(),
+            'max_await_time_ms': 1000
+        }
+        if self.update_lookup:
+            options['full_document'] = 'updateLookup'
+        if self.resume_token:
+            options['start_after'] = self.resume_token
+            
+        return self.source_collection.watch(**options)
+        
+    def _collection_name(self, change):
+        """Name of the collection a change event belongs to"""
+        # Invalidate events carry no namespace
+        return change.get('ns', {}).get('coll', self.source_collection.name)
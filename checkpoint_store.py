@@ -0,0 +1,265 @@
+import collections
+import datetime
+import logging
+import os
+import threading
+import time
+from bson import json_util
+from bson.timestamp import Timestamp
+from pymongo.errors import PyMongoError
+
+class CheckpointStore:
+    def __init__(self, config, target_db):
+        """
+        Initialize the checkpoint store
+        
+        Parameters:
+        -----------
+        config : dict
+            Checkpoint configuration (replication.checkpoint)
+        target_db : pymongo.database.Database
+            Target MongoDB database, used by the collection backend
+        """
+        self.config = config
+        self.logger = logging.getLogger("iris.checkpoint_store")
+        
+        self.backend = config.get('backend', 'collection')
+        self.path = config.get('path', 'iris_checkpoints.json')
+        self.flush_interval = config.get('flush_interval_seconds', 5)
+        self.flush_every = config.get('flush_every', 1000)
+        
+        if self.backend == 'collection':
+            self.collection = target_db[config.get('collection', '_minervadb_iris_checkpoints')]
+        elif self.backend == 'file':
+            self.collection = None
+        else:
+            raise ValueError(f"Unknown checkpoint backend: {self.backend}")
+            
+        self._lock = threading.Lock()
+        # Held for a whole flush, so a flush that read older checkpoints
+        # cannot write them after a newer one
+        self._flush_lock = threading.Lock()
+        self._checkpoints = self._read_all()  # Key -> checkpoint document
+        self._dirty = set()
+        self._updates_since_flush = 0
+        
+        self.running = False
+        self.thread = None
+        
+    def start(self):
+        """Start the periodic flush thread"""
+        if self.thread and self.thread.is_alive():
+            return
+            
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def stop(self):
+        """Stop the flush thread and persist outstanding checkpoints"""
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        
+    def load(self, key):
+        """
+        Return the last persisted checkpoint for a stream
+        
+        Returns:
+        --------
+        dict or None
+            Checkpoint with resume_token, cluster_time and updated_at
+        """
+        with self._lock:
+            return self._checkpoints.get(key)
+            
+    def update(self, key, resume_token, cluster_time=None):
+        """Record a new checkpoint in memory; it is persisted on the next flush"""
+        if self.record(key, resume_token, cluster_time):
+            self.flush()
+            
+    def record(self, key, resume_token, cluster_time=None):
+        """
+        Record a new checkpoint in memory without ever flushing
+        
+        Returns:
+        --------
+        bool
+            True when flush_every updates have accumulated and the caller
+            should flush once it holds no lock of its own
+        """
+        with self._lock:
+            self._checkpoints[key] = {
+                'resume_token': resume_token,
+                'cluster_time': cluster_time,
+                'updated_at': datetime.datetime.utcnow()
+            }
+            self._dirty.add(key)
+            self._updates_since_flush += 1
+            return self._updates_since_flush >= self.flush_every
+            
+    def flush(self):
+        """Persist checkpoints that changed since the last flush"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                dirty = {key: self._checkpoints[key] for key in self._dirty}
+                snapshot = dict(self._checkpoints)
+                self._dirty = set()
+                self._updates_since_flush = 0
+                
+            try:
+                if self.backend == 'collection':
+                    for key, checkpoint in dirty.items():
+                        self.collection.replace_one({'_id': key}, checkpoint, upsert=True)
+                else:
+                    self._write_file(snapshot)
+                    
+            except (PyMongoError, OSError) as e:
+                self.logger.error(f"Failed to persist checkpoints: {str(e)}")
+                with self._lock:
+                    self._dirty.update(dirty)
+                    
+    def _run(self):
+        """Flush loop"""
+        elapsed = 0.0
+        while self.running:
+            time.sleep(0.5)
+            elapsed += 0.5
+            if elapsed >= self.flush_interval:
+                elapsed = 0.0
+                self.flush()
+                
+    def _read_all(self):
+        """Load every stored checkpoint from the backend"""
+        try:
+            if self.backend == 'collection':
+                return {doc.pop('_id'): doc for doc in self.collection.find()}
+                
+            if not os.path.exists(self.path):
+                return {}
+            with open(self.path, 'r') as f:
+                return json_util.loads(f.read())
+                
+        except (PyMongoError, OSError, ValueError) as e:
+            self.logger.error(f"Failed to load checkpoints, starting without them: {str(e)}")
+            return {}
+            
+    def _write_file(self, checkpoints):
+        """Atomically replace the checkpoint file"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(json_util.dumps(checkpoints))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class CheckpointTracker:
+    def __init__(self, store, key, flush=None):
+        """
+        Track in-flight events of one change stream and advance its checkpoint
+        
+        Events may complete out of order (batched or parallel apply). The
+        checkpoint only moves past an event once it and every earlier event
+        have completed.
+        
+        Parameters:
+        -----------
+        store : CheckpointStore
+            Store the checkpoint is written to
+        key : str
+            Checkpoint key of the change stream
+        flush : callable
+            Called instead of store.flush() once flush_every updates have
+            accumulated; the asyncio engine uses it to flush off its loop
+        """
+        self.store = store
+        self.key = key
+        self.flush = flush or store.flush
+        self._lock = threading.Lock()
+        self._next_seq = 0
+        self._in_flight = collections.OrderedDict()  # Seq -> [resume_token, cluster_time, done]
+        
+    def track(self, resume_token, cluster_time=None):
+        """Register an event and return its sequence number"""
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._in_flight[seq] = [resume_token, cluster_time, False]
+            return seq
+            
+    def complete(self, seq):
+        """
+        Mark an event as completed
+        
+        Returns:
+        --------
+        tuple or None
+            (resume_token, cluster_time) of the new checkpoint if it advanced
+        """
+        with self._lock:
+            entry = self._in_flight.get(seq)
+            if entry is None:
+                return None
+            entry[2] = True
+            
+            advanced = None
+            while self._in_flight:
+                first_seq, first = next(iter(self._in_flight.items()))
+                if not first[2]:
+                    break
+                del self._in_flight[first_seq]
+                advanced = (first[0], first[1])
+                
+            # Recorded under the lock so concurrent completions cannot
+            # record an older checkpoint over a newer one; the write itself
+            # happens after releasing it
+            flush_now = self.store.record(self.key, *advanced) if advanced else False
+            
+        if flush_now:
+            self.flush()
+        return advanced
+        
+    def advance_idle(self, resume_token, cluster_time=None):
+        """
+        Move the checkpoint to a post-batch resume token of a quiet stream
+        
+        Only done when no tracked event is outstanding, since the token lies
+        beyond every event read so far.
+        
+        Returns:
+        --------
+        bool
+            True if the checkpoint was moved
+        """
+        with self._lock:
+            if self._in_flight:
+                return False
+            flush_now = self.store.record(self.key, resume_token, cluster_time)
+            
+        if flush_now:
+            self.flush()
+        return True
+        
+    @property
+    def pending(self):
+        """Number of events not yet reflected in the checkpoint"""
+        with self._lock:
+            return len(self._in_flight)
+
+
+def resume_token_time(resume_token):
+    """
+    clusterTime encoded at the start of a resume token, or None
+    
+    Resume tokens of MongoDB 4.2+ are a hex KeyString whose first value
+    is the event's (or, for a post-batch token, the scan's) timestamp.
+    """
+    data = resume_token.get('_data') if resume_token else None
+    if not isinstance(data, str) or len(data) < 18 or not data.startswith('82'):
+        return None
+    return Timestamp(int(data[2:10], 16), int(data[10:18], 16))
@@ -0,0 +1,179 @@
+import logging
+import threading
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from pymongo.write_concern import WriteConcern
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+
+# Client settings (source.client / target.client) -> MongoClient keyword
+CLIENT_OPTIONS = {
+    'max_pool_size': 'maxPoolSize',
+    'min_pool_size': 'minPoolSize',
+    'max_idle_time_ms': 'maxIdleTimeMS',
+    'max_connecting': 'maxConnecting',
+    'wait_queue_timeout_ms': 'waitQueueTimeoutMS',
+    'connect_timeout_ms': 'connectTimeoutMS',
+    'socket_timeout_ms': 'socketTimeoutMS',
+    'server_selection_timeout_ms': 'serverSelectionTimeoutMS',
+    'zlib_compression_level': 'zlibCompressionLevel',
+    'app_name': 'appname'
+}
+
+class ClientRegistry:
+    def __init__(self, config, monitoring_service=None, name_prefix=''):
+        """
+        One MongoClient per cluster, shared by every component of the process
+        
+        Clients are created on first use from source/target uri, auth_source
+        and the optional client section (pool size, timeouts, compression).
+        Wire compression defaults to zstd and snappy; PyMongo warns about and
+        skips a compressor whose module is not installed, and the server
+        picks the first one it supports.
+        
+        Parameters:
+        -----------
+        config : dict
+            Application configuration
+        monitoring_service : MonitoringService
+            Receives connection pool metrics; None to record none
+        name_prefix : str
+            Prefix of the pool names in metrics, e.g. a worker process index
+        """
+        self.config = config
+        self.monitoring_service = monitoring_service
+        self.name_prefix = name_prefix
+        self.logger = logging.getLogger("iris.client_registry")
+        
+        self._clients = {}  # "source" or "target" -> MongoClient
+        self._lock = threading.Lock()
+        
+    def client(self, side):
+        """Shared MongoClient of the source or target cluster"""
+        with self._lock:
+            client = self._clients.get(side)
+            if client is None:
+                options = self.options(side)
+                client = self._clients[side] = MongoClient(self.config[side]['uri'], **options)
+                self.logger.info(f"Created {side} client (maxPoolSize {client.options.pool_options.max_pool_size}, "
+                                 f"compressors {options.get('compressors', 'none')})")
+            return client
+            
+    def database(self, side, read_preference=None, write_concern=None):
+        """
+        Configured database of a side, optionally with another read preference or write concern
+        
+        Parameters:
+        -----------
+        read_preference : str or dict
+            Mode name, or {mode, max_staleness_seconds, tag_sets}
+        write_concern : dict
+            {w, j, wtimeout_ms}
+        """
+        database = self.client(side)[self.config[side]['database']]
+        options = {}
+        if read_preference:
+            options['read_preference'] = read_preference_from_config(read_preference)
+        if write_concern:
+            options['write_concern'] = write_concern_from_config(write_concern)
+        return database.with_options(**options) if options else database
+        
+    def options(self, side):
+        """MongoClient keyword arguments of a side; also used for AsyncMongoClient"""
+        side_config = self.config[side]
+        client_config = side_config.get('client', {})
+        
+        options = {CLIENT_OPTIONS[key]: value for key, value in client_config.items() if key in CLIENT_OPTIONS}
+        compressors = client_config.get('compressors', ['zstd', 'snappy'])
+        if compressors:
+            options['compressors'] = compressors if isinstance(compressors, str) else ','.join(compressors)
+            
+        # Only meaningful with credentials, which live in the uri
+        if side_config.get('auth_source'):
+            options['authSource'] = side_config['auth_source']
+            
+        if self.monitoring_service is not None:
+            options['event_listeners'] = [_PoolMetrics(self.monitoring_service, f"{self.name_prefix}{side}")]
+        return options
+        
+    def close(self):
+        """Close every client"""
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+
+def read_preference_from_config(read_preference):
+    """Read preference object for a mode name or {mode, max_staleness_seconds, tag_sets}"""
+    if isinstance(read_preference, str):
+        read_preference = {'mode': read_preference}
+        
+    mode = read_preference.get('mode', 'primary')
+    if mode not in READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference: {mode}")
+    if mode == 'primary':
+        return Primary()
+        
+    return READ_PREFERENCES[mode](
+        tag_sets=read_preference.get('tag_sets'),
+        max_staleness=read_preference.get('max_staleness_seconds', -1)
+    )
+
+
+def write_concern_from_config(write_concern):
+    """WriteConcern for {w, j, wtimeout_ms}"""
+    return WriteConcern(
+        w=write_concern.get('w'),
+        j=write_concern.get('j'),
+        wtimeout=write_concern.get('wtimeout_ms')
+    )
+
+
+class _PoolMetrics(ConnectionPoolListener):
+    """Forward connection pool events of one client to the monitoring service"""
+    
+    def __init__(self, monitoring_service, name):
+        self.monitoring_service = monitoring_service
+        self.name = name
+        
+    def connection_created(self, event):
+        self.monitoring_service.record_pool_event(self.name, 'created')
+        
+    def connection_closed(self, event):
+        self.monitoring_service.record_pool_event(self.name, 'closed')
+        
+    def connection_checked_out(self, event):
+        self.monitoring_service.record_pool_checkout(self.name, event.duration)
+        
+    def connection_check_out_failed(self, event):
+        self.monitoring_service.record_pool_event(self.name, 'checkout_failed')
+        
+    def connection_checked_in(self, event):
+        self.monitoring_service.record_pool_event(self.name, 'checked_in')
+        
+    def pool_cleared(self, event):
+        self.monitoring_service.record_pool_event(self.name, 'cleared')
+        
+    # Remaining pool events are not recorded
+    def pool_created(self, event):
+        pass
+        
+    def pool_ready(self, event):
+        pass
+        
+    def pool_closed(self, event):
+        pass
+        
+    def connection_ready(self, event):
+        pass
+        
+    def connection_check_out_started(self, event):
+        pass
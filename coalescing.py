@@ -0,0 +1,177 @@
+import bson
+from bson.raw_bson import RawBSONDocument
+
+def merge_operations(previous, operation, full_document=False, idempotent=False):
+    """
+    Merge two transformed operations on the same document into one net operation
+    
+    Parameters:
+    -----------
+    previous : dict
+        Operation still waiting to be written
+    operation : dict
+        Later operation on the same document
+    full_document : bool
+        True when updates of the collection are applied from their
+        fullDocument (update_mode "full_document")
+    idempotent : bool
+        True when inserts are written as guarded upserts (replication.idempotent);
+        otherwise nothing is folded into an insert. A replayed InsertOne
+        fails on its duplicate key, and a later change merged into it would
+        be lost with it.
+        
+    Returns:
+    --------
+    dict
+        Operation with the combined effect of both, or None when they have
+        to be written separately
+    """
+    if operation['operationType'] not in ('update', 'replace'):
+        return None
+    if previous['operationType'] == 'insert' and not idempotent:
+        return None
+        
+    # A later full document replaces whatever came before; an insert stays
+    # an insert, since the document is not on the target yet
+    document = _full_document(operation, full_document)
+    if document is not None:
+        merged = dict(operation)
+        if previous['operationType'] == 'insert':
+            merged['operationType'] = 'insert'
+        return merged
+        
+    description = operation['updateDescription']
+    previous_document = _full_document(previous, full_document)
+    if previous_document is not None:
+        document = apply_delta(previous_document, description)
+        if document is None:
+            return None
+        merged = dict(previous)
+        merged['fullDocument'] = document
+        merged['clusterTime'] = operation.get('clusterTime')
+        return merged
+        
+    description = merge_deltas(previous['updateDescription'], description)
+    if description is None:
+        return None
+    merged = dict(operation)
+    merged['updateDescription'] = description
+    return merged
+
+
+def merge_deltas(previous, description):
+    """
+    updateDescription with the effect of two consecutive ones, or None
+    
+    Only paths that are equal or unrelated are merged: the later value of
+    an equal path wins, and unrelated paths commute. A path inside or
+    above one changed earlier, or an array truncation, is not merged.
+    """
+    if previous.get('truncatedArrays') or description.get('truncatedArrays'):
+        return None
+        
+    previous_set = previous.get('updatedFields') or {}
+    previous_unset = previous.get('removedFields') or []
+    updated_fields = description.get('updatedFields') or {}
+    removed_fields = description.get('removedFields') or []
+    
+    previous_paths = list(previous_set) + list(previous_unset)
+    for path in list(updated_fields) + list(removed_fields):
+        if any(_overlaps(path, other) for other in previous_paths):
+            return None
+            
+    merged_set = {path: value for path, value in previous_set.items() if path not in removed_fields}
+    merged_set.update(updated_fields)
+    merged_unset = [path for path in previous_unset if path not in updated_fields]
+    merged_unset.extend(path for path in removed_fields if path not in previous_unset)
+    return {'updatedFields': merged_set, 'removedFields': merged_unset}
+
+
+def apply_delta(document, description):
+    """
+    Copy of a document with an updateDescription applied, or None
+    
+    Like the transformer, only the dictionaries and arrays on the changed
+    paths are copied; the rest is shared with the original document.
+    Returns None when a path cannot be followed (a missing parent or an
+    array index past the end), rather than guessing what the server did.
+    """
+    if isinstance(document, RawBSONDocument):
+        document = bson.decode(document.raw)
+    else:
+        document = dict(document)
+    copied = {id(document)}
+    
+    for truncated in description.get('truncatedArrays') or []:
+        array = _container(document, truncated['field'].split('.'), copied)
+        if not isinstance(array, list):
+            return None
+        del array[truncated['newSize']:]
+        
+    for path, value in (description.get('updatedFields') or {}).items():
+        parent, key = _parent(document, path, copied)
+        if isinstance(parent, dict):
+            parent[key] = value
+        elif isinstance(parent, list) and key.isdigit() and int(key) < len(parent):
+            parent[int(key)] = value
+        else:
+            return None
+            
+    for path in description.get('removedFields') or []:
+        parent, key = _parent(document, path, copied)
+        if isinstance(parent, dict):
+            parent.pop(key, None)
+        elif isinstance(parent, list) and key.isdigit() and int(key) < len(parent):
+            # $unset of an array element leaves null in its place
+            parent[int(key)] = None
+            
+    return document
+
+
+def _full_document(operation, full_document):
+    """Full document an operation writes, or None for a delta update"""
+    if operation['operationType'] == 'update' and not full_document:
+        return None
+    return operation.get('fullDocument')
+
+
+def _overlaps(path, other):
+    """True when two different paths are one inside the other"""
+    if path == other:
+        return False
+    return path.startswith(other + '.') or other.startswith(path + '.')
+
+
+def _parent(document, path, copied):
+    """Container holding the last part of a dotted path, and that part"""
+    parts = path.split('.')
+    return _container(document, parts[:-1], copied), parts[-1]
+
+
+def _container(document, parts, copied):
+    """
+    Value at a path, copying every dict and list on the way once
+    
+    Copies replace the originals in their parent and are remembered by id
+    in copied, so later paths through them change the copy in place.
+    """
+    container = document
+    for part in parts:
+        child = _get(container, part)
+        if isinstance(child, (dict, list)) and id(child) not in copied:
+            child = dict(child) if isinstance(child, dict) else list(child)
+            copied.add(id(child))
+            if isinstance(container, dict):
+                container[part] = child
+            else:
+                container[int(part)] = child
+        container = child
+    return container
+
+
+def _get(container, key):
+    if isinstance(container, dict):
+        return container.get(key)
+    if isinstance(container, list) and key.isdigit() and int(key) < len(container):
+        return container[int(key)]
+    return None
@@ -0,0 +1,177 @@
+import datetime
+import gzip
+import logging
+import os
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import BulkWriteError
+
+# Documents are read and restored as raw BSON, so archiving never decodes
+# or re-encodes a document body
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+# Duplicate key; the document is already present on the restore target
+DUPLICATE_KEY = 11000
+
+class ColdArchive:
+    def __init__(self, config):
+        """
+        Compressed on-disk archive of documents removed by retention
+        
+        Documents are stored as concatenated raw BSON in gzip segment files,
+        one directory per collection and one file per day of the retention
+        timestamp:
+        
+            <path>/<collection>/<YYYY-MM-DD>.bson.gz
+            
+        Every write appends a new gzip member and is fsynced before the
+        caller deletes the documents. A decompressed segment is a plain BSON
+        dump that mongorestore and bsondump can read. Documents archived twice
+        by an interrupted purge are deduplicated on restore.
+        
+        Parameters:
+        -----------
+        config : dict
+            Archive configuration (retention.archive) with path, batch_size
+            (cursor batch size for whole-collection archives) and
+            compression_level
+        """
+        self.path = config.get('path', 'iris_archive')
+        self.batch_size = config.get('batch_size', 10000)
+        self.compression_level = config.get('compression_level', 6)
+        self.logger = logging.getLogger("iris.cold_archive")
+        
+    def reader(self, collection):
+        """The collection with raw BSON documents, as write() expects them"""
+        return collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+        
+    def write(self, collection_name, documents, timestamp_field):
+        """
+        Append documents to the segments of the days they belong to
+        
+        Parameters:
+        -----------
+        collection_name : str
+            Logical collection the documents belong to
+        documents : list
+            RawBSONDocument instances
+        timestamp_field : str
+            Field whose date selects the segment
+        """
+        by_day = {}
+        for document in documents:
+            by_day.setdefault(self._day(document.get(timestamp_field)), []).append(document.raw)
+            
+        for day, raw_documents in by_day.items():
+            self._append(self._segment_path(collection_name, day), raw_documents)
+            
+    def write_collection(self, collection_name, collection, timestamp_field):
+        """
+        Stream a whole collection into the archive with constant memory
+        
+        Returns:
+        --------
+        int
+            Number of documents archived
+        """
+        archived = 0
+        chunk = []
+        cursor = self.reader(collection).find().batch_size(self.batch_size)
+        for document in cursor:
+            chunk.append(document)
+            if len(chunk) >= self.batch_size:
+                self.write(collection_name, chunk, timestamp_field)
+                archived += len(chunk)
+                chunk = []
+                
+        if chunk:
+            self.write(collection_name, chunk, timestamp_field)
+            archived += len(chunk)
+            
+        self.logger.info(f"Archived {archived} documents of {collection.name} as {collection_name}")
+        return archived
+        
+    def segments(self, collection_name, from_day=None, to_day=None):
+        """Segment files of a collection within an inclusive YYYY-MM-DD range, oldest first"""
+        directory = os.path.join(self.path, collection_name)
+        if not os.path.isdir(directory):
+            return []
+            
+        paths = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.bson.gz'):
+                continue
+            day = name[:-len('.bson.gz')]
+            if (from_day and day < from_day) or (to_day and day > to_day):
+                continue
+            paths.append(os.path.join(directory, name))
+        return paths
+        
+    def restore(self, target_db, collection_name, from_day=None, to_day=None, into=None, batch_size=1000):
+        """
+        Bulk load archived documents back into a target collection
+        
+        Parameters:
+        -----------
+        target_db : pymongo.database.Database
+            Database to restore into
+        collection_name : str
+            Archived collection to restore
+        from_day, to_day : str
+            Optional inclusive YYYY-MM-DD range of segments
+        into : str
+            Destination collection; defaults to collection_name
+        batch_size : int
+            Documents per insert_many
+            
+        Returns:
+        --------
+        int
+            Number of documents inserted (documents already present are skipped)
+        """
+        target = target_db[into or collection_name]
+        restored = 0
+        
+        for path in self.segments(collection_name, from_day, to_day):
+            batch = []
+            with gzip.open(path, 'rb') as segment:
+                for document in bson.decode_file_iter(segment, codec_options=RAW_CODEC_OPTIONS):
+                    batch.append(document)
+                    if len(batch) >= batch_size:
+                        restored += self._insert(target, batch)
+                        batch = []
+            if batch:
+                restored += self._insert(target, batch)
+            self.logger.info(f"Restored {path} into {target.name}")
+            
+        return restored
+        
+    def _insert(self, target, batch):
+        """Insert a batch, skipping documents that are already present"""
+        try:
+            return len(target.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            errors = [error for error in e.details.get('writeErrors', []) if error['code'] != DUPLICATE_KEY]
+            if errors or e.details.get('writeConcernErrors'):
+                raise
+            return e.details.get('nInserted', 0)
+            
+    def _append(self, path, raw_documents):
+        """Append one gzip member and make it durable"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=self.compression_level) as member:
+                for raw in raw_documents:
+                    member.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+            
+    def _segment_path(self, collection_name, day):
+        return os.path.join(self.path, collection_name, f"{day}.bson.gz")
+        
+    @staticmethod
+    def _day(value):
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%d')
+        return 'undated'
@@ -0,0 +1,238 @@
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pymongo.errors import BulkWriteError, PyMongoError
+
+# Duplicate key; a document copied by an interrupted run is already on the target
+DUPLICATE_KEY = 11000
+
+class InitialSync:
+    def __init__(self, config, source_db, target_db, operation_transformer, checkpoint_store, monitoring_service,
+                 stream_key=None, target_applier=None):
+        """
+        Initialize the initial sync (backfill) engine
+        
+        Parameters:
+        -----------
+        config : dict
+            Application configuration
+        source_db : pymongo.database.Database
+            Source MongoDB database
+        target_db : pymongo.database.Database
+            Target MongoDB database
+        operation_transformer : OperationTransformer
+            Transformer applied to every copied document
+        checkpoint_store : CheckpointStore
+            Store receiving the change stream start point of each collection
+        monitoring_service : MonitoringService
+            Receives partition progress
+        stream_key : str
+            Checkpoint key of a database-level change stream; None when every
+            collection has its own stream
+        target_applier : TargetApplier
+            Routes documents of partitioned collections to their buckets
+        """
+        sync_config = config['replication'].get('initial_sync', {})
+        self.logger = logging.getLogger("iris.initial_sync")
+        
+        self.source_db = source_db
+        self.target_db = target_db
+        self.operation_transformer = operation_transformer
+        self.checkpoint_store = checkpoint_store
+        self.monitoring_service = monitoring_service
+        self.stream_key = stream_key
+        self.target_applier = target_applier
+        
+        self.workers = sync_config.get('workers', 4)
+        self.partitions = sync_config.get('partitions_per_collection', 8)
+        self.batch_size = sync_config.get('batch_size', 1000)
+        self.state = target_db[sync_config.get('state_collection', '_minervadb_iris_initial_sync')]
+        
+    def run(self, collection_names):
+        """
+        Copy every collection that has not completed an initial sync
+        
+        Partitions of all collections share one worker pool. Partitions that
+        finished in an earlier, interrupted run are skipped and unfinished
+        ones continue after the last copied _id.
+        """
+        tasks = []
+        for collection_name in collection_names:
+            tasks.extend(self._prepare_collection(collection_name))
+            
+        if not tasks:
+            return
+            
+        self.logger.info(f"Initial sync of {len(tasks)} partitions with {self.workers} workers")
+        
+        failed = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self._copy_partition, task): task for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    future.result()
+                except PyMongoError as e:
+                    failed.add(task['collection'])
+                    self.logger.error(f"Initial sync of {task['_id']} failed: {str(e)}")
+                    self.monitoring_service.record_error(
+                        collection=task['collection'],
+                        error_type="initial_sync",
+                        message=str(e)
+                    )
+                    
+        for collection_name in {task['collection'] for task in tasks} - failed:
+            self.state.update_one(
+                {'_id': collection_name},
+                {'$set': {'status': 'complete', 'completed_at': datetime.datetime.utcnow()}}
+            )
+            self.logger.info(f"Initial sync complete for {collection_name}")
+            
+    def _prepare_collection(self, collection_name):
+        """Return the partitions of a collection that still need copying"""
+        state = self.state.find_one({'_id': collection_name})
+        
+        if state and state['status'] == 'complete':
+            return []
+            
+        if not state:
+            # The change stream start point is recorded before the first
+            # document is read, so streaming replays everything the copy
+            # might have missed
+            self._record_start_point(collection_name)
+            
+            boundaries = self._partition_boundaries(collection_name)
+            bounds = [None] + boundaries + [None]
+            partitions = [{
+                '_id': f"{collection_name}:{index}",
+                'collection': collection_name,
+                'index': index,
+                'lower': bounds[index],
+                'upper': bounds[index + 1],
+                'last_id': None,
+                'copied': 0,
+                'done': False
+            } for index in range(len(bounds) - 1)]
+            
+            # Upserts, so a run interrupted while partitioning can redo it
+            for partition in partitions:
+                self.state.replace_one({'_id': partition['_id']}, dict(partition, type='partition'), upsert=True)
+            self.state.insert_one({
+                '_id': collection_name,
+                'status': 'running',
+                'partitions': len(partitions),
+                'started_at': datetime.datetime.utcnow()
+            })
+            self.logger.info(f"Initial sync of {collection_name} split into {len(partitions)} partitions")
+            
+        return list(self.state.find({'type': 'partition', 'collection': collection_name, 'done': False}))
+        
+    def _record_start_point(self, collection_name):
+        """Store the current change stream position as the stream's checkpoint"""
+        if self.stream_key:
+            key, source = self.stream_key, self.source_db
+        else:
+            key, source = collection_name, self.source_db[collection_name]
+            
+        if self.checkpoint_store.load(key):
+            # Streaming already ran; its older checkpoint covers the copy
+            # window too
+            return
+            
+        with source.watch(max_await_time_ms=1) as stream:
+            self.checkpoint_store.update(key, stream.resume_token)
+        self.checkpoint_store.flush()
+        
+    def _partition_boundaries(self, collection_name):
+        """
+        Pick _id split points from a random sample of the collection
+        
+        Ranges are built with $gte/$lt on _id, which assumes the _id values
+        share one BSON type (as with the default ObjectIds).
+        """
+        if self.partitions <= 1:
+            return []
+            
+        sample = list(self.source_db[collection_name].aggregate([
+            {'$sample': {'size': self.partitions * 20}},
+            {'$project': {'_id': 1}},
+            {'$sort': {'_id': 1}}
+        ]))
+        if len(sample) < self.partitions:
+            return []
+            
+        step = len(sample) / self.partitions
+        boundaries = []
+        for index in range(1, self.partitions):
+            value = sample[int(index * step)]['_id']
+            if not boundaries or boundaries[-1] != value:
+                boundaries.append(value)
+        return boundaries
+        
+    def _copy_partition(self, task):
+        """Copy one _id range in batches, recording progress after each batch"""
+        collection_name = task['collection']
+        
+        id_range = {}
+        if task['last_id'] is not None:
+            id_range['$gt'] = task['last_id']
+        elif task['lower'] is not None:
+            id_range['$gte'] = task['lower']
+        if task['upper'] is not None:
+            id_range['$lt'] = task['upper']
+            
+        cursor = self.source_db[collection_name].find(
+            {'_id': id_range} if id_range else {}
+        ).sort('_id', 1).batch_size(self.batch_size)
+        
+        copied = task['copied']
+        batch = []
+        for document in cursor:
+            batch.append(self._transform(document))
+            if len(batch) >= self.batch_size:
+                copied = self._write_batch(task, batch, copied)
+                batch = []
+                
+        if batch:
+            copied = self._write_batch(task, batch, copied)
+            
+        self.state.update_one({'_id': task['_id']}, {'$set': {'done': True}})
+        self.monitoring_service.record_sync_progress(collection_name, task['index'], copied, done=True)
+        
+    def _write_batch(self, task, batch, copied):
+        """Insert a batch and persist the partition's resume position"""
+        # Partitioned collections spread one batch over several buckets
+        by_target = {}
+        for document in batch:
+            by_target.setdefault(self._route(task['collection'], document), []).append(document)
+            
+        for target_name, documents in by_target.items():
+            try:
+                self.target_db[target_name].insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                errors = [error for error in e.details.get('writeErrors', []) if error['code'] != DUPLICATE_KEY]
+                if errors or e.details.get('writeConcernErrors'):
+                    raise
+                    
+        copied += len(batch)
+        self.state.update_one(
+            {'_id': task['_id']},
+            {'$set': {'last_id': batch[-1]['_id'], 'copied': copied}}
+        )
+        self.monitoring_service.record_sync_progress(task['collection'], task['index'], copied, done=False)
+        return copied
+        
+    def _route(self, collection_name, document):
+        """Target collection of a copied document"""
+        if not self.target_applier:
+            return collection_name
+        return self.target_applier.route(collection_name, {'operationType': 'insert', 'fullDocument': document})
+        
+    def _transform(self, document):
+        """Run a copied document through the transformer as if it were an insert"""
+        transformed = self.operation_transformer.transform({
+            'operationType': 'insert',
+            'documentKey': {'_id': document['_id']},
+            'fullDocument': document
+        })
+        return transformed['fullDocument']
@@ -7,6 +7,8 @@ import argparse
 import signal
 from replication_controller import ReplicationController
 from retention_manager import RetentionManager
+from cold_archive import ColdArchive
+from client_registry import ClientRegistry
 
 def setup_logging(config):
     """Set up logging based on configuration"""
@@ -30,10 +32,29 @@ def load_config(config_path):
         print(f"Error loading configuration: {str(e)}")
         sys.exit(1)
 
+def restore_archive(config, archive_config, args, logger):
+    """Load archived documents back into the target database"""
+    clients = ClientRegistry(config)
+    target_db = clients.database('target')
+    
+    restored = ColdArchive(archive_config).restore(
+        target_db,
+        args.restore,
+        from_day=args.from_day,
+        to_day=args.to_day,
+        into=args.into
+    )
+    logger.info(f"Restored {restored} documents of {args.restore}")
+    clients.close()
+
 def main():
     """Main entry point for the application"""
     parser = argparse.ArgumentParser(description='MinervaDB Iris: MongoDB Replication with Differential Retention')
     parser.add_argument('-c', '--config', default='config/config.yaml', help='Path to configuration file')
+    parser.add_argument('--restore', metavar='COLLECTION', help='Restore archived documents of a collection and exit')
+    parser.add_argument('--from-day', help='First archive day to restore (YYYY-MM-DD)')
+    parser.add_argument('--to-day', help='Last archive day to restore (YYYY-MM-DD)')
+    parser.add_argument('--into', help='Target collection to restore into (default: the archived collection)')
     args = parser.parse_args()
     
     # Load configuration
@@ -43,6 +64,12 @@ def main():
     setup_logging(config)
     
     logger = logging.getLogger("iris.main")
+    
+    archive_config = config.get('retention', {}).get('archive', {})
+    if args.restore:
+        restore_archive(config, archive_config, args, logger)
+        return
+        
     logger.info("Starting MinervaDB Iris")
     
     # Print banner
@@ -59,7 +86,13 @@ def main():
     
     # Initialize components
     replication_controller = ReplicationController(config)
-    retention_manager = RetentionManager(config)
+    retention_manager = RetentionManager(
+        config,
+        monitoring_service=replication_controller.monitoring_service,
+        partitioners=replication_controller.partitioners,
+        archive=ColdArchive(archive_config) if archive_config.get('enabled', False) else None,
+        clients=replication_controller.clients
+    )
     
     # Handle shutdown signals
     def signal_handler(sig, frame):
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from pymongo.errors import PyMongoError
+
+class LagMonitor:
+    def __init__(self, config, source_client, monitoring_service, target_applier, apply_stage=None):
+        """
+        Track replication lag per collection and switch lagging collections
+        into catch-up mode
+        
+        Lag is measured from the clusterTime of each collection's last
+        acknowledged event, against the wall clock at acknowledgement and
+        against the source's latest optime (hello.lastWrite). A collection
+        whose lag exceeds replication.max_lag_seconds gets larger apply
+        batches and more apply workers, and retention purges pause while any
+        collection catches up. It returns to normal once its lag is below
+        catch_up.exit_lag_seconds.
+        
+        The optime lag only counts while events are waiting in a capture
+        queue; an idle collection's last event is naturally far behind the
+        optime of a busy source.
+        
+        Parameters:
+        -----------
+        config : dict
+            Application configuration
+        source_client : pymongo.MongoClient
+            Client of the source deployment
+        monitoring_service : MonitoringService
+            Provides acknowledged event times and receives lag and mode
+        target_applier : TargetApplier
+            Switched to catch-up batch sizes
+        apply_stage : PartitionedApplier
+            Switched to catch-up parallelism; None without apply workers
+        """
+        replication_config = config['replication']
+        catch_up_config = replication_config.get('catch_up', {})
+        self.logger = logging.getLogger("iris.lag_monitor")
+        
+        self.source_client = source_client
+        self.monitoring_service = monitoring_service
+        self.target_applier = target_applier
+        self.apply_stage = apply_stage
+        
+        self.collection_names = [c['name'] for c in replication_config['collections']]
+        self.max_lag = replication_config.get('max_lag_seconds', 300)
+        self.exit_lag = catch_up_config.get('exit_lag_seconds', 30)
+        self.interval = catch_up_config.get('check_interval_seconds', 5)
+        self.enabled = catch_up_config.get('enabled', True)
+        
+        self.catching_up = set()
+        self.running = False
+        self.thread = None
+        
+    def start(self):
+        """Start the lag monitor thread"""
+        if self.thread and self.thread.is_alive():
+            return
+            
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="iris-lag-monitor")
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def stop(self):
+        """Stop the lag monitor thread"""
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=30)
+            
+    def _run(self):
+        while self.running:
+            try:
+                self.check()
+            except Exception as e:
+                self.logger.error(f"Lag check failed: {str(e)}")
+                
+            deadline = time.monotonic() + self.interval
+            while self.running and time.monotonic() < deadline:
+                time.sleep(min(0.5, deadline - time.monotonic()))
+                
+    def check(self):
+        """Measure the lag of every collection and update catch-up modes"""
+        source_optime = self._source_optime()
+        backlogged = self._backlogged()
+        
+        for collection_name in self.collection_names:
+            lag, optime_lag = self.monitoring_service.replication_lag(collection_name, source_optime)
+            effective = lag
+            if optime_lag is not None and (collection_name in backlogged or 'database' in backlogged):
+                effective = max(effective or 0, optime_lag)
+                
+            if effective is not None and self.enabled:
+                if collection_name not in self.catching_up and effective > self.max_lag:
+                    self._set_catch_up(collection_name, True, effective)
+                elif collection_name in self.catching_up and effective <= self.exit_lag:
+                    self._set_catch_up(collection_name, False, effective)
+                    
+            self.monitoring_service.record_lag(
+                collection=collection_name,
+                lag_seconds=lag,
+                optime_lag_seconds=optime_lag,
+                catch_up=collection_name in self.catching_up
+            )
+            
+    def _set_catch_up(self, collection_name, enabled, lag):
+        if enabled:
+            self.catching_up.add(collection_name)
+            self.logger.warning(f"{collection_name} is {lag:.0f}s behind; entering catch-up mode")
+        else:
+            self.catching_up.discard(collection_name)
+            self.logger.info(f"{collection_name} caught up ({lag:.0f}s behind); leaving catch-up mode")
+            
+        self.target_applier.set_catch_up(collection_name, enabled)
+        if self.apply_stage:
+            self.apply_stage.set_catch_up(collection_name, enabled)
+            
+    def _backlogged(self):
+        """Collections (or "database" for a shared stream) with events waiting in a capture queue"""
+        return {
+            'database' if name.startswith('database:') else name
+            for name, depth in self.monitoring_service.capture_queue_depths().items() if depth
+        }
+        
+    def _source_optime(self):
+        """Timestamp of the source's latest write; None where hello does not report it"""
+        try:
+            hello = self.source_client.admin.command('hello')
+        except PyMongoError as e:
+            self.logger.debug(f"Could not read source optime: {str(e)}")
+            return None
+        return hello.get('lastWrite', {}).get('opTime', {}).get('ts')
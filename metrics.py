@@ -0,0 +1,161 @@
+import collections
+import threading
+
+class ShardedCounter:
+    def __init__(self):
+        """
+        Counters that many threads increment without a shared lock
+        
+        Every thread increments its own shard, a plain dict that no other
+        thread writes. Reading sums the shards; copying a dict happens under
+        the GIL, so a reader sees each shard in a consistent state.
+        """
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()  # Only taken when a thread creates its shard
+        
+    def increment(self, key, amount=1):
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + amount
+        
+    def snapshot(self):
+        """Totals of all shards, keyed like increment()"""
+        with self._lock:
+            shards = list(self._shards)
+            
+        totals = {}
+        for shard in shards:
+            for key, value in dict(shard).items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+        
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+
+class RingBuffer:
+    def __init__(self, size):
+        """
+        Keep the most recent records in a fixed amount of memory
+        
+        Appending is O(1) and thread-safe; the oldest record is discarded
+        once the buffer is full.
+        """
+        self._records = collections.deque(maxlen=size)
+        
+    def append(self, record):
+        self._records.append(record)
+        
+    def snapshot(self):
+        """Records, oldest first"""
+        return list(self._records)
+
+
+class Histogram:
+    # Values are recorded in microseconds. Each power of two is split into
+    # 2**(SUB_BUCKET_BITS - 1) linear sub-buckets, which bounds the relative
+    # error of any reported value to about 3%.
+    SUB_BUCKET_BITS = 6
+    
+    # Upper bounds, in milliseconds, of the cumulative buckets exposed to
+    # scrapers; each is widened to the edge of the fine-grained bucket it
+    # falls into (see _cumulative)
+    EXPOSITION_BOUNDS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 300000)
+    
+    # Bounds for the in-process pipeline stages, which take microseconds
+    STAGE_BOUNDS_MS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 100, 1000)
+    
+    def __init__(self):
+        """
+        Log-linear (HDR style) histogram of durations
+        
+        Recording costs one bucket computation and one sharded counter
+        increment. Percentiles are derived from the bucket counts only when
+        a snapshot is taken.
+        """
+        self._counts = ShardedCounter()
+        
+    def record(self, seconds):
+        value = max(0, int(seconds * 1000000))
+        self._counts.increment(self._bucket(value))
+        self._counts.increment('sum', value)
+        
+    def snapshot(self, bounds=None):
+        """
+        Count, sum, mean, percentiles and maximum in milliseconds
+        
+        'buckets' lists [bound_ms, cumulative count] pairs for bounds
+        (default EXPOSITION_BOUNDS_MS), each bound widened to the exclusive
+        edge of the fine-grained bucket it falls into. Returns only count,
+        sum and buckets before the first value.
+        """
+        counts = self._counts.snapshot()
+        total_sum = counts.pop('sum', 0)
+        buckets = sorted(counts.items())
+        count = sum(bucket_count for _, bucket_count in buckets)
+        
+        summary = {
+            'count': count,
+            'sum_ms': total_sum / 1000.0,
+            'buckets': self._cumulative(buckets, bounds or self.EXPOSITION_BOUNDS_MS)
+        }
+        if not count:
+            return summary
+            
+        summary['mean_ms'] = total_sum / count / 1000.0
+        for name, quantile in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99), ('p999_ms', 0.999)):
+            summary[name] = self._percentile(buckets, count, quantile)
+        summary['max_ms'] = self._upper_bound(buckets[-1][0]) / 1000.0
+        return summary
+        
+    def _cumulative(self, buckets, bounds):
+        """
+        Cumulative counts at each bound, for "le" style exposition
+        
+        A value is only known to lie within its fine-grained bucket, so a
+        bound inside a bucket counts that whole bucket and is reported as
+        the bucket's exclusive upper edge. Every count then holds exactly
+        the values below its reported bound, at the cost of bounds up to one
+        sub-bucket (about 3%) above the configured ones; a value equal to a
+        configured bound is counted at that bound.
+        """
+        cumulative = []
+        index = 0
+        seen = 0
+        for bound in bounds:
+            last_bucket = self._bucket(int(bound * 1000))
+            while index < len(buckets) and buckets[index][0] <= last_bucket:
+                seen += buckets[index][1]
+                index += 1
+            cumulative.append([(self._upper_bound(last_bucket) + 1) / 1000.0, seen])
+        return cumulative
+        
+    def _percentile(self, buckets, count, quantile):
+        rank = quantile * count
+        seen = 0
+        for bucket, bucket_count in buckets:
+            seen += bucket_count
+            if seen >= rank:
+                return self._upper_bound(bucket) / 1000.0
+        return self._upper_bound(buckets[-1][0]) / 1000.0
+        
+    @classmethod
+    def _bucket(cls, value):
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        return (shift << cls.SUB_BUCKET_BITS) + (value >> shift)
+        
+    @classmethod
+    def _upper_bound(cls, bucket):
+        """Highest value that falls into a bucket"""
+        shift = bucket >> cls.SUB_BUCKET_BITS
+        if shift == 0:
+            return bucket
+        sub_bucket = bucket - (shift << cls.SUB_BUCKET_BITS)
+        return ((sub_bucket + 1) << shift) - 1
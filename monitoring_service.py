@@ -1,10 +1,16 @@
+import asyncio
 import logging
 import threading
 import time
 import datetime
+import hashlib
 import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import urllib.parse
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from pymongo import MongoClient
+from .metrics import Histogram, RingBuffer, ShardedCounter
+from .profiler import SamplingProfiler
 
 class MonitoringService:
     def __init__(self, config):
@@ -19,25 +25,56 @@ class MonitoringService:
         self.config = config
         self.logger = logging.getLogger("iris.monitoring")
         
-        # Use in-memory storage for metrics
+        # Hot-path metrics are recorded into structures that need no shared
+        # lock and are only aggregated when a snapshot is read
+        self.operations = ShardedCounter()  # (collection, operation type) -> count
+        self.errors = RingBuffer(config.get('error_buffer_size', 1000))
+        self.error_counts = ShardedCounter()  # (collection, error type) -> count
+        self.latency = {}  # (collection, "apply" or "replication_lag") -> Histogram
+        self.stages = {}  # (collection, pipeline stage) -> Histogram
+        self.pool_events = ShardedCounter()  # (pool, event) -> count
+        self.pool_checkout = {}  # Pool -> Histogram of connection checkout waits
+        self.coalescing = ShardedCounter()  # (collection, "events" or "writes") -> count
+        self.last_operations = {}  # Collection -> (operation type, epoch seconds)
+        self.last_errors = {}  # Collection -> (error type, message, epoch seconds)
+        self.last_applied = {}  # Collection -> (clusterTime seconds, acknowledged at epoch seconds)
+        
+        # Use in-memory storage for the remaining metrics
         self.metrics = {
-            'operations': {},  # Collection -> operation type -> count
-            'errors': [],      # List of error records
+            'initial_sync': {},  # Collection -> partition -> progress
+            'retention': {},     # "side:collection" -> purge progress
+            'spill': {},         # Spill queue size, age and drain rate
+            'workers': {},       # Worker process index -> pid, liveness, restarts, collections
             'status': {
                 'start_time': datetime.datetime.utcnow(),
                 'collections': {}  # Collection status
             }
         }
         
-        # Web server for monitoring
+        # Latest snapshot of every replication worker process, merged into
+        # snapshot() so the one endpoint covers all collections
+        self.worker_snapshots = {}
+        
+        # Web server for monitoring; responses are rendered from a snapshot
+        # cached for a short time, so concurrent scrapers share one render
+        self.renderer = MonitoringRenderer(self, cache_ttl=config.get('cache_ttl_seconds', 1.0))
+        
+        # Serves /debug/profile; samples nothing until it is requested
+        self.profiler = SamplingProfiler(
+            interval_ms=config.get('profile_interval_ms', 5),
+            max_seconds=config.get('profile_max_seconds', 60),
+            thread_prefix=config.get('profile_thread_prefix', 'iris-')
+        ) if config.get('profiling_enabled', True) else None
         self.server = None
         self.server_thread = None
         
     def start(self):
         """Start the monitoring service"""
-        # Start HTTP server
+        # Start HTTP server; one thread per request so a slow client does not
+        # block the others
         server_address = ('', self.config['port'])
-        self.server = HTTPServer(server_address, lambda *args: MonitoringRequestHandler(self, *args))
+        self.server = ThreadingHTTPServer(server_address, lambda *args: MonitoringRequestHandler(self, *args))
+        self.server.daemon_threads = True
         self.server_thread = threading.Thread(target=self.server.serve_forever)
         self.server_thread.daemon = True
         self.server_thread.start()
@@ -46,53 +83,361 @@ class MonitoringService:
         
     def stop(self):
         """Stop the monitoring service"""
-        if self.server:
+        if self.server and self.server_thread:
             self.server.shutdown()
             self.server.server_close()
             self.server_thread.join()
             self.logger.info("Monitoring service stopped")
             
+    async def serve_async(self):
+        """
+        Serve the monitoring endpoints on the running event loop
+        
+        Used by the asyncio engine instead of start(), so no server thread
+        is needed.
+        """
+        async def handle(reader, writer):
+            try:
+                request_line = await reader.readline()
+                if_none_match = None
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'if-none-match':
+                        if_none_match = value.strip()
+                        
+                parts = request_line.decode('latin-1').split()
+                path = parts[1] if len(parts) > 1 else '/'
+                if path.startswith('/debug/'):
+                    # A profile samples for seconds; keep the loop running
+                    # so the profile sees it at work
+                    status, content_type, body, etag = await asyncio.get_running_loop().run_in_executor(
+                        None, self.renderer.respond, path, if_none_match
+                    )
+                else:
+                    status, content_type, body, etag = self.renderer.respond(path, if_none_match)
+                    
+                headers = [
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+                    f"Content-Length: {len(body)}",
+                    "Connection: close"
+                ]
+                if content_type:
+                    headers.append(f"Content-type: {content_type}")
+                if etag:
+                    headers.append(f"ETag: {etag}")
+                writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode() + body)
+                await writer.drain()
+            finally:
+                writer.close()
+                
+        self.server = await asyncio.start_server(handle, port=self.config['port'])
+        self.logger.info(f"Monitoring service started on port {self.config['port']} (asyncio)")
+        return self.server
+        
     def record_operation(self, collection, operation_type):
         """Record an operation in the metrics"""
-        if collection not in self.metrics['operations']:
-            self.metrics['operations'][collection] = {}
+        self.operations.increment((collection, operation_type))
+        self.last_operations[collection] = (operation_type, time.time())
+        
+    def record_error(self, collection, error_type, message):
+        """Record an error in the metrics; only the most recent errors are kept"""
+        now = time.time()
+        self.errors.append((collection, error_type, message, now))
+        self.error_counts.increment((collection, error_type))
+        self.last_errors[collection] = (error_type, message, now)
+        
+    def record_apply(self, collection, latency_seconds, cluster_time=None):
+        """
+        Record an acknowledged apply
+        
+        Parameters:
+        -----------
+        collection : str
+            Collection the operation was applied to
+        latency_seconds : float
+            Time from submitting the operation to the target acknowledging it
+        cluster_time : bson.timestamp.Timestamp
+            clusterTime of the source event, for end-to-end replication lag
+        """
+        self._histogram(collection, 'apply').record(latency_seconds)
+        if cluster_time is not None:
+            now = time.time()
+            self._histogram(collection, 'replication_lag').record(now - cluster_time.time)
+            self.last_applied[collection] = (cluster_time.time, now)
             
-        if operation_type not in self.metrics['operations'][collection]:
-            self.metrics['operations'][collection][operation_type] = 0
+    def replication_lag(self, collection, source_optime=None):
+        """
+        Lag of a collection measured from its last acknowledged event
+        
+        Returns:
+        --------
+        tuple
+            (seconds between the event's clusterTime and its acknowledgement,
+            seconds between that clusterTime and the source's latest optime),
+            with None where the value is not known
+        """
+        applied = self.last_applied.get(collection)
+        if not applied:
+            return None, None
             
-        self.metrics['operations'][collection][operation_type] += 1
+        cluster_seconds, acknowledged_at = applied
+        optime_lag = max(0, source_optime.time - cluster_seconds) if source_optime is not None else None
+        return acknowledged_at - cluster_seconds, optime_lag
         
-        # Update collection status
+    def record_lag(self, collection, lag_seconds, optime_lag_seconds, catch_up):
+        """Record the lag of a collection and whether it is in catch-up mode"""
         if collection not in self.metrics['status']['collections']:
             self.metrics['status']['collections'][collection] = {}
             
-        self.metrics['status']['collections'][collection]['last_operation'] = {
-            'type': operation_type,
+        self.metrics['status']['collections'][collection]['lag'] = {
+            'lag_seconds': lag_seconds,
+            'optime_lag_seconds': optime_lag_seconds,
+            'catch_up': catch_up,
             'timestamp': datetime.datetime.utcnow()
         }
         
-    def record_error(self, collection, error_type, message):
-        """Record an error in the metrics"""
-        error_record = {
+    def catch_up_active(self):
+        """True while any collection is in catch-up mode"""
+        return any(status.get('lag', {}).get('catch_up') for status in self._collection_statuses())
+        
+    def capture_queue_depths(self):
+        """Stream key (collection, or "database:<name>") -> events waiting in its capture queue"""
+        return {
+            name: status['capture_queue']['depth']
+            for name, status in list(self.metrics['status']['collections'].items())
+            if 'capture_queue' in status
+        }
+        
+    def record_stage(self, collection, stage, seconds):
+        """Record the time one event spent in a pipeline stage (fetch, queue, filter, transform, submit)"""
+        histogram = self.stages.get((collection, stage))
+        if histogram is None:
+            histogram = self.stages.setdefault((collection, stage), Histogram())
+        histogram.record(seconds)
+        
+    def record_pool_event(self, pool, event):
+        """Count a connection pool event (created, closed, checked_in, checkout_failed, cleared)"""
+        self.pool_events.increment((pool, event))
+        
+    def record_pool_checkout(self, pool, wait_seconds):
+        """Record a connection checkout and how long it waited for a connection"""
+        self.pool_events.increment((pool, 'checked_out'))
+        histogram = self.pool_checkout.get(pool)
+        if histogram is None:
+            histogram = self.pool_checkout.setdefault(pool, Histogram())
+        histogram.record(wait_seconds)
+        
+    def _histogram(self, collection, name):
+        histogram = self.latency.get((collection, name))
+        if histogram is None:
+            histogram = self.latency.setdefault((collection, name), Histogram())
+        return histogram
+        
+    def snapshot(self):
+        """
+        Aggregate all metrics into one nested dict
+        
+        This is where counters are summed, histograms summarised and
+        timestamps converted, so the recording side stays cheap.
+        """
+        operations = {}
+        for (collection, operation_type), count in self.operations.snapshot().items():
+            operations.setdefault(collection, {})[operation_type] = count
+            
+        error_counts = {}
+        for (collection, error_type), count in self.error_counts.snapshot().items():
+            error_counts.setdefault(collection, {})[error_type] = count
+            
+        errors = [{
             'collection': collection,
             'error_type': error_type,
             'message': message,
-            'timestamp': datetime.datetime.utcnow()
+            'timestamp': datetime.datetime.utcfromtimestamp(timestamp)
+        } for collection, error_type, message, timestamp in self.errors.snapshot()]
+        
+        latency = {}
+        for (collection, name), histogram in list(self.latency.items()):
+            latency.setdefault(collection, {})[name] = histogram.snapshot()
+            
+        stages = {}
+        for (collection, stage), histogram in list(self.stages.items()):
+            stages.setdefault(collection, {})[stage] = histogram.snapshot(Histogram.STAGE_BOUNDS_MS)
+            
+        pools = {}
+        for (pool, event), count in self.pool_events.snapshot().items():
+            pools.setdefault(pool, {})[event] = count
+        for pool, counts in pools.items():
+            counts['open'] = counts.get('created', 0) - counts.get('closed', 0)
+            counts['in_use'] = counts.get('checked_out', 0) - counts.get('checked_in', 0)
+            if pool in self.pool_checkout:
+                counts['checkout_wait'] = self.pool_checkout[pool].snapshot()
+                
+        coalescing = {}
+        for (collection, name), count in self.coalescing.snapshot().items():
+            coalescing.setdefault(collection, {})[name] = count
+        for counts in coalescing.values():
+            # Events per target write; 1.0 means nothing was merged
+            counts['ratio'] = counts.get('events', 0) / counts['writes'] if counts.get('writes') else None
+            
+        collections = {name: dict(status) for name, status in list(self.metrics['status']['collections'].items())}
+        for collection, (operation_type, timestamp) in list(self.last_operations.items()):
+            collections.setdefault(collection, {})['last_operation'] = {
+                'type': operation_type,
+                'timestamp': datetime.datetime.utcfromtimestamp(timestamp)
+            }
+        for collection, (error_type, message, timestamp) in list(self.last_errors.items()):
+            collections.setdefault(collection, {})['last_error'] = {
+                'type': error_type,
+                'message': message,
+                'timestamp': datetime.datetime.utcfromtimestamp(timestamp)
+            }
+            
+        snapshot = {
+            'operations': operations,
+            'errors': errors,
+            'error_counts': error_counts,
+            'latency': latency,
+            'stages': stages,
+            'pools': pools,
+            'coalescing': coalescing,
+            'initial_sync': {name: dict(partitions) for name, partitions in list(self.metrics['initial_sync'].items())},
+            'retention': dict(self.metrics['retention']),
+            'spill': dict(self.metrics['spill']),
+            'workers': {worker: dict(state) for worker, state in list(self.metrics['workers'].items())},
+            'status': {
+                'start_time': self.metrics['status']['start_time'],
+                'collections': collections
+            }
         }
+        if self.worker_snapshots:
+            self._merge_worker_snapshots(snapshot)
+        return snapshot
+        
+    def _merge_worker_snapshots(self, snapshot):
+        """
+        Fold worker snapshots into this process's snapshot
+        
+        Every collection is replicated by one worker, so per-collection
+        sections are combined by collection; errors are interleaved by time
+        and spill queues, one per worker, are added up.
+        """
+        spills = [snapshot['spill']] if snapshot['spill'] else []
+        for worker, worker_snapshot in sorted(self.worker_snapshots.items()):
+            for section in ('operations', 'error_counts', 'latency', 'stages', 'pools', 'coalescing', 'initial_sync',
+                            'retention'):
+                snapshot[section].update(worker_snapshot[section])
+            snapshot['status']['collections'].update(worker_snapshot['status']['collections'])
+            snapshot['errors'].extend(worker_snapshot['errors'])
+            if worker_snapshot['spill']:
+                spills.append(worker_snapshot['spill'])
+                
+        snapshot['errors'].sort(key=lambda error: error['timestamp'])
+        del snapshot['errors'][:-self.config.get('error_buffer_size', 1000)]
         
-        self.metrics['errors'].append(error_record)
+        if spills:
+            ages = [spill['oldest_age_seconds'] for spill in spills if spill['oldest_age_seconds'] is not None]
+            snapshot['spill'] = {
+                'pending': sum(spill['pending'] for spill in spills),
+                'size_bytes': sum(spill['size_bytes'] for spill in spills),
+                'oldest_age_seconds': max(ages) if ages else None,
+                'drained_per_second': sum(spill['drained_per_second'] for spill in spills)
+            }
+            
+    def record_coalescing(self, collection, events, writes):
+        """Record a flushed batch: events submitted, and writes left after coalescing"""
+        self.coalescing.increment((collection, 'events'), events)
+        self.coalescing.increment((collection, 'writes'), writes)
         
-        # Keep only recent errors (30 days)
-        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=30)
-        self.metrics['errors'] = [e for e in self.metrics['errors'] if e['timestamp'] > cutoff]
+    def record_checkpoint(self, collection, cluster_time):
+        """Record how far the persisted change stream checkpoint has advanced"""
+        checkpoint_time = datetime.datetime.utcfromtimestamp(cluster_time.time)
+        now = datetime.datetime.utcnow()
         
-        # Update collection status
         if collection not in self.metrics['status']['collections']:
             self.metrics['status']['collections'][collection] = {}
             
-        self.metrics['status']['collections'][collection]['last_error'] = {
-            'type': error_type,
-            'message': message,
+        self.metrics['status']['collections'][collection]['checkpoint'] = {
+            'cluster_time': checkpoint_time,
+            'lag_seconds': (now - checkpoint_time).total_seconds(),
+            'timestamp': now
+        }
+        
+    def checkpoint_lag(self, collection):
+        """Seconds between now and the source time covered by the checkpoint"""
+        return _checkpoint_lag(self.metrics['status']['collections'].get(collection, {}))
+        
+    def record_queue(self, collection, depth, wait_seconds, avg_wait_seconds):
+        """Record capture queue depth and how long the last event waited in it"""
+        if collection not in self.metrics['status']['collections']:
+            self.metrics['status']['collections'][collection] = {}
+            
+        self.metrics['status']['collections'][collection]['capture_queue'] = {
+            'depth': depth,
+            'last_wait_ms': wait_seconds * 1000.0,
+            'avg_wait_ms': avg_wait_seconds * 1000.0
+        }
+        
+    def record_retention_progress(self, side, collection, deleted, docs_per_second, complete):
+        """Record progress and throughput of a retention purge"""
+        self.metrics['retention'][f"{side}:{collection}"] = {
+            'deleted': deleted,
+            'docs_per_second': docs_per_second,
+            'complete': complete,
+            'timestamp': datetime.datetime.utcnow()
+        }
+        
+    def record_spill(self, pending, size_bytes, oldest_age_seconds, drained_per_second):
+        """Record the size of the spill queue and how fast it drains"""
+        self.metrics['spill'] = {
+            'pending': pending,
+            'size_bytes': size_bytes,
+            'oldest_age_seconds': oldest_age_seconds,
+            'drained_per_second': drained_per_second
+        }
+        
+    def max_replication_lag(self):
+        """
+        Largest checkpoint lag, in seconds, of all collections
+        
+        Measured now rather than when the checkpoint last advanced, so a
+        lag spike does not linger once a collection goes quiet; quiet
+        streams keep their checkpoint current with idle advances.
+        """
+        lags = [_checkpoint_lag(status) for status in self._collection_statuses() if 'checkpoint' in status]
+        return max(lags) if lags else None
+        
+    def record_worker(self, worker, pid, alive, restarts, collections):
+        """Record the state of a replication worker process"""
+        self.metrics['workers'][worker] = {
+            'pid': pid,
+            'alive': alive,
+            'restarts': restarts,
+            'collections': collections,
+            'timestamp': datetime.datetime.utcnow()
+        }
+        
+    def merge_worker(self, worker, snapshot):
+        """Keep the latest snapshot() of a worker process for merging"""
+        self.worker_snapshots[worker] = snapshot
+        
+    def _collection_statuses(self):
+        """Status dicts of all collections, including those of worker processes"""
+        statuses = list(self.metrics['status']['collections'].values())
+        for snapshot in list(self.worker_snapshots.values()):
+            statuses.extend(snapshot['status']['collections'].values())
+        return statuses
+        
+    def record_sync_progress(self, collection, partition, copied, done):
+        """Record initial sync progress of one collection partition"""
+        if collection not in self.metrics['initial_sync']:
+            self.metrics['initial_sync'][collection] = {}
+            
+        self.metrics['initial_sync'][collection][str(partition)] = {
+            'copied': copied,
+            'done': done,
             'timestamp': datetime.datetime.utcnow()
         }
 
@@ -103,29 +448,122 @@ class MonitoringRequestHandler(BaseHTTPRequestHandler):
         
     def do_GET(self):
         """Handle GET requests for monitoring data"""
-        if self.path == '/metrics':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
+        status, content_type, body, etag = self.monitoring_service.renderer.respond(
+            self.path,
+            self.headers.get('If-None-Match')
+        )
+        
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def log_message(self, format, *args):
+        # Scrapes are frequent; keep them out of the application log
+        self.monitoring_service.logger.debug(format % args)
+
+
+class MonitoringRenderer:
+    def __init__(self, monitoring_service, cache_ttl=1.0):
+        """
+        Render monitoring responses independently of the HTTP server
+        
+        Parameters:
+        -----------
+        monitoring_service : MonitoringService
+            Service whose metrics are rendered
+        cache_ttl : float
+            Seconds a metrics snapshot and the responses rendered from it
+            are reused
+        """
+        self.monitoring_service = monitoring_service
+        self.cache_ttl = cache_ttl
+        self._cache = {}  # Path -> (expires at, status, content type, body, etag)
+        self._lock = threading.Lock()
+        
+    def respond(self, path, if_none_match=None):
+        """
+        Cached response for a request path, honouring If-None-Match
+        
+        Returns:
+        --------
+        tuple
+            (HTTP status, content type or None, body bytes, ETag or None)
+        """
+        path, _, query = path.partition('?')
+        if path.startswith('/debug/'):
+            # Never cached, and not rendered under the lock: a profile runs
+            # for seconds
+            status, content_type, body = self.render_debug(path, urllib.parse.parse_qs(query))
+            return status, content_type, body, None
+            
+        now = time.monotonic()
+        
+        # Rendering under the lock lets concurrent requests share one render
+        with self._lock:
+            cached = self._cache.get(path)
+            if not cached or cached[0] <= now:
+                status, content_type, body = self.render(path)
+                etag = f'"{hashlib.sha1(body).hexdigest()}"' if status == 200 else None
+                cached = self._cache[path] = (now + self.cache_ttl, status, content_type, body, etag)
+                
+        _, status, content_type, body, etag = cached
+        if etag and if_none_match == etag:
+            return 304, None, b'', etag
+        return status, content_type, body, etag
+        
+    def render(self, path):
+        """
+        Render the response for a request path
+        
+        Returns:
+        --------
+        tuple
+            (HTTP status, content type or None, body bytes)
+        """
+        if path == '/metrics/prometheus':
+            text = self._generate_prometheus_text(self.monitoring_service.snapshot())
+            return 200, 'text/plain; version=0.0.4; charset=utf-8', text.encode()
             
+        elif path == '/metrics':
             # Convert datetime objects to strings for JSON serialization
-            metrics_copy = self._prepare_metrics_for_json(self.monitoring_service.metrics)
+            metrics_copy = self._prepare_metrics_for_json(self.monitoring_service.snapshot())
             
-            self.wfile.write(json.dumps(metrics_copy).encode())
+            return 200, 'application/json', json.dumps(metrics_copy).encode()
             
-        elif self.path == '/':
+        elif path == '/':
             # Serve a simple HTML dashboard
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            
             html = self._generate_dashboard_html()
-            self.wfile.write(html.encode())
+            return 200, 'text/html', html.encode()
             
-        else:
-            self.send_response(404)
-            self.end_headers()
+        return 404, None, b''
+        
+    def render_debug(self, path, query):
+        """
+        Render a /debug/ endpoint
+        
+        /debug/profile?seconds=N samples the replication threads for N
+        seconds (default 10) and returns collapsed stacks; threads=PREFIX
+        selects other threads than the configured prefix.
+        """
+        profiler = self.monitoring_service.profiler
+        if path != '/debug/profile' or profiler is None:
+            return 404, None, b''
             
+        try:
+            seconds = float(query.get('seconds', ['10'])[0])
+            stacks = profiler.profile(seconds, query.get('threads', [None])[0])
+        except ValueError as e:
+            return 400, 'text/plain; charset=utf-8', f"{str(e)}\n".encode()
+        except RuntimeError as e:
+            return 409, 'text/plain; charset=utf-8', f"{str(e)}\n".encode()
+            
+        return 200, 'text/plain; charset=utf-8', stacks.encode()
+        
     def _prepare_metrics_for_json(self, metrics):
         """Prepare metrics for JSON serialization by converting datetime objects to strings"""
         if isinstance(metrics, dict):
@@ -144,7 +582,7 @@ class MonitoringRequestHandler(BaseHTTPRequestHandler):
         """Generate a simple HTML dashboard for monitoring"""
         # This would be a more comprehensive HTML in a real implementation
         # Just a simple example here
-        metrics = self._prepare_metrics_for_json(self.monitoring_service.metrics)
+        metrics = self._prepare_metrics_for_json(self.monitoring_service.snapshot())
         
         html = """
         <!DOCTYPE html>
@@ -152,13 +590,14 @@ class MonitoringRequestHandler(BaseHTTPRequestHandler):
         <head>
             <title>MinervaDB Iris Monitoring</title>
             <style>
-                body { font-family: Arial, sans-serif; margin: 20px; }
-                h1 { color: #2c3e50; }
-                .card { background: #f8f9fa; border-radius: 5px; padding: 15px; margin-bottom: 20px; }
-                table { border-collapse: collapse; width: 100%; }
-                th, td { text-align: left; padding: 8px; border-bottom: 1px solid #ddd; }
-                th { background-color: #f2f2f2; }
-                .error { color: red; }
+                body {{ font-family: Arial, sans-serif; margin: 20px; }}
+                h1 {{ color: #2c3e50; }}
+                .card {{ background: #f8f9fa; border-radius: 5px; padding: 15px; margin-bottom: 20px; }}
+                table {{ border-collapse: collapse; width: 100%; }}
+                th, td {{ text-align: left; padding: 8px; border-bottom: 1px solid #ddd; }}
+                th {{ background-color: #f2f2f2; }}
+                .error {{ color: red; }}
+                .lagging {{ color: #d35400; font-weight: bold; }}
             </style>
         </head>
         <body>
@@ -175,6 +614,9 @@ class MonitoringRequestHandler(BaseHTTPRequestHandler):
                 <table>
                     <tr>
                         <th>Collection</th>
+                        <th>Lag</th>
+                        <th>Behind Source</th>
+                        <th>Mode</th>
                         <th>Last Operation</th>
                         <th>Last Error</th>
                     </tr>
@@ -197,9 +639,9 @@ class MonitoringRequestHandler(BaseHTTPRequestHandler):
             
             <script>
                 // Refresh the page every 30 seconds
-                setTimeout(function() {
+                setTimeout(function() {{
                     location.reload();
-                }, 30000);
+                }}, 30000);
             </script>
         </body>
         </html>
@@ -215,6 +657,12 @@ class MonitoringRequestHandler(BaseHTTPRequestHandler):
         for collection, status in metrics['status'].get('collections', {}).items():
             last_op = status.get('last_operation', {})
             last_error = status.get('last_error', {})
+            lag = status.get('lag', {})
+            
+            lag_str = f"{lag['lag_seconds']:.1f} s" if lag.get('lag_seconds') is not None else "N/A"
+            optime_lag_str = f"{lag['optime_lag_seconds']:.1f} s" if lag.get('optime_lag_seconds') is not None else "N/A"
+            mode_str = "catch-up" if lag.get('catch_up') else "normal"
+            mode_class = "lagging" if lag.get('catch_up') else ""
             
             last_op_str = f"{last_op.get('type', 'N/A')} at {last_op.get('timestamp', 'N/A')}" if last_op else "N/A"
             last_error_str = f"{last_error.get('type', 'N/A')} at {last_error.get('timestamp', 'N/A')}: {last_error.get('message', '')}" if last_error else "None"
@@ -222,6 +670,9 @@ class MonitoringRequestHandler(BaseHTTPRequestHandler):
             collection_rows += f"""
             <tr>
                 <td>{collection}</td>
+                <td>{lag_str}</td>
+                <td>{optime_lag_str}</td>
+                <td class="{mode_class}">{mode_str}</td>
                 <td>{last_op_str}</td>
                 <td class="error">{last_error_str}</td>
             </tr>
@@ -245,3 +696,179 @@ class MonitoringRequestHandler(BaseHTTPRequestHandler):
             collection_rows=collection_rows,
             error_rows=error_rows
         )
+        
+    def _generate_prometheus_text(self, metrics):
+        """Render a snapshot in the Prometheus text exposition format"""
+        lines = []
+        
+        def family(name, metric_type, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            
+        def sample(name, labels, value):
+            label_text = ','.join(f'{key}="{_escape_label(label)}"' for key, label in labels.items())
+            if label_text:
+                lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+            else:
+                lines.append(f"{name} {_format_value(value)}")
+                
+        now = datetime.datetime.utcnow()
+        collections = metrics['status']['collections']
+        
+        family('iris_start_time_seconds', 'gauge', 'Start time of the process since the epoch')
+        sample('iris_start_time_seconds', {}, metrics['status']['start_time'].replace(tzinfo=datetime.timezone.utc).timestamp())
+        
+        family('iris_operations_total', 'counter', 'Change events received')
+        for collection, counts in metrics['operations'].items():
+            for operation_type, count in counts.items():
+                sample('iris_operations_total', {'collection': collection, 'operation_type': operation_type}, count)
+                
+        family('iris_errors_total', 'counter', 'Errors recorded')
+        for collection, counts in metrics['error_counts'].items():
+            for error_type, count in counts.items():
+                sample('iris_errors_total', {'collection': collection, 'error_type': error_type}, count)
+                
+        family('iris_checkpoint_lag_seconds', 'gauge', 'Source time between now and the persisted checkpoint')
+        for collection, status in collections.items():
+            if 'checkpoint' in status:
+                lag = (now - status['checkpoint']['cluster_time']).total_seconds()
+                sample('iris_checkpoint_lag_seconds', {'collection': collection}, lag)
+                
+        family('iris_lag_seconds', 'gauge', 'Lag of the last acknowledged event behind its source clusterTime')
+        for collection, status in collections.items():
+            if status.get('lag', {}).get('lag_seconds') is not None:
+                sample('iris_lag_seconds', {'collection': collection}, status['lag']['lag_seconds'])
+                
+        family('iris_optime_lag_seconds', 'gauge', 'Source optime ahead of the last acknowledged event')
+        for collection, status in collections.items():
+            if status.get('lag', {}).get('optime_lag_seconds') is not None:
+                sample('iris_optime_lag_seconds', {'collection': collection}, status['lag']['optime_lag_seconds'])
+                
+        family('iris_catch_up', 'gauge', '1 while a collection is in catch-up mode')
+        for collection, status in collections.items():
+            if 'lag' in status:
+                sample('iris_catch_up', {'collection': collection}, status['lag']['catch_up'])
+                
+        family('iris_capture_queue_depth', 'gauge', 'Events waiting between capture and apply')
+        for collection, status in collections.items():
+            if 'capture_queue' in status:
+                sample('iris_capture_queue_depth', {'collection': collection}, status['capture_queue']['depth'])
+                
+        family('iris_capture_queue_wait_seconds', 'gauge', 'Moving average of the time events wait in the capture queue')
+        for collection, status in collections.items():
+            if 'capture_queue' in status:
+                sample('iris_capture_queue_wait_seconds', {'collection': collection},
+                       status['capture_queue']['avg_wait_ms'] / 1000.0)
+                       
+        for name, key, help_text in (
+            ('iris_apply_latency_seconds', 'apply', 'Time from submitting an operation to target acknowledgement'),
+            ('iris_replication_lag_seconds', 'replication_lag', 'Time from the source clusterTime to target acknowledgement')
+        ):
+            family(name, 'histogram', help_text)
+            for collection, histograms in metrics['latency'].items():
+                histogram = histograms.get(key)
+                if not histogram:
+                    continue
+                for bound_ms, count in histogram['buckets']:
+                    sample(f"{name}_bucket", {'collection': collection, 'le': _format_value(bound_ms / 1000.0)}, count)
+                sample(f"{name}_bucket", {'collection': collection, 'le': '+Inf'}, histogram['count'])
+                sample(f"{name}_sum", {'collection': collection}, histogram['sum_ms'] / 1000.0)
+                sample(f"{name}_count", {'collection': collection}, histogram['count'])
+                
+        family('iris_stage_duration_seconds', 'histogram', 'Time an event spends in each pipeline stage')
+        for collection, stages in metrics['stages'].items():
+            for stage, histogram in stages.items():
+                labels = {'collection': collection, 'stage': stage}
+                for bound_ms, count in histogram['buckets']:
+                    sample('iris_stage_duration_seconds_bucket', dict(labels, le=_format_value(bound_ms / 1000.0)), count)
+                sample('iris_stage_duration_seconds_bucket', dict(labels, le='+Inf'), histogram['count'])
+                sample('iris_stage_duration_seconds_sum', labels, histogram['sum_ms'] / 1000.0)
+                sample('iris_stage_duration_seconds_count', labels, histogram['count'])
+                
+        family('iris_retention_deleted_documents', 'gauge', 'Documents deleted by the current or last purge pass')
+        for key, progress in metrics['retention'].items():
+            side, _, collection = key.partition(':')
+            sample('iris_retention_deleted_documents', {'side': side, 'collection': collection}, progress['deleted'])
+            
+        family('iris_retention_docs_per_second', 'gauge', 'Delete throughput of the current or last purge pass')
+        for key, progress in metrics['retention'].items():
+            side, _, collection = key.partition(':')
+            sample('iris_retention_docs_per_second', {'side': side, 'collection': collection}, progress['docs_per_second'])
+            
+        if metrics['coalescing']:
+            family('iris_coalesce_events_total', 'counter', 'Operations submitted to batches with coalescing enabled')
+            for collection, counts in metrics['coalescing'].items():
+                sample('iris_coalesce_events_total', {'collection': collection}, counts.get('events', 0))
+            family('iris_coalesce_writes_total', 'counter', 'Target writes left after coalescing same-document operations')
+            for collection, counts in metrics['coalescing'].items():
+                sample('iris_coalesce_writes_total', {'collection': collection}, counts.get('writes', 0))
+                
+        spill = metrics['spill']
+        if spill:
+            family('iris_spill_pending_operations', 'gauge', 'Operations spilled to disk and not yet replayed')
+            sample('iris_spill_pending_operations', {}, spill['pending'])
+            family('iris_spill_size_bytes', 'gauge', 'Size of the spilled operations not yet replayed')
+            sample('iris_spill_size_bytes', {}, spill['size_bytes'])
+            if spill['oldest_age_seconds'] is not None:
+                family('iris_spill_oldest_age_seconds', 'gauge', 'Age of the oldest spilled operation')
+                sample('iris_spill_oldest_age_seconds', {}, spill['oldest_age_seconds'])
+            family('iris_spill_drain_rate', 'gauge', 'Spilled operations replayed per second in the last drain batch')
+            sample('iris_spill_drain_rate', {}, spill['drained_per_second'])
+            
+        family('iris_pool_connections', 'gauge', 'Open connections of a client pool')
+        for pool, counts in metrics['pools'].items():
+            sample('iris_pool_connections', {'pool': pool}, counts['open'])
+            
+        family('iris_pool_connections_in_use', 'gauge', 'Connections of a client pool checked out by operations')
+        for pool, counts in metrics['pools'].items():
+            sample('iris_pool_connections_in_use', {'pool': pool}, counts['in_use'])
+            
+        family('iris_pool_checkout_failures_total', 'counter', 'Connection checkouts that failed or timed out')
+        for pool, counts in metrics['pools'].items():
+            sample('iris_pool_checkout_failures_total', {'pool': pool}, counts.get('checkout_failed', 0))
+            
+        family('iris_pool_checkout_wait_seconds', 'histogram', 'Time operations waited to check out a connection')
+        for pool, counts in metrics['pools'].items():
+            histogram = counts.get('checkout_wait')
+            if not histogram:
+                continue
+            for bound_ms, count in histogram['buckets']:
+                sample('iris_pool_checkout_wait_seconds_bucket', {'pool': pool, 'le': _format_value(bound_ms / 1000.0)}, count)
+            sample('iris_pool_checkout_wait_seconds_bucket', {'pool': pool, 'le': '+Inf'}, histogram['count'])
+            sample('iris_pool_checkout_wait_seconds_sum', {'pool': pool}, histogram['sum_ms'] / 1000.0)
+            sample('iris_pool_checkout_wait_seconds_count', {'pool': pool}, histogram['count'])
+            
+        if metrics['workers']:
+            family('iris_worker_up', 'gauge', '1 while a replication worker process is running')
+            for worker, state in metrics['workers'].items():
+                sample('iris_worker_up', {'worker': worker}, state['alive'])
+            family('iris_worker_restarts_total', 'counter', 'Restarts of a replication worker process')
+            for worker, state in metrics['workers'].items():
+                sample('iris_worker_restarts_total', {'worker': worker}, state['restarts'])
+                
+        family('iris_initial_sync_copied_documents', 'gauge', 'Documents copied by the initial sync')
+        for collection, partitions in metrics['initial_sync'].items():
+            copied = sum(partition['copied'] for partition in partitions.values())
+            sample('iris_initial_sync_copied_documents', {'collection': collection}, copied)
+            
+        return '\n'.join(lines) + '\n'
+
+
+def _checkpoint_lag(status):
+    """Seconds between now and the source time covered by a collection's checkpoint"""
+    checkpoint = status.get('checkpoint')
+    if not checkpoint:
+        return None
+    return (datetime.datetime.utcnow() - checkpoint['cluster_time']).total_seconds()
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -1,5 +1,9 @@
 class OperationFilter:
-    def __init__(self, excluded_operations=None):
+    # Event fields the listener, checkpointing and applier rely on; these are
+    # never projected away
+    REQUIRED_FIELDS = ('_id', 'operationType', 'ns', 'documentKey', 'clusterTime')
+    
+    def __init__(self, excluded_operations=None, excluded_fields=None, pushdown=True):
         """
         Initialize the operation filter
         
@@ -7,8 +11,37 @@ class OperationFilter:
         -----------
         excluded_operations : list
             List of operation types to exclude (e.g., ["delete"])
+        excluded_fields : list
+            Change event fields to drop on the server (e.g., ["lsid", "txnNumber"])
+        pushdown : bool
+            Compile the filter into change stream stages so excluded events
+            never leave the source
         """
         self.excluded_operations = excluded_operations or []
+        self.excluded_fields = [f for f in (excluded_fields or []) if f not in self.REQUIRED_FIELDS]
+        self.pushdown = pushdown
+        
+    def pipeline(self):
+        """
+        Compile the filter into change stream aggregation stages
+        
+        Returns:
+        --------
+        list
+            $match / $project stages for watch(pipeline=...); empty when
+            pushdown is disabled
+        """
+        if not self.pushdown:
+            return []
+            
+        stages = []
+        if self.excluded_operations:
+            stages.append({'$match': {'operationType': {'$nin': list(self.excluded_operations)}}})
+            
+        if self.excluded_fields:
+            stages.append({'$project': {field: 0 for field in self.excluded_fields}})
+            
+        return stages
         
     def should_process(self, change_event):
         """
@@ -26,7 +59,9 @@ class OperationFilter:
         """
         operation_type = change_event['operationType']
         
-        # Check if operation type is in exclusion list
+        # Check if operation type is in exclusion list; this also runs when
+        # the same check was pushed down, as a fallback for streams opened
+        # without the compiled stages
         if operation_type in self.excluded_operations:
             return False
             
@@ -1,11 +1,42 @@
-import copy
 import datetime
+import bson
+from bson.raw_bson import RawBSONDocument
+
+METADATA_FIELD = '_minervadb_iris_metadata'
 
 class OperationTransformer:
-    def __init__(self):
-        """Initialize the operation transformer"""
-        pass
+    def __init__(self, config=None):
+        """
+        Initialize the operation transformer
+        
+        The configured field transformations are compiled once into a list of
+        steps. Events are never deep-copied: each step copies only the
+        dictionaries on the path it changes, so the original event and any
+        untouched sub-documents are shared with the result.
+        
+        Events read with a RawBSONDocument codec (replication.raw_documents)
+        keep their fullDocument as raw bytes: the metadata is appended to the
+        bytes and the result goes to the target without being decoded. Only
+        when field transformations are configured is the document decoded.
+        
+        Parameters:
+        -----------
+        config : dict
+            Transform configuration (replication.transform) with optional
+            rename (old path -> new path), redact and drop (lists of paths)
+            and redacted_value
+        """
+        config = config or {}
+        redacted_value = config.get('redacted_value', '[REDACTED]')
         
+        self.steps = []
+        for source, destination in (config.get('rename') or {}).items():
+            self.steps.append(_Rename(source, destination))
+        for path in config.get('redact') or []:
+            self.steps.append(_Redact(path, redacted_value))
+        for path in config.get('drop') or []:
+            self.steps.append(_Drop(path))
+            
     def transform(self, change_event):
         """
         Transform a change event before applying to target
@@ -20,15 +51,184 @@ class OperationTransformer:
         dict
             Transformed operation
         """
-        # Create a deep copy to avoid modifying the original event
-        transformed = copy.deepcopy(change_event)
-        
-        # Add metadata about the replication
-        if 'fullDocument' in transformed and transformed['fullDocument']:
-            transformed['fullDocument']['_minervadb_iris_metadata'] = {
-                'replicated_at': datetime.datetime.utcnow(),
-                'source_operation_type': transformed['operationType'],
-                'source_timestamp': transformed.get('clusterTime')
-            }
+        # Shallow overlay; the original event is left untouched
+        transformed = dict(change_event)
+        
+        # Metadata about the replication
+        metadata = {
+            'replicated_at': datetime.datetime.utcnow(),
+            'source_operation_type': change_event['operationType'],
+            'source_timestamp': change_event.get('clusterTime')
+        }
+        
+        document = change_event.get('fullDocument')
+        if isinstance(document, RawBSONDocument) and not self.steps:
+            transformed['fullDocument'] = _append_field(document, METADATA_FIELD, metadata)
+        elif document:
+            document = dict(_decoded(document))
+            for step in self.steps:
+                step.apply(document)
+            document[METADATA_FIELD] = metadata
+            transformed['fullDocument'] = document
+            
+        # Updates applied as a delta carry the metadata in their $set
+        description = change_event.get('updateDescription')
+        if description:
+            # Deltas are small; decoding a raw one in one go is cheaper than
+            # walking it through the RawBSONDocument mapping interface
+            description = dict(_decoded(description))
+            updated_fields = dict(description.get('updatedFields') or {})
+            removed_fields = list(description.get('removedFields') or [])
+            for step in self.steps:
+                step.apply_update(updated_fields, removed_fields)
+            updated_fields[METADATA_FIELD] = metadata
+            description['updatedFields'] = updated_fields
+            description['removedFields'] = removed_fields
+            transformed['updateDescription'] = description
             
         return transformed
+
+
+def _append_field(document, name, value):
+    """
+    Append a field to a RawBSONDocument without decoding it
+    
+    The field is not looked for first, which would mean scanning the
+    document; source documents are not expected to carry Iris metadata.
+    """
+    raw = document.raw
+    element = b'\x03' + name.encode() + b'\x00' + bson.encode(value)
+    length = len(raw) + len(element)
+    return RawBSONDocument(length.to_bytes(4, 'little') + raw[4:-1] + element + b'\x00')
+
+
+def _decoded(document):
+    """A RawBSONDocument decoded to nested dicts; other values unchanged"""
+    if isinstance(document, RawBSONDocument):
+        return bson.decode(document.raw)
+    return document
+
+
+def _parent(document, parts, create=False):
+    """
+    Return the dict holding parts[-1], copying every dict on the way
+    
+    Returns None when the path does not exist and create is False.
+    """
+    parent = document
+    for key in parts[:-1]:
+        child = parent.get(key)
+        if not isinstance(child, dict):
+            if not create:
+                return None
+            child = {}
+        else:
+            child = dict(child)
+        parent[key] = child
+        parent = child
+    return parent
+
+
+class _FieldStep:
+    """A transformation of one (dotted) field path"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.parts = path.split('.')
+        
+    def apply(self, document):
+        """Apply the step to a document whose top level the caller owns"""
+        self._apply_at(document, self.parts)
+        
+    def apply_update(self, updated_fields, removed_fields):
+        """
+        Apply the step to an update description
+        
+        updatedFields is keyed by dotted paths, so a key may name the field
+        itself, something below it, or a sub-document that contains it.
+        """
+        for key in list(updated_fields):
+            if key == self.path or key.startswith(self.path + '.'):
+                self._update_at_or_below(updated_fields, key)
+            elif self.path.startswith(key + '.') and isinstance(updated_fields[key], dict):
+                self._update_containing(updated_fields, key)
+                
+    def _update_containing(self, updated_fields, key):
+        value = dict(updated_fields[key])
+        self._apply_at(value, self.parts[len(key.split('.')):])
+        updated_fields[key] = value
+        
+    def _apply_at(self, document, parts):
+        raise NotImplementedError
+        
+    def _update_at_or_below(self, updated_fields, key):
+        raise NotImplementedError
+
+
+class _Rename(_FieldStep):
+    def __init__(self, path, destination):
+        super().__init__(path)
+        self.destination = destination
+        self.destination_parts = destination.split('.')
+        
+    def _apply_at(self, document, parts):
+        parent = _parent(document, parts)
+        if parent is None or parts[-1] not in parent:
+            return
+        value = parent.pop(parts[-1])
+        _parent(document, self.destination_parts, create=True)[self.destination_parts[-1]] = value
+        
+    def apply_update(self, updated_fields, removed_fields):
+        super().apply_update(updated_fields, removed_fields)
+        for index, key in enumerate(removed_fields):
+            if key == self.path or key.startswith(self.path + '.'):
+                removed_fields[index] = self.destination + key[len(self.path):]
+                
+    def _update_at_or_below(self, updated_fields, key):
+        updated_fields[self.destination + key[len(self.path):]] = updated_fields.pop(key)
+        
+    def _update_containing(self, updated_fields, key):
+        depth = len(key.split('.'))
+        value = dict(updated_fields[key])
+        parent = _parent(value, self.parts[depth:])
+        if parent is None or self.parts[-1] not in parent:
+            return
+        moved = parent.pop(self.parts[-1])
+        updated_fields[key] = value
+        
+        # The destination either lives in the same sub-document or becomes
+        # its own updated path
+        if self.destination.startswith(key + '.'):
+            destination_parts = self.destination_parts[depth:]
+            _parent(value, destination_parts, create=True)[destination_parts[-1]] = moved
+        else:
+            updated_fields[self.destination] = moved
+
+
+class _Redact(_FieldStep):
+    def __init__(self, path, redacted_value):
+        super().__init__(path)
+        self.redacted_value = redacted_value
+        
+    def _apply_at(self, document, parts):
+        parent = _parent(document, parts)
+        if parent is not None and parts[-1] in parent:
+            parent[parts[-1]] = self.redacted_value
+            
+    def _update_at_or_below(self, updated_fields, key):
+        updated_fields[key] = self.redacted_value
+
+
+class _Drop(_FieldStep):
+    def _apply_at(self, document, parts):
+        parent = _parent(document, parts)
+        if parent is not None:
+            parent.pop(parts[-1], None)
+            
+    def apply_update(self, updated_fields, removed_fields):
+        super().apply_update(updated_fields, removed_fields)
+        removed_fields[:] = [key for key in removed_fields
+                             if key != self.path and not key.startswith(self.path + '.')]
+                             
+    def _update_at_or_below(self, updated_fields, key):
+        del updated_fields[key]
@@ -0,0 +1,137 @@
+import datetime
+import logging
+import re
+import threading
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+class TimePartitioner:
+    def __init__(self, target_db, collection_config):
+        """
+        Route a collection's documents to time-period bucket collections
+        
+        Documents go to <name>_YYYY_MM (or <name>_YYYY_MM_DD) based on the
+        partition field, so retention can drop whole buckets. A view using
+        $unionWith exposes the base collection and all buckets as one
+        logical collection (MongoDB 4.4+). The partition field is expected
+        to be fixed at insert time, such as a creation timestamp; a document
+        whose field later moves it to another period is not migrated.
+        
+        Parameters:
+        -----------
+        target_db : pymongo.database.Database
+            Target MongoDB database
+        collection_config : dict
+            Replication config of the collection, with a partitioning section
+            (field, granularity "month" or "day", view)
+        """
+        partitioning = collection_config['partitioning']
+        
+        self.target_db = target_db
+        self.name = collection_config['name']
+        self.field = partitioning.get('field') or self._retention_field(collection_config)
+        self.granularity = partitioning.get('granularity', 'month')
+        self.view_name = partitioning.get('view', f"{self.name}_view")
+        self.indexes = collection_config.get('indexes', [])
+        self.logger = logging.getLogger(f"iris.partitioning.{self.name}")
+        
+        if not self.field:
+            raise ValueError(f"No partition field configured for {self.name}")
+        if self.granularity not in ('month', 'day'):
+            raise ValueError(f"Unknown partition granularity for {self.name}: {self.granularity}")
+            
+        pattern = r'_(\d{4})_(\d{2})' if self.granularity == 'month' else r'_(\d{4})_(\d{2})_(\d{2})'
+        self.bucket_pattern = re.compile('^' + re.escape(self.name) + pattern + '$')
+        
+        self._lock = threading.Lock()
+        self._known_buckets = None
+        
+    @staticmethod
+    def _retention_field(collection_config):
+        """First indexed field with expireAfterSeconds, as used by retention"""
+        for index_config in collection_config.get('indexes', []):
+            if 'expireAfterSeconds' in index_config.get('options', {}):
+                return next(iter(index_config['keys']))
+        return None
+        
+    def bucket_for(self, document):
+        """
+        Name of the collection a document belongs in
+        
+        Documents without a datetime partition field stay in the base
+        collection.
+        """
+        value = document.get(self.field) if document else None
+        if not isinstance(value, datetime.datetime):
+            return self.name
+            
+        if self.granularity == 'month':
+            bucket = f"{self.name}_{value.year:04d}_{value.month:02d}"
+        else:
+            bucket = f"{self.name}_{value.year:04d}_{value.month:02d}_{value.day:02d}"
+            
+        self._ensure_bucket(bucket)
+        return bucket
+        
+    def buckets(self):
+        """Existing bucket collections, oldest first"""
+        names = self.target_db.list_collection_names(filter={'name': {'$regex': self.bucket_pattern.pattern}})
+        return sorted(names)
+        
+    def bucket_end(self, bucket):
+        """First instant after the period covered by a bucket"""
+        parts = [int(part) for part in self.bucket_pattern.match(bucket).groups()]
+        if self.granularity == 'month':
+            year, month = parts
+            return datetime.datetime(year + month // 12, month % 12 + 1, 1)
+        return datetime.datetime(*parts) + datetime.timedelta(days=1)
+        
+    def expired_buckets(self, cutoff_date):
+        """Buckets whose whole period lies before the cutoff"""
+        return [bucket for bucket in self.buckets() if self.bucket_end(bucket) <= cutoff_date]
+        
+    def drop_bucket(self, bucket):
+        """Drop an expired bucket and remove it from the view"""
+        self.target_db.drop_collection(bucket)
+        with self._lock:
+            if self._known_buckets is not None:
+                self._known_buckets.discard(bucket)
+        self.refresh_view()
+        self.logger.info(f"Dropped expired bucket {bucket}")
+        
+    def refresh_view(self):
+        """Create or update the view unioning the base collection with all buckets"""
+        pipeline = [{'$unionWith': bucket} for bucket in self.buckets()]
+        try:
+            if self.view_name in self.target_db.list_collection_names(filter={'name': self.view_name}):
+                self.target_db.command('collMod', self.view_name, viewOn=self.name, pipeline=pipeline)
+            else:
+                self.target_db.create_collection(self.view_name, viewOn=self.name, pipeline=pipeline)
+        except PyMongoError as e:
+            self.logger.error(f"Failed to refresh view {self.view_name}: {str(e)}")
+            
+    def _ensure_bucket(self, bucket):
+        """
+        Create a bucket with the collection's indexes the first time it is used
+        
+        expireAfterSeconds is left out: buckets expire as a whole through
+        drop_bucket, and a TTL index would delete their documents one by one.
+        """
+        with self._lock:
+            if self._known_buckets is None:
+                self._known_buckets = set(self.buckets())
+            if bucket in self._known_buckets:
+                return
+            self._known_buckets.add(bucket)
+            
+        try:
+            self.target_db.create_collection(bucket)
+        except CollectionInvalid:
+            pass  # Created concurrently
+            
+        for index_config in self.indexes:
+            options = {key: value for key, value in index_config.get('options', {}).items()
+                       if key != 'expireAfterSeconds'}
+            self.target_db[bucket].create_index(list(index_config['keys'].items()), **options)
+            
+        self.refresh_view()
+        self.logger.info(f"Created bucket {bucket}")
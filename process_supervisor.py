@@ -0,0 +1,289 @@
+import copy
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+
+class ProcessSupervisor:
+    def __init__(self, config, monitoring_service):
+        """
+        Run the configured collections in a pool of worker processes
+        
+        Each worker is a separate process with its own MongoClients and a
+        ReplicationController for its share of the collections, so decoding
+        and transforming events of different collections is not serialised
+        by one GIL. Collections are assigned by a stable hash of their name
+        or, with assignment "weight", largest weight first to the least
+        loaded worker.
+        
+        Workers report a metrics snapshot every metrics_interval_seconds;
+        the supervisor merges them into the parent's MonitoringService, which
+        serves the only monitoring endpoint. A worker that exits while the
+        supervisor runs is restarted after a backoff and resumes from its
+        collections' checkpoints.
+        
+        Parameters:
+        -----------
+        config : dict
+            Application configuration; replication.processes configures the pool
+        monitoring_service : MonitoringService
+            Parent service that receives the workers' metrics
+        """
+        replication_config = config['replication']
+        processes_config = replication_config.get('processes', {})
+        self.logger = logging.getLogger("iris.process_supervisor")
+        
+        # Workers resume from per-collection checkpoints in a shared store, so
+        # a collection may move to another worker when the pool changes
+        if replication_config.get('stream_mode', 'collection') != 'collection':
+            raise ValueError("replication.processes requires stream_mode 'collection'")
+        if replication_config.get('engine', 'threads') != 'threads':
+            raise ValueError("replication.processes requires the threads engine")
+        if replication_config.get('checkpoint', {}).get('backend', 'collection') != 'collection':
+            raise ValueError("replication.processes requires the collection checkpoint backend")
+            
+        self.config = config
+        self.monitoring_service = monitoring_service
+        self.metrics_interval = processes_config.get('metrics_interval_seconds', 5)
+        self.restart_backoff = processes_config.get('restart_backoff_seconds', 5)
+        self.max_restart_backoff = processes_config.get('max_restart_backoff_seconds', 300)
+        self.stop_timeout = processes_config.get('stop_timeout_seconds', 60)
+        
+        self.assignments = assign_collections(
+            replication_config['collections'],
+            processes_config.get('workers', 2),
+            processes_config.get('assignment', 'hash')
+        )
+        
+        # Spawned workers start from a fresh interpreter; forking a process
+        # that already holds MongoClients and threads is not safe
+        self.context = multiprocessing.get_context('spawn')
+        self.metrics_queue = None
+        self.log_queue = None
+        self.log_listener = None
+        self.stop_event = None
+        
+        self.processes = {}  # Worker index -> Process
+        self.started_at = {}  # Worker index -> monotonic start time
+        self.backoff = {}  # Worker index -> seconds to wait before the next restart
+        self.restart_at = {}  # Worker index -> monotonic time of a pending restart
+        self.restarts = {}  # Worker index -> number of restarts
+        
+        self.running = False
+        self.thread = None
+        
+    def start(self):
+        """Start every worker that has collections, and the supervising thread"""
+        self.metrics_queue = self.context.Queue()
+        self.stop_event = self.context.Event()
+        
+        # Worker log records are handled by the parent's handlers, so all
+        # processes log to the same console and file
+        self.log_queue = self.context.Queue()
+        self.log_listener = logging.handlers.QueueListener(
+            self.log_queue,
+            *logging.getLogger().handlers,
+            respect_handler_level=True
+        )
+        self.log_listener.start()
+        
+        self.running = True
+        for index, collections in enumerate(self.assignments):
+            if collections:
+                self.restarts[index] = 0
+                self.backoff[index] = self.restart_backoff
+                self._spawn(index)
+                
+        self.thread = threading.Thread(target=self._run, name="iris-process-supervisor")
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def stop(self):
+        """Stop the workers, letting each flush its batches and checkpoints"""
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=30)
+        if not self.stop_event:
+            return
+            
+        self.stop_event.set()
+        deadline = time.monotonic() + self.stop_timeout
+        for index, process in self.processes.items():
+            # Keep draining metrics: a worker cannot exit while its last
+            # snapshot is stuck in a full pipe
+            while process.is_alive() and time.monotonic() < deadline:
+                self._collect_metrics(timeout=0.5)
+            if process.is_alive():
+                self.logger.error(f"Worker {index} did not stop within {self.stop_timeout}s; terminating it")
+                process.terminate()
+            process.join(timeout=5)
+            
+        self._collect_metrics()
+        self.log_listener.stop()
+        self.logger.info("Stopped all replication workers")
+        
+    def _spawn(self, index):
+        process = self.context.Process(
+            target=_run_worker,
+            args=(
+                self._worker_config(index),
+                index,
+                self.metrics_queue,
+                self.stop_event,
+                self.log_queue,
+                logging.getLogger().level,
+                self.metrics_interval,
+                os.getpid()
+            ),
+            name=f"iris-worker-{index}"
+        )
+        process.start()
+        
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        self.restart_at.pop(index, None)
+        self._record(index)
+        
+        names = ', '.join(c['name'] for c in self.assignments[index])
+        self.logger.info(f"Started worker {index} (pid {process.pid}) for collections: {names}")
+        
+    def _worker_config(self, index):
+        """Configuration of one worker: its collections, and its own spill directory"""
+        config = copy.deepcopy(self.config)
+        replication_config = config['replication']
+        replication_config['collections'] = self.assignments[index]
+        
+        spill_config = replication_config.get('spill')
+        if spill_config:
+            spill_config['path'] = os.path.join(spill_config.get('path', 'iris_spill'), f"worker-{index}")
+        return config
+        
+    def _run(self):
+        """Collect worker metrics and restart workers that exited"""
+        while self.running:
+            self._collect_metrics(timeout=1.0)
+            
+            now = time.monotonic()
+            for index, process in list(self.processes.items()):
+                if process.is_alive() or not self.running:
+                    continue
+                    
+                if index not in self.restart_at:
+                    self._schedule_restart(index, process, now)
+                elif now >= self.restart_at[index]:
+                    self.restarts[index] += 1
+                    self._spawn(index)
+                    
+    def _schedule_restart(self, index, process, now):
+        # A worker that ran for a while starts over with the short backoff;
+        # one that keeps failing right away waits longer every time
+        if now - self.started_at[index] > self.max_restart_backoff:
+            self.backoff[index] = self.restart_backoff
+        backoff = self.backoff[index]
+        self.backoff[index] = min(backoff * 2, self.max_restart_backoff)
+        self.restart_at[index] = now + backoff
+        
+        message = f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}; restarting in {backoff:.0f}s"
+        self.logger.error(message)
+        self.monitoring_service.record_error(
+            collection=f"worker-{index}",
+            error_type="worker_exit",
+            message=message
+        )
+        self._record(index)
+        
+    def _collect_metrics(self, timeout=None):
+        """Merge every snapshot waiting in the metrics queue"""
+        block = timeout is not None
+        while True:
+            try:
+                index, snapshot = self.metrics_queue.get(block=block, timeout=timeout)
+            except queue.Empty:
+                return
+            self.monitoring_service.merge_worker(index, snapshot)
+            self._record(index)
+            block = False
+            
+    def _record(self, index):
+        process = self.processes[index]
+        self.monitoring_service.record_worker(
+            worker=index,
+            pid=process.pid,
+            alive=process.is_alive(),
+            restarts=self.restarts[index],
+            collections=[c['name'] for c in self.assignments[index]]
+        )
+
+
+def assign_collections(collections, workers, assignment='hash'):
+    """
+    Split collection configurations between workers
+    
+    Parameters:
+    -----------
+    collections : list
+        Collection configurations (replication.collections)
+    workers : int
+        Number of worker processes
+    assignment : str
+        "hash" (stable CRC32 of the collection name) or "weight" (each
+        collection's weight, default 1, balanced greedily)
+        
+    Returns:
+    --------
+    list
+        One list of collection configurations per worker; some may be empty
+    """
+    assignments = [[] for _ in range(max(1, workers))]
+    
+    if assignment == 'hash':
+        for collection in collections:
+            assignments[zlib.crc32(collection['name'].encode()) % len(assignments)].append(collection)
+            
+    elif assignment == 'weight':
+        loads = [0] * len(assignments)
+        for collection in sorted(collections, key=lambda c: (-c.get('weight', 1), c['name'])):
+            index = loads.index(min(loads))
+            assignments[index].append(collection)
+            loads[index] += collection.get('weight', 1)
+            
+    else:
+        raise ValueError(f"Unknown collection assignment: {assignment}")
+        
+    return assignments
+
+
+def _run_worker(config, index, metrics_queue, stop_event, log_queue, log_level, metrics_interval, parent_pid):
+    """Entry point of a worker process"""
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(log_level)
+    logger = logging.getLogger(f"iris.worker.{index}")
+    
+    # The supervisor decides when workers stop; SIGTERM stops only this
+    # worker, which the supervisor then restarts
+    terminated = threading.Event()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: terminated.set())
+    
+    from .replication_controller import ReplicationController
+    controller = ReplicationController(config, worker_index=index)
+    controller.start()
+    
+    try:
+        reported_at = time.monotonic()
+        while not stop_event.is_set() and not terminated.wait(min(1.0, metrics_interval)):
+            if os.getppid() != parent_pid:
+                logger.error("Supervisor process is gone; stopping")
+                break
+            if time.monotonic() - reported_at >= metrics_interval:
+                metrics_queue.put((index, controller.monitoring_service.snapshot()))
+                reported_at = time.monotonic()
+    finally:
+        controller.stop()
+        metrics_queue.put((index, controller.monitoring_service.snapshot()))
@@ -0,0 +1,99 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+class SamplingProfiler:
+    def __init__(self, interval_ms=5, max_seconds=60, thread_prefix='iris-'):
+        """
+        Wall-clock sampling profiler for the replication threads
+        
+        Nothing is recorded until profile() is called. While it runs, the
+        stack of every matching thread is read every interval_ms from
+        sys._current_frames(); the sampled threads are not interrupted.
+        Threads that wait (on a cursor, a queue or the target) show up in
+        the frame they wait in, so the output shows where wall time goes
+        rather than only CPU time.
+        
+        Parameters:
+        -----------
+        interval_ms : float
+            Time between two samples
+        max_seconds : float
+            Longest profile a caller may ask for
+        thread_prefix : str
+            Default prefix of the names of the threads to sample
+        """
+        self.interval = interval_ms / 1000.0
+        self.max_seconds = max_seconds
+        self.thread_prefix = thread_prefix
+        self._running = threading.Lock()  # One profile at a time
+        
+    def profile(self, seconds, thread_prefix=None):
+        """
+        Sample the matching threads for a number of seconds
+        
+        Returns:
+        --------
+        str
+            Collapsed stacks ("thread;outer;...;inner count" per line, root
+            first), as read by flamegraph.pl, speedscope and inferno
+            
+        Raises:
+        -------
+        ValueError
+            If seconds is not between 0 and max_seconds
+        RuntimeError
+            If another profile is running
+        """
+        if not 0 < seconds <= self.max_seconds:
+            raise ValueError(f"seconds must be between 0 and {self.max_seconds}")
+        if not self._running.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+            
+        try:
+            counts = self._sample(seconds, thread_prefix or self.thread_prefix)
+        finally:
+            self._running.release()
+            
+        lines = [f"{stack} {count}" for stack, count in counts.most_common()]
+        return '\n'.join(lines) + '\n' if lines else ''
+        
+    def _sample(self, seconds, thread_prefix):
+        counts = collections.Counter()
+        labels = {}  # Code object -> frame label
+        own_ident = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                name = names.get(ident)
+                if ident == own_ident or not name or not name.startswith(thread_prefix):
+                    continue
+                    
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = self._label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(name.replace(';', '_').replace(' ', '_'))
+                counts[';'.join(reversed(stack))] += 1
+                
+            # Do not keep the sampled frames alive while sleeping
+            frames = frame = None
+            time.sleep(self.interval)
+            
+        return counts
+        
+    @staticmethod
+    def _label(code):
+        # The first line of the function, not the current one, so all
+        # samples of a function fold into one frame
+        label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label.replace(';', '_')
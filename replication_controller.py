@@ -1,47 +1,199 @@
 import logging
+import threading
 import time
-from pymongo import MongoClient
-from .change_stream_listener import ChangeStreamListener
+from bson.raw_bson import RawBSONDocument
+from .change_stream_listener import ChangeStreamListener, DatabaseChangeStreamListener
+from .apply_workers import PartitionedApplier
+from .async_engine import AsyncReplicationEngine
+from .checkpoint_store import CheckpointStore
+from .client_registry import ClientRegistry
+from .initial_sync import InitialSync
+from .lag_monitor import LagMonitor
 from .operation_filter import OperationFilter
 from .operation_transformer import OperationTransformer
+from .partitioning import TimePartitioner
+from .process_supervisor import ProcessSupervisor
+from .spill_queue import SpillQueue
 from .target_applier import TargetApplier
 from .monitoring_service import MonitoringService
 
 class ReplicationController:
-    def __init__(self, config):
+    def __init__(self, config, worker_index=None):
+        """
+        Initialize the replication controller
+        
+        Parameters:
+        -----------
+        config : dict
+            Application configuration
+        worker_index : int
+            Set when running inside a worker process of a ProcessSupervisor;
+            the worker then replicates the collections in config without
+            serving monitoring itself
+        """
         self.config = config
+        self.worker_index = worker_index
         self.logger = logging.getLogger("iris.replication_controller")
         
+        self.monitoring_service = MonitoringService(config['monitoring'])
+        
+        # One client per cluster, shared with the retention manager; pool
+        # metrics of worker processes are told apart by their prefix
+        self.clients = ClientRegistry(
+            config,
+            self.monitoring_service,
+            name_prefix=f"worker-{worker_index}/" if worker_index is not None else ''
+        )
+        
         # Initialize components
-        self.source_client = MongoClient(config['source']['uri'])
-        self.target_client = MongoClient(config['target']['uri'])
+        self.source_client = self.clients.client('source')
+        self.target_client = self.clients.client('target')
         
-        self.source_db = self.source_client[config['source']['database']]
-        self.target_db = self.target_client[config['target']['database']]
+        self.source_db = self.clients.database('source')
+        self.target_db = self.clients.database('target')
         
-        self.operation_filter = OperationFilter(config['replication']['exclude_operations'])
-        self.operation_transformer = OperationTransformer()
-        self.target_applier = TargetApplier(self.target_db)
+        self.operation_filter = OperationFilter(
+            config['replication']['exclude_operations'],
+            excluded_fields=config['replication'].get('exclude_event_fields'),
+            pushdown=config['replication'].get('pushdown_filter', True)
+        )
+        self.operation_transformer = OperationTransformer(config['replication'].get('transform'))
+        # Collections with update_mode "full_document" replace the whole
+        # document on update and need updateLookup; the rest apply the delta
+        self.full_document_collections = {
+            c['name'] for c in config['replication']['collections']
+            if c.get('update_mode', 'delta') == 'full_document'
+        }
         
-        self.monitoring_service = MonitoringService(config['monitoring'])
+        # Collections with a partitioning section are written to time-period
+        # buckets; routing needs the partition field, so their updates always
+        # use the full document
+        self.partitioners = {
+            c['name']: TimePartitioner(self.target_db, c)
+            for c in config['replication']['collections'] if c.get('partitioning')
+        }
+        self.full_document_collections.update(self.partitioners)
+        
+        # Collections lagging more than max_lag_seconds apply with larger
+        # batches and more workers until they catch up
+        catch_up_config = config['replication'].get('catch_up', {})
+        batch_size = config['replication'].get('batch_size', 1)
+        
+        # Replicated writes use replication.write_concern; checkpoints and
+        # metadata keep the client default
+        self.target_applier = TargetApplier(
+            self.clients.database('target', write_concern=config['replication'].get('write_concern')),
+            batch_size=batch_size,
+            max_delay_ms=config['replication'].get('batch_max_delay_ms', 100),
+            full_document_collections=self.full_document_collections,
+            partitioners=self.partitioners,
+            catch_up_batch_size=catch_up_config.get('batch_size', batch_size * 4),
+            idempotent=config['replication'].get('idempotent', False),
+            coalesce=config['replication'].get('coalesce', False),
+            monitoring_service=self.monitoring_service
+        )
+        
+        # With several apply workers, listeners hand operations to a stage
+        # that applies different documents concurrently
+        apply_workers = config['replication'].get('apply_workers', 1)
+        if apply_workers > 1:
+            self.apply_stage = PartitionedApplier(
+                self.target_applier,
+                workers=apply_workers,
+                queue_size=config['replication'].get('apply_queue_size', 1000),
+                catch_up_workers=catch_up_config.get('apply_workers', apply_workers * 2)
+            )
+        else:
+            self.apply_stage = None
+            
+        # Operations the target fails on or cannot keep up with are spilled
+        # to disk and replayed, so capture keeps going
+        spill_config = config['replication'].get('spill', {})
+        if spill_config.get('enabled', False):
+            self.spill_queue = SpillQueue(
+                spill_config,
+                self.apply_stage or self.target_applier,
+                self.target_applier,
+                self.monitoring_service
+            )
+        else:
+            self.spill_queue = None
+        self.lag_monitor = LagMonitor(
+            config,
+            self.source_client,
+            self.monitoring_service,
+            self.target_applier,
+            self.apply_stage
+        )
+        
+        # Resume tokens are persisted so restarts continue where they stopped
+        self.checkpoint_store = CheckpointStore(config['replication'].get('checkpoint', {}), self.target_db)
+        
+        # Read change events as RawBSONDocuments; full documents then reach
+        # the target without being decoded and encoded again
+        self.raw_documents = config['replication'].get('raw_documents', False)
+        
+        # "database" opens one change stream for all collections instead of one per collection
+        self.stream_mode = config['replication'].get('stream_mode', 'collection')
+        
+        # "asyncio" runs every listener and applier on one event loop
+        self.engine = config['replication'].get('engine', 'threads')
+        self.async_engine = None
+        self.async_engine_thread = None
         
         self.listeners = {}
         
+        # With replication.processes.workers > 1 this process only supervises;
+        # the collections are replicated by worker processes
+        workers = config['replication'].get('processes', {}).get('workers', 1)
+        if worker_index is None and workers > 1:
+            self.supervisor = ProcessSupervisor(config, self.monitoring_service)
+        else:
+            self.supervisor = None
+            
     def start(self):
         """Start the replication process for all configured collections"""
         self.logger.info("Starting MinervaDB Iris replication")
         
-        # Create collections in target if they don't exist
-        self._prepare_target_collections()
-        
-        # Start monitoring service
-        self.monitoring_service.start()
+        # Create collections in target if they don't exist; workers rely on
+        # the supervising process for this
+        if self.worker_index is None:
+            self._prepare_target_collections()
+            
+        if self.supervisor:
+            self.monitoring_service.start()
+            self.supervisor.start()
+            self.logger.info("Replication workers started")
+            return
+            
+        # Start monitoring service and the batch flusher before any listener
+        # submits operations; the asyncio engine runs both on its own loop
+        if self.engine != 'asyncio':
+            if self.worker_index is None:
+                self.monitoring_service.start()
+            self.target_applier.start()
+            if self.apply_stage:
+                self.apply_stage.start()
+            if self.spill_queue:
+                self.spill_queue.start()
+        self.checkpoint_store.start()
+        self.lag_monitor.start()
         
-        # Start change stream listeners for each collection
-        for collection_config in self.config['replication']['collections']:
-            collection_name = collection_config['name']
-            self._start_collection_replication(collection_name)
+        # Copy pre-existing documents; streaming then resumes from the
+        # start point recorded before the copy
+        if self.config['replication'].get('initial_sync', {}).get('enabled', False):
+            self._run_initial_sync()
             
+        # Start change stream listeners for each collection
+        if self.engine == 'asyncio':
+            self._start_async_engine()
+        elif self.stream_mode == 'database':
+            self._start_database_replication()
+        else:
+            for collection_config in self.config['replication']['collections']:
+                collection_name = collection_config['name']
+                self._start_collection_replication(collection_name)
+                
         self.logger.info("Replication started for all collections")
         
     def _prepare_target_collections(self):
@@ -58,30 +210,152 @@ class ReplicationController:
             for index_config in collection_config.get('indexes', []):
                 target_collection.create_index(**index_config)
                 
+            if collection_name in self.partitioners:
+                self.partitioners[collection_name].refresh_view()
+                
             self.logger.info(f"Prepared target collection: {collection_name}")
             
+    def _run_initial_sync(self):
+        """Backfill the target with documents that existed before streaming started"""
+        initial_sync = InitialSync(
+            self.config,
+            self.source_db,
+            self.target_db,
+            self.operation_transformer,
+            self.checkpoint_store,
+            self.monitoring_service,
+            stream_key=self._database_checkpoint_key() if self.stream_mode == 'database' else None,
+            target_applier=self.target_applier
+        )
+        initial_sync.run([c['name'] for c in self.config['replication']['collections']])
+        
     def _start_collection_replication(self, collection_name):
         """Start replication for a specific collection"""
         # Create and start listener
-        source_collection = self.source_db[collection_name]
+        source_collection = self._stream_source(self.source_db[collection_name])
         
         listener = ChangeStreamListener(
             source_collection,
             self.operation_filter,
             self.operation_transformer,
-            self.target_applier,
-            self.monitoring_service
+            self.spill_queue or self.apply_stage or self.target_applier,
+            self.monitoring_service,
+            checkpoint_store=self.checkpoint_store,
+            update_lookup=collection_name in self.full_document_collections,
+            **self._listener_options()
         )
         
         listener.start()
         self.listeners[collection_name] = listener
         self.logger.info(f"Started replication for collection: {collection_name}")
         
+    def _start_database_replication(self):
+        """
+        Start database-level listeners that serve every configured collection
+        
+        updateLookup applies to a whole stream, so collections that need the
+        full document are watched by a second stream; the others then skip
+        the lookup on every update.
+        """
+        collection_names = [c['name'] for c in self.config['replication']['collections']]
+        lookup_names = [name for name in collection_names if name in self.full_document_collections]
+        delta_names = [name for name in collection_names if name not in self.full_document_collections]
+        
+        for names, update_lookup in ((delta_names, False), (lookup_names, True)):
+            if not names:
+                continue
+                
+            listener = DatabaseChangeStreamListener(
+                self._stream_source(self.source_db),
+                names,
+                self.operation_filter,
+                self.operation_transformer,
+                self.spill_queue or self.apply_stage or self.target_applier,
+                self.monitoring_service,
+                checkpoint_store=self.checkpoint_store,
+                update_lookup=update_lookup,
+                **self._listener_options()
+            )
+            
+            listener.start()
+            self.listeners[listener.checkpoint_key] = listener
+            self.logger.info(f"Started database-level replication for collections: {', '.join(names)}"
+                             f"{' (updateLookup)' if update_lookup else ''}")
+                             
+    def _stream_source(self, source):
+        """The database or collection to watch, with the raw codec when configured"""
+        if not self.raw_documents:
+            return source
+        return source.with_options(codec_options=source.codec_options.with_options(document_class=RawBSONDocument))
+        
+    def _listener_options(self):
+        """Capture queue settings shared by all listeners"""
+        return {
+            'capture_queue_size': self.config['replication'].get('capture_queue_size', 10000),
+            'max_idle_wait_ms': self.config['replication'].get('max_idle_wait_ms', 100)
+        }
+        
+    def _start_async_engine(self):
+        """Run the asyncio engine on a dedicated thread owning its event loop"""
+        self.async_engine = AsyncReplicationEngine(
+            self.config,
+            self.operation_filter,
+            self.operation_transformer,
+            self.target_applier,
+            self.checkpoint_store,
+            self.monitoring_service,
+            full_document_collections=self.full_document_collections,
+            clients=self.clients
+        )
+        
+        self.async_engine_thread = threading.Thread(target=self.async_engine.run, name="iris-asyncio")
+        self.async_engine_thread.daemon = True
+        self.async_engine_thread.start()
+        self.logger.info("Started asyncio replication engine")
+        
+    def _database_checkpoint_key(self):
+        """Checkpoint key of the shared stream in database stream mode; the lookup stream starts from it"""
+        return DatabaseChangeStreamListener.checkpoint_key_for(self.source_db.name)
+        
     def stop(self):
         """Stop all replication processes"""
+        if self.supervisor:
+            self.supervisor.stop()
+            self.monitoring_service.stop()
+            self.clients.close()
+            self.logger.info("Stopped MinervaDB Iris replication")
+            return
+            
+        self.lag_monitor.stop()
+        
+        if self.async_engine:
+            self.async_engine.stop()
+            self.async_engine_thread.join(timeout=30)
+            
         for name, listener in self.listeners.items():
             listener.stop()
+            
+        # Listeners finish applying what they captured before the applier
+        # writes out its last batches
+        for name, listener in self.listeners.items():
+            listener.join(timeout=30)
             self.logger.info(f"Stopped replication for collection: {name}")
             
+        # Write out operations still queued or waiting in partial batches
+        if self.apply_stage:
+            self.apply_stage.stop()
+        self.target_applier.stop()
+        
+        # Failures of those last writes may still spill, so the spill queue
+        # stops after the applier
+        if self.spill_queue:
+            self.spill_queue.stop()
+            
+        # Persist checkpoints covering the operations just written
+        self.checkpoint_store.stop()
+        
         self.monitoring_service.stop()
+        
+        # Shared with the retention manager, which stops first
+        self.clients.close()
         self.logger.info("Stopped MinervaDB Iris replication")
@@ -3,9 +3,10 @@ import threading
 import time
 import datetime
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 
 class RetentionManager:
-    def __init__(self, config):
+    def __init__(self, config, monitoring_service=None, partitioners=None, archive=None, clients=None):
         """
         Initialize the retention manager
         
@@ -13,19 +14,70 @@ class RetentionManager:
         -----------
         config : dict
             Application configuration
+        monitoring_service : MonitoringService
+            Receives purge progress and provides replication lag for backoff
+        partitioners : dict
+            Collection name -> TimePartitioner of target collections stored in
+            time-period buckets
+        archive : ColdArchive
+            Receives expiring target documents before they are deleted
+        clients : ClientRegistry
+            Shared clients of the replication controller; without it the
+            retention manager connects on its own
         """
         self.config = config
         self.logger = logging.getLogger("iris.retention_manager")
         
-        self.source_client = MongoClient(config['source']['uri'])
-        self.target_client = MongoClient(config['target']['uri'])
-        
-        self.source_db = self.source_client[config['source']['database']]
-        self.target_db = self.target_client[config['target']['database']]
+        retention_config = config.get('retention', {})
         
+        # Expired documents are found with retention.read_preference (e.g.
+        # secondaryPreferred, to keep the scans off the primary); deletes and
+        # purge progress always go to the primary
+        if clients:
+            read_preference = retention_config.get('read_preference')
+            self.source_db = clients.database('source', read_preference=read_preference)
+            self.target_db = clients.database('target', read_preference=read_preference)
+            state_db = clients.database('target')
+        else:
+            self.source_client = MongoClient(config['source']['uri'])
+            self.target_client = MongoClient(config['target']['uri'])
+            self.source_db = self.source_client[config['source']['database']]
+            self.target_db = self.target_client[config['target']['database']]
+            state_db = self.target_db
+            
         self.source_retention_days = config['source']['retention_days']
         self.target_retention_days = config['target']['retention_days']
         
+        self.monitoring_service = monitoring_service
+        self.partitioners = partitioners or {}
+        self.archive = archive
+        
+        # Purges delete in index-ordered chunks at a bounded rate and back off
+        # while replication lags or target writes slow down
+        self.batch_size = retention_config.get('batch_size', 1000)
+        self.max_docs_per_second = retention_config.get('max_docs_per_second', 5000)
+        self.pause = retention_config.get('pause_ms', 100) / 1000.0
+        self.max_write_latency = retention_config.get('max_write_latency_ms', 500) / 1000.0
+        self.max_lag_seconds = config['replication'].get('max_lag_seconds', 300)
+        self.backoff = 0.0
+        
+        # Small passes run often and only cover the window expired since the
+        # previous pass; a periodic full sweep catches late-arriving documents
+        self.interval = retention_config.get('interval_seconds', 300)
+        self.full_sweep_interval = retention_config.get('full_sweep_interval_seconds', 86400)
+        self.require_index = retention_config.get('require_index', True)
+        
+        # Timestamp field of each collection (first indexed field with expireAfterSeconds)
+        self.timestamp_fields = {}
+        for collection_config in config['replication']['collections']:
+            for index_config in collection_config.get('indexes', []):
+                if 'expireAfterSeconds' in index_config.get('options', {}):
+                    self.timestamp_fields[collection_config['name']] = next(iter(index_config['keys']))
+                    break
+                    
+        # Purge progress, so an interrupted purge resumes with the same cutoff
+        self.state = state_db[retention_config.get('state_collection', '_minervadb_iris_retention')]
+        
         self.running = False
         self.thread = None
         
@@ -60,61 +112,245 @@ class RetentionManager:
             except Exception as e:
                 self.logger.error(f"Error in retention manager: {str(e)}")
                 
-            # Sleep until next retention cycle (daily check is reasonable)
-            # But we check more frequently to allow for clean shutdown
-            for _ in range(24):  # Check every hour for 24 hours
-                if not self.running:
-                    break
-                time.sleep(3600)  # 1 hour
+            # Sleep until the next pass in short steps for a clean shutdown
+            deadline = time.monotonic() + self.interval
+            while self.running and time.monotonic() < deadline:
+                time.sleep(min(1.0, deadline - time.monotonic()))
                 
     def _process_source_retention(self):
         """Apply retention policy to source database"""
-        self.logger.info(f"Applying {self.source_retention_days} day retention policy to source")
+        self._apply_retention('source', self.source_db, self.source_retention_days)
+        
+    def _process_target_retention(self):
+        """Apply retention policy to target database"""
+        self._apply_retention('target', self.target_db, self.target_retention_days)
         
-        cutoff_date = datetime.datetime.utcnow() - datetime.timedelta(days=self.source_retention_days)
+    def _apply_retention(self, side, db, retention_days):
+        """Purge documents older than the retention period from every collection"""
+        self.logger.info(f"Applying {retention_days} day retention policy to {side}")
         
+        cutoff_date = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+        
+        if self.monitoring_service and self.monitoring_service.catch_up_active():
+            self.logger.info(f"Replication is catching up; {side} retention pass skipped")
+            return
+            
         # Process each collection
         for collection_config in self.config['replication']['collections']:
+            if not self.running:
+                break
+                
             collection_name = collection_config['name']
-            collection = self.source_db[collection_name]
+            collection = db[collection_name]
             
-            # Find the timestamp field (first indexed field with expireAfterSeconds)
-            timestamp_field = None
-            for index_config in collection_config.get('indexes', []):
-                if 'expireAfterSeconds' in index_config.get('options', {}):
-                    timestamp_field = next(iter(index_config['keys']))
-                    break
-                    
+            timestamp_field = self.timestamp_fields.get(collection_name)
             if not timestamp_field:
                 self.logger.warning(f"No timestamp field found for retention in {collection_name}")
                 continue
                 
-            # Delete old documents
-            result = collection.delete_many({timestamp_field: {'$lt': cutoff_date}})
-            self.logger.info(f"Deleted {result.deleted_count} documents from source {collection_name}")
+            collections = [collection]
+            if side == 'target' and collection_name in self.partitioners:
+                partitioner = self.partitioners[collection_name]
+                self._drop_expired_buckets(partitioner, timestamp_field, cutoff_date)
+                # The oldest remaining bucket may straddle the cutoff
+                collections.extend(db[bucket] for bucket in partitioner.buckets()[:1])
                 
-    def _process_target_retention(self):
-        """Apply retention policy to target database"""
-        self.logger.info(f"Applying {self.target_retention_days} day retention policy to target")
+            # Only the target keeps cold copies; the source copy lives on there
+            archive_name = collection_name if side == 'target' and self.archive else None
+            for expiring in collections:
+                deleted = self._purge(side, expiring, timestamp_field, cutoff_date, archive_name)
+                if deleted:
+                    self.logger.info(f"Deleted {deleted} documents from {side} {expiring.name}")
+                    
+    def _drop_expired_buckets(self, partitioner, timestamp_field, cutoff_date):
+        """
+        Expire a partitioned collection by dropping whole buckets
         
-        cutoff_date = datetime.datetime.utcnow() - datetime.timedelta(days=self.target_retention_days)
+        Only buckets whose period ends before the cutoff are dropped. The
+        bucket straddling the cutoff and the base collection are purged
+        document by document as usual.
+        """
+        for bucket in partitioner.expired_buckets(cutoff_date):
+            if not self.running:
+                break
+            if self.archive:
+                self.archive.write_collection(partitioner.name, self.target_db[bucket], timestamp_field)
+            partitioner.drop_bucket(bucket)
+            
+    def _purge(self, side, collection, timestamp_field, cutoff_date, archive_name=None):
+        """
+        Delete expired documents in chunks ordered by the timestamp index
         
-        # Process each collection
-        for collection_config in self.config['replication']['collections']:
-            collection_name = collection_config['name']
-            collection = self.target_db[collection_name]
+        Each chunk selects the next batch_size _ids in timestamp order and
+        deletes them by _id. Progress is stored after every chunk; a purge
+        interrupted by a restart continues with its original cutoff from the
+        last timestamp it reached.
+        
+        A completed purge leaves its cutoff behind as a watermark. The next
+        pass only scans [watermark, cutoff) unless a full sweep is due.
+        
+        With an archive_name, each chunk is read as raw BSON and archived
+        before it is deleted.
+        
+        Returns:
+        --------
+        int
+            Number of documents deleted by this purge
+        """
+        state_id = f"{side}:{collection.name}"
+        state = self.state.find_one({'_id': state_id})
+        
+        if state and not state.get('complete'):
+            cutoff_date = state['cutoff']
+            deleted = state['deleted']
+            last_value = state.get('last_value')
+            self.logger.info(f"Resuming {side} purge of {collection.name} at {deleted} deleted documents")
+        else:
+            now = datetime.datetime.utcnow()
+            swept_at = state.get('swept_at') if state else None
+            full_sweep = not swept_at or (now - swept_at).total_seconds() >= self.full_sweep_interval
+            watermark = None if full_sweep else state['cutoff']
+            if watermark is not None and watermark >= cutoff_date:
+                return 0
+                
+            if not self._index_supports(side, collection, timestamp_field, cutoff_date):
+                return 0
+                
+            deleted = 0
+            last_value = watermark
+            self.state.replace_one({'_id': state_id}, {
+                'cutoff': cutoff_date,
+                'deleted': 0,
+                'last_value': watermark,
+                'complete': False,
+                'started_at': now,
+                'swept_at': now if full_sweep else swept_at
+            }, upsert=True)
             
-            # Find the timestamp field (first indexed field with expireAfterSeconds)
-            timestamp_field = None
-            for index_config in collection_config.get('indexes', []):
-                if 'expireAfterSeconds' in index_config.get('options', {}):
-                    timestamp_field = next(iter(index_config['keys']))
-                    break
-                    
-            if not timestamp_field:
-                self.logger.warning(f"No timestamp field found for retention in {collection_name}")
-                continue
+        started = time.monotonic()
+        purged = 0
+        
+        if archive_name:
+            reader, projection = self.archive.reader(collection), None
+        else:
+            reader, projection = collection, {timestamp_field: 1}
+            
+        while self.running:
+            query = {timestamp_field: {'$lt': cutoff_date}}
+            if last_value is not None:
+                query[timestamp_field]['$gte'] = last_value
                 
-            # Delete old documents
-            result = collection.delete_many({timestamp_field: {'$lt': cutoff_date}})
-            self.logger.info(f"Deleted {result.deleted_count} documents from target {collection_name}")
+            chunk = list(reader.find(query, projection)
+                         .sort(timestamp_field, 1)
+                         .limit(self.batch_size))
+            if not chunk:
+                self.state.update_one({'_id': state_id}, {'$set': {
+                    'complete': True,
+                    'completed_at': datetime.datetime.utcnow()
+                }})
+                self._report_progress(side, collection.name, deleted, purged, started, complete=True)
+                break
+                
+            if archive_name:
+                self.archive.write(archive_name, chunk, timestamp_field)
+                
+            write_started = time.monotonic()
+            result = collection.delete_many({'_id': {'$in': [doc['_id'] for doc in chunk]}})
+            write_latency = time.monotonic() - write_started
+            
+            deleted += result.deleted_count
+            purged += result.deleted_count
+            last_value = chunk[-1].get(timestamp_field)
+            
+            self.state.update_one({'_id': state_id}, {'$set': {'deleted': deleted, 'last_value': last_value}})
+            self._report_progress(side, collection.name, deleted, purged, started, complete=False)
+            
+            self._throttle(len(chunk), write_latency)
+            
+        return purged
+        
+    def _index_supports(self, side, collection, timestamp_field, cutoff_date):
+        """
+        Check with explain that the purge query is answered from an index
+        
+        A collection scan is refused when retention.require_index is set and
+        only logged otherwise.
+        """
+        query = {timestamp_field: {'$lt': cutoff_date}}
+        try:
+            explain = (collection.find(query, {timestamp_field: 1})
+                       .sort(timestamp_field, 1)
+                       .limit(self.batch_size)
+                       .explain())
+        except PyMongoError as e:
+            self.logger.warning(f"Could not explain {side} purge of {collection.name}: {str(e)}")
+            return True
+            
+        stages = _plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {}))
+        if 'COLLSCAN' not in stages:
+            return True
+            
+        message = f"Purge of {side} {collection.name} on {timestamp_field} would scan the whole collection"
+        if not self.require_index:
+            self.logger.warning(message)
+            return True
+            
+        self.logger.error(f"{message}; skipped (create an index on {timestamp_field} or set retention.require_index: false)")
+        if self.monitoring_service:
+            self.monitoring_service.record_error(
+                collection=collection.name,
+                error_type="retention",
+                message=message
+            )
+        return False
+        
+    def _throttle(self, chunk_size, write_latency):
+        """Pause between chunks to respect the rate limit and back off under pressure"""
+        delay = self.pause
+        if self.max_docs_per_second:
+            delay = max(delay, chunk_size / self.max_docs_per_second - write_latency)
+            
+        lag = self.monitoring_service.max_replication_lag() if self.monitoring_service else None
+        catching_up = self.monitoring_service.catch_up_active() if self.monitoring_service else False
+        if (write_latency > self.max_write_latency or catching_up
+                or (lag is not None and lag > self.max_lag_seconds)):
+            # Exponential backoff while the pressure lasts, capped at a minute
+            self.backoff = min(max(self.backoff * 2, 1.0), 60.0)
+            self.logger.warning(f"Retention backing off {self.backoff:.0f}s "
+                                f"(write latency {write_latency * 1000:.0f} ms, replication lag {lag} s)")
+            delay = max(delay, self.backoff)
+        else:
+            self.backoff = 0.0
+            
+        # Sleep in short steps so stop() is not held up
+        deadline = time.monotonic() + delay
+        while self.running and time.monotonic() < deadline:
+            time.sleep(min(0.5, deadline - time.monotonic()))
+            
+    def _report_progress(self, side, collection_name, deleted, purged, started, complete):
+        """Report purge progress and throughput"""
+        if not self.monitoring_service:
+            return
+            
+        elapsed = time.monotonic() - started
+        self.monitoring_service.record_retention_progress(
+            side=side,
+            collection=collection_name,
+            deleted=deleted,
+            docs_per_second=purged / elapsed if elapsed > 0 else 0.0,
+            complete=complete
+        )
+
+
+def _plan_stages(plan):
+    """All stage names of an explain plan tree"""
+    stages = set()
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.add(plan['stage'])
+        for value in plan.values():
+            stages |= _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages |= _plan_stages(value)
+    return stages
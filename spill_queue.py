@@ -0,0 +1,421 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import bson
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+
+class SpillQueue:
+    def __init__(self, config, stage, target_applier, monitoring_service):
+        """
+        Disk-backed buffer for operations the target cannot take right now
+        
+        Sits in front of the apply stage. An operation is spilled to a local
+        segmented log instead of being applied when:
+        - its apply failed with a retryable error (connection, timeout,
+          write concern; see TargetApplier._execute)
+        - more than max_in_flight operations are waiting on the target
+        - an earlier operation of the same document is still spilled
+        
+        Spilled operations are reported as {'spilled': True} once the record
+        is fsynced, so capture and checkpoints move on; they count as applied
+        when the drainer replays them. The drainer replays the log in order,
+        in batches, with exponential backoff while the target keeps failing.
+        
+        Every document's operations reach the log in submission order:
+        - operations on a document with spilled operations are spilled too
+        - an operation that was already sent when an earlier one of its
+          document got spilled is spilled again after it
+        - an operation to be spilled while earlier ones of its document are
+          still in flight waits until they finished (and possibly spilled)
+          
+        Parameters:
+        -----------
+        config : dict
+            Spill configuration (replication.spill)
+        stage : TargetApplier or PartitionedApplier
+            Where operations go while they are not spilled
+        target_applier : TargetApplier
+            Used by the drainer to replay spilled operations
+        monitoring_service : MonitoringService
+            Receives spill size, age and drain rate
+        """
+        self.logger = logging.getLogger("iris.spill_queue")
+        self.stage = stage
+        self.target_applier = target_applier
+        self.monitoring_service = monitoring_service
+        
+        self.path = config.get('path', 'iris_spill')
+        self.segment_size = config.get('segment_size_mb', 64) * 1024 * 1024
+        self.max_in_flight = config.get('max_in_flight', 10000)
+        self.drain_batch_size = config.get('drain_batch_size', 500)
+        self.drain_rate = config.get('drain_max_ops_per_second', 0)
+        self.max_backoff = config.get('max_backoff_seconds', 60)
+        self.fsync = config.get('fsync', True)
+        
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self.pending = {}  # (collection, encoded _id) -> spilled operations not yet replayed
+        self.in_flight = 0  # Operations handed to the stage and not yet completed
+        self.in_flight_keys = {}  # (collection, encoded _id) -> operations of the document in flight
+        self.waiting = {}  # (collection, encoded _id) -> operations to spill once those in flight finished
+        self.overtaken = set()  # Documents spilled while later operations of theirs were in flight
+        self.backlog = 0  # Spilled operations not yet replayed
+        self.backlog_bytes = 0
+        self.oldest_spilled_at = None
+        self.drained_per_second = 0.0
+        
+        self.position = (0, 0)  # (segment, offset) of the next record to replay
+        self.write_segment = 0
+        self.writer = None
+        self.write_offset = 0
+        
+        self.running = False
+        self.drain_thread = None
+        
+    def start(self):
+        """Recover an existing log and start the drainer"""
+        os.makedirs(self.path, exist_ok=True)
+        self._recover()
+        
+        # Writing always continues in a new segment, so a record torn by a
+        # crash stays at the end of an older one
+        self._open_segment(self.write_segment + 1)
+        
+        self.running = True
+        self.drain_thread = threading.Thread(target=self._run_drainer, name="iris-spill-drainer")
+        self.drain_thread.daemon = True
+        self.drain_thread.start()
+        
+        if self.backlog:
+            self.logger.info(f"Recovered {self.backlog} spilled operations")
+            
+    def stop(self):
+        """Stop the drainer; operations not yet replayed stay in the log"""
+        with self._lock:
+            self.running = False
+            self._available.notify_all()
+        if self.drain_thread:
+            self.drain_thread.join(timeout=30)
+        with self._lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+                
+    def submit(self, collection_name, operation, callback, lane=0):
+        """Apply an operation through the stage, or spill it (same arguments as TargetApplier.submit)"""
+        key = self._key(collection_name, operation)
+        with self._lock:
+            spill = key in self.pending or self.in_flight >= self.max_in_flight
+            if key in self.waiting or (spill and key in self.in_flight_keys):
+                # Spilled now, it would be replayed before the earlier
+                # operations of its document still in flight
+                self.waiting.setdefault(key, []).append((collection_name, operation, callback))
+                return
+                
+            if spill:
+                result = self._append([(collection_name, operation, callback)], key)[0]
+            else:
+                self.in_flight += 1
+                self.in_flight_keys[key] = self.in_flight_keys.get(key, 0) + 1
+                
+        if spill:
+            self._report()
+            callback(result)
+            return
+            
+        self.stage.submit(
+            collection_name,
+            operation,
+            functools.partial(self._completed, collection_name, operation, key, callback)
+        )
+        
+    def _completed(self, collection_name, operation, key, callback, result):
+        with self._lock:
+            self.in_flight -= 1
+            self.in_flight_keys[key] -= 1
+            respill = result.get('retryable') or (result.get('success') and key in self.overtaken)
+            spill = [(collection_name, operation, callback)] if respill else []
+            
+            if not self.in_flight_keys[key]:
+                del self.in_flight_keys[key]
+                self.overtaken.discard(key)
+                spill.extend(self.waiting.pop(key, []))
+                
+            results = self._append(spill, key)
+            
+        if spill:
+            self._report()
+        if not respill:
+            callback(result)
+        for (_, _, spilled_callback), spilled_result in zip(spill, results):
+            spilled_callback(spilled_result)
+            
+    def _append(self, entries, key):
+        """
+        Append operations of one document to the log and make them durable
+        
+        Called with the lock held, so no other operation of the document
+        gets between them.
+        
+        Returns:
+        --------
+        list
+            Result to report for each operation
+        """
+        results = []
+        for collection_name, operation, _ in entries:
+            record = bson.encode({
+                'collection': collection_name,
+                'operation': operation,
+                'spilled_at': time.time()
+            })
+            try:
+                if self.write_offset >= self.segment_size:
+                    self._open_segment(self.write_segment + 1)
+                    
+                self.writer.write(record)
+                self.writer.flush()
+                if self.fsync:
+                    os.fsync(self.writer.fileno())
+                    
+            except OSError as e:
+                try:
+                    # Drop what was written of the record, so it is not replayed
+                    self.writer.truncate(self.write_offset)
+                except OSError:
+                    pass
+                self.logger.error(f"Failed to spill {operation['operationType']} on {collection_name}: {str(e)}")
+                results.append({'success': False, 'error': f"Failed to spill operation: {str(e)}"})
+                continue
+                
+            self.write_offset += len(record)
+            self.pending[key] = self.pending.get(key, 0) + 1
+            self.backlog += 1
+            self.backlog_bytes += len(record)
+            if self.oldest_spilled_at is None:
+                self.oldest_spilled_at = time.time()
+            if key in self.in_flight_keys:
+                self.overtaken.add(key)
+            results.append({'spilled': True})
+            
+        if results:
+            self._available.notify()
+        return results
+        
+    def _run_drainer(self):
+        """Replay spilled operations in log order"""
+        backoff = 0.0
+        while True:
+            with self._lock:
+                while self.running and not self.backlog:
+                    self._available.wait(1.0)
+                if not self.running:
+                    return
+                    
+            started = time.monotonic()
+            records = self._read(self.drain_batch_size)
+            if not records:
+                # The writer has not finished the record yet
+                time.sleep(0.01)
+                continue
+                
+            self.oldest_spilled_at = records[0][1]['spilled_at']
+            replayed = self._replay(records)
+            if replayed:
+                self._advance(records[:replayed])
+                
+            elapsed = time.monotonic() - started
+            if replayed:
+                self.drained_per_second = replayed / elapsed if elapsed > 0 else 0.0
+            self._report()
+            
+            if replayed < len(records):
+                backoff = min(max(backoff * 2, 1.0), self.max_backoff)
+                self.logger.warning(f"Target still failing; retrying spilled operations in {backoff:.0f}s")
+                self._sleep(backoff)
+            else:
+                backoff = 0.0
+                if self.drain_rate:
+                    self._sleep(replayed / self.drain_rate - elapsed)
+                    
+    def _replay(self, records):
+        """
+        Apply records in order until one fails with a retryable error
+        
+        Returns:
+        --------
+        int
+            Number of leading records that are done, including those the
+            target rejected permanently
+        """
+        replayed = 0
+        start = 0
+        while start < len(records):
+            collection_name = records[start][1]['collection']
+            end = start + 1
+            while end < len(records) and records[end][1]['collection'] == collection_name:
+                end += 1
+                
+            batch = [record for _, record, _ in records[start:end]]
+            results = self.target_applier.apply_batch(collection_name, [record['operation'] for record in batch])
+            for record, result in zip(batch, results):
+                operation = record['operation']
+                if result.get('success'):
+                    # Spilled operations only count as applied now
+                    self.monitoring_service.record_apply(
+                        collection=collection_name,
+                        latency_seconds=time.time() - record['spilled_at'],
+                        cluster_time=operation.get('clusterTime')
+                    )
+                    replayed += 1
+                elif result.get('retryable'):
+                    return replayed
+                else:
+                    self.logger.error(f"Dropping spilled {operation['operationType']} on {collection_name}: "
+                                      f"{result.get('error')}")
+                    self.monitoring_service.record_error(
+                        collection=collection_name,
+                        error_type="spill_replay",
+                        message=result.get('error')
+                    )
+                    replayed += 1
+            start = end
+            
+        return replayed
+        
+    def _advance(self, records):
+        """Move the replay position past records and release their documents"""
+        position = records[-1][2]
+        with self._lock:
+            for _, record, _ in records:
+                key = self._key(record['collection'], record['operation'])
+                self.pending[key] -= 1
+                if not self.pending[key]:
+                    del self.pending[key]
+            self.backlog -= len(records)
+            self.backlog_bytes -= sum(end[1] - start[1] for start, _, end in records)
+            if not self.backlog:
+                self.oldest_spilled_at = None
+                
+        self.position = position
+        self._save_position()
+        
+        # Segments before the replay position are fully replayed
+        for segment in self._segments():
+            if segment < position[0]:
+                os.remove(self._segment_path(segment))
+                
+    def _read(self, limit, position=None):
+        """
+        Read up to limit records from a position (default: the replay position)
+        
+        Returns:
+        --------
+        list
+            (start position, record, end position) tuples
+        """
+        segment, offset = position or self.position
+        records = []
+        while len(records) < limit:
+            path = self._segment_path(segment)
+            if not os.path.exists(path):
+                later = [s for s in self._segments() if s > segment]
+                if not later:
+                    break
+                segment, offset = later[0], 0
+                continue
+                
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                while len(records) < limit:
+                    header = f.read(4)
+                    length = int.from_bytes(header, 'little') if len(header) == 4 else 0
+                    body = f.read(length - 4) if length else b''
+                    if not length or len(body) < length - 4:
+                        break
+                    records.append(((segment, offset), bson.decode(header + body), (segment, offset + length)))
+                    offset += length
+                    
+            if len(records) >= limit:
+                break
+                
+            # A shorter read at the end of a segment that is no longer
+            # written means the segment is done (or ends in a torn record)
+            later = [s for s in self._segments() if s > segment]
+            if not later or segment == self.write_segment:
+                break
+            segment, offset = later[0], 0
+            
+        return records
+        
+    def _recover(self):
+        """Load the replay position and rebuild pending documents from the log"""
+        segments = self._segments()
+        self.write_segment = segments[-1] if segments else 0
+        
+        try:
+            with open(os.path.join(self.path, 'position.json')) as f:
+                self.position = tuple(json.load(f))
+        except FileNotFoundError:
+            self.position = (segments[0], 0) if segments else (0, 0)
+            
+        position = self.position
+        while True:
+            records = self._read(self.drain_batch_size, position)
+            if not records:
+                break
+            for start, record, end in records:
+                key = self._key(record['collection'], record['operation'])
+                self.pending[key] = self.pending.get(key, 0) + 1
+                self.backlog += 1
+                self.backlog_bytes += end[1] - start[1]
+            position = records[-1][2]
+            
+    def _save_position(self):
+        path = os.path.join(self.path, 'position.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(list(self.position), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        
+    def _open_segment(self, segment):
+        if self.writer:
+            self.writer.close()
+        self.write_segment = segment
+        self.writer = open(self._segment_path(segment), 'ab')
+        self.write_offset = self.writer.tell()
+        
+    def _segments(self):
+        """Numbers of the existing segment files, oldest first"""
+        segments = []
+        for name in os.listdir(self.path):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                segments.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(segments)
+        
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f"{SEGMENT_PREFIX}{segment:08d}{SEGMENT_SUFFIX}")
+        
+    def _report(self):
+        self.monitoring_service.record_spill(
+            pending=self.backlog,
+            size_bytes=self.backlog_bytes,
+            oldest_age_seconds=time.time() - self.oldest_spilled_at if self.oldest_spilled_at else None,
+            drained_per_second=self.drained_per_second
+        )
+        
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while self.running and time.monotonic() < deadline:
+            time.sleep(min(0.5, deadline - time.monotonic()))
+            
+    @staticmethod
+    def _key(collection_name, operation):
+        document_id = operation.get('documentKey', {}).get('_id')
+        return collection_name, bson.encode({'_id': document_id})
@@ -1,8 +1,21 @@
+import functools
 import logging
-from pymongo.errors import PyMongoError
+import threading
+import time
+import bson
+from pymongo import InsertOne, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from .coalescing import merge_operations
+from .operation_transformer import METADATA_FIELD
+
+# Duplicate key; raised by a guarded upsert whose target document is newer
+DUPLICATE_KEY = 11000
+
+SOURCE_TIMESTAMP_FIELD = f"{METADATA_FIELD}.source_timestamp"
 
 class TargetApplier:
-    def __init__(self, target_db):
+    def __init__(self, target_db, batch_size=1, max_delay_ms=100, full_document_collections=None, partitioners=None,
+                 catch_up_batch_size=None, idempotent=False, coalesce=False, monitoring_service=None):
         """
         Initialize the target applier
         
@@ -10,10 +23,77 @@ class TargetApplier:
         -----------
         target_db : pymongo.database.Database
             Target MongoDB database
+        batch_size : int
+            Number of operations collected per collection before they are
+            flushed as one ordered bulk_write (1 disables batching)
+        max_delay_ms : int
+            Maximum time an operation may wait in a partial batch
+        full_document_collections : set
+            Collections whose updates are applied by replacing the whole
+            document from updateLookup; all others apply the update delta
+        partitioners : dict
+            Collection name -> TimePartitioner for collections written to
+            time-period buckets
+        catch_up_batch_size : int
+            Batch size of collections in catch-up mode (see set_catch_up);
+            only used when batching is enabled
+        idempotent : bool
+            Make re-delivered events harmless: inserts and replaces become
+            upserts, and every write only matches a target document whose
+            source_timestamp metadata is not newer than the event, so events
+            replayed after a resume neither fail on duplicate keys nor
+            overwrite newer state
+        coalesce : bool
+            Merge an operation into the pending write of the same document
+            in its lane, so a burst of changes to one document is written
+            once with its net effect; only used when batching is enabled
+        monitoring_service : MonitoringService
+            Receives the coalescing ratio of every flushed batch
         """
         self.target_db = target_db
         self.logger = logging.getLogger("iris.target_applier")
         
+        self.batch_size = max(1, int(batch_size))
+        self.max_delay = max_delay_ms / 1000.0
+        self.full_document_collections = set(full_document_collections or [])
+        self.partitioners = partitioners or {}
+        self.idempotent = idempotent
+        self.coalesce = coalesce
+        self.monitoring_service = monitoring_service
+        if coalesce and not self.batching:
+            self.logger.warning("Coalescing has no effect without batching (batch_size 1)")
+            
+        self.catch_up_batch_size = max(self.batch_size, int(catch_up_batch_size or self.batch_size))
+        self.catch_up_collections = set()
+        
+        self._lock = threading.Lock()
+        self._lanes = {}  # (collection, lane index) -> _Lane
+        
+        self.running = False
+        self.flush_thread = None
+        
+    @property
+    def batching(self):
+        """True when operations are buffered and written with bulk_write"""
+        return self.batch_size > 1
+        
+    def start(self):
+        """Start the background flusher that enforces max_delay_ms"""
+        if not self.batching or (self.flush_thread and self.flush_thread.is_alive()):
+            return
+            
+        self.running = True
+        self.flush_thread = threading.Thread(target=self._run_flusher, name="iris-apply-flusher")
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+        
+    def stop(self):
+        """Stop the flusher and write out everything still buffered"""
+        self.running = False
+        if self.flush_thread:
+            self.flush_thread.join(timeout=30)
+        self.flush_all()
+        
     def apply(self, collection_name, operation):
         """
         Apply an operation to the target database
@@ -31,37 +111,374 @@ class TargetApplier:
             Result of the operation with success flag and error if applicable
         """
         try:
-            collection = self.target_db[collection_name]
-            operation_type = operation['operationType']
+            target_name = self.route(collection_name, operation)
+            writes = self.build_writes(collection_name, operation)
+        except ValueError as e:
+            return {'success': False, 'error': str(e)}
             
-            if operation_type == 'insert':
-                document = operation['fullDocument']
-                result = collection.insert_one(document)
-                return {'success': True, 'result': str(result.inserted_id)}
-                
-            elif operation_type == 'update':
-                document_id = operation['documentKey']['_id']
-                update_doc = operation['updateDescription']['updatedFields']
-                result = collection.update_one(
-                    {'_id': document_id},
-                    {'$set': update_doc}
+        results = []
+        self._execute(target_name, [(writes, results.append)])
+        return results[0]
+        
+    def apply_batch(self, collection_name, operations):
+        """
+        Apply several operations of one collection in order, bypassing the lanes
+        
+        Returns:
+        --------
+        list
+            One result dict (as returned by apply) per operation
+        """
+        results = [None] * len(operations)
+        entries = []
+        target_names = []
+        for index, operation in enumerate(operations):
+            try:
+                target_name = self.route(collection_name, operation)
+                writes = self.build_writes(collection_name, operation)
+            except ValueError as e:
+                results[index] = {'success': False, 'error': str(e)}
+                continue
+            target_names.append(target_name)
+            entries.append((writes, functools.partial(results.__setitem__, index)))
+            
+        # Consecutive operations on the same target collection share a bulk_write
+        start = 0
+        while start < len(entries):
+            end = start + 1
+            while end < len(entries) and target_names[end] == target_names[start]:
+                end += 1
+            self._execute(target_names[start], entries[start:end])
+            start = end
+            
+        return results
+        
+    def submit(self, collection_name, operation, callback, lane=0):
+        """
+        Queue an operation for the target database
+        
+        With batching disabled the operation is applied immediately. Otherwise
+        it is buffered per collection and written with the next bulk_write.
+        
+        Parameters:
+        -----------
+        collection_name : str
+            Name of the collection
+        operation : dict
+            Transformed operation to apply
+        callback : callable
+            Called with the result dict (same shape as apply) once the
+            operation has been written or has failed
+        lane : int
+            Batch lane within the collection; callers applying in parallel
+            use one lane each so their batches are written independently
+        """
+        if not self.batching:
+            callback(self.apply(collection_name, operation))
+            return
+            
+        try:
+            target_name = self.route(collection_name, operation)
+            writes = self.build_writes(collection_name, operation)
+        except ValueError as e:
+            callback({'success': False, 'error': str(e)})
+            return
+            
+        with self._lock:
+            pending = self._lanes.get((target_name, lane))
+            if pending is None:
+                pending = self._lanes[(target_name, lane)] = _Lane(target_name)
+            if self.coalesce:
+                self._coalesce(pending, collection_name, operation, writes, callback)
+            else:
+                pending.append(writes, callback)
+            full = pending.events >= self.batch_limit(collection_name)
+            
+        if full:
+            self._flush_lane(pending)
+            
+    def _coalesce(self, lane, collection_name, operation, writes, callback):
+        """
+        Append an operation to a lane, merged with a pending write of the same document
+        
+        The net write keeps the slot of the document's earlier write, so
+        writes of different documents stay in the order they were first
+        submitted. Its callbacks report the result to every merged event in
+        order, which is what lets their checkpoints advance. Called with the
+        lock held.
+        """
+        key = bson.encode({'_id': operation['documentKey']['_id']})
+        callbacks = [callback]
+        
+        previous = lane.documents.get(key)
+        if previous:
+            index, previous_operation, previous_callbacks = previous
+            merged = merge_operations(previous_operation, operation,
+                                      full_document=collection_name in self.full_document_collections,
+                                      idempotent=self.idempotent)
+            if merged is not None:
+                callbacks = previous_callbacks + callbacks
+                lane.pending[index] = (
+                    self.build_writes(collection_name, merged),
+                    functools.partial(self._complete_callbacks, callbacks)
                 )
-                return {'success': True, 'matched': result.matched_count, 'modified': result.modified_count}
+                lane.documents[key] = (index, merged, callbacks)
+                lane.events += 1
+                return
                 
-            elif operation_type == 'replace':
-                document_id = operation['documentKey']['_id']
-                document = operation['fullDocument']
-                result = collection.replace_one(
-                    {'_id': document_id},
-                    document
-                )
-                return {'success': True, 'matched': result.matched_count, 'modified': result.modified_count}
+        lane.documents[key] = (len(lane.pending), operation, callbacks)
+        lane.append(writes, callback)
+        
+    def set_catch_up(self, collection_name, enabled):
+        """Use the larger catch-up batch size for a collection while it lags"""
+        if enabled:
+            self.catch_up_collections.add(collection_name)
+        else:
+            self.catch_up_collections.discard(collection_name)
+            
+    def batch_limit(self, collection_name):
+        """Operations buffered per lane of a collection before it is flushed"""
+        if collection_name in self.catch_up_collections:
+            return self.catch_up_batch_size
+        return self.batch_size
+        
+    def flush_all(self):
+        """Write out every buffered batch"""
+        with self._lock:
+            lanes = list(self._lanes.values())
+            
+        for lane in lanes:
+            self._flush_lane(lane)
+            
+    def _run_flusher(self):
+        """Flush partial batches once their oldest operation exceeds max_delay_ms"""
+        while self.running:
+            now = time.monotonic()
+            with self._lock:
+                due = [lane for lane in self._lanes.values()
+                       if lane.pending and now - lane.first_queued_at >= self.max_delay]
+                       
+            for lane in due:
+                try:
+                    self._flush_lane(lane)
+                except Exception as e:
+                    # One bad batch must not stop the timed flushes of all lanes
+                    self.logger.error(f"Failed to flush {lane.collection_name}: {str(e)}")
+                    
+            time.sleep(min(self.max_delay, 0.05) or 0.01)
+            
+    def _flush_lane(self, lane):
+        """Detach the pending batch of a lane and write it"""
+        # Holding the flush lock while detaching keeps batches of one
+        # collection in submission order when the flusher races a full batch
+        with lane.flush_lock:
+            with self._lock:
+                entries = lane.pending
+                events = lane.events
+                lane.pending = []
+                lane.documents = {}
+                lane.events = 0
                 
-            # Note: We explicitly don't handle 'delete' here since it's filtered out
-            # But we include this for completeness in case filtering is changed
-            else:
-                return {'success': False, 'error': f"Unsupported operation type: {operation_type}"}
+            if self.coalesce and entries and self.monitoring_service:
+                self.monitoring_service.record_coalescing(lane.collection_name, events, len(entries))
                 
-        except PyMongoError as e:
-            self.logger.error(f"Failed to apply operation to target: {str(e)}")
-            return {'success': False, 'error': str(e)}
+            if entries:
+                self._execute(lane.collection_name, entries)
+                
+    def _execute(self, collection_name, entries):
+        """
+        Write a batch as ordered bulk_write calls and report each operation
+        
+        Entries are (write models, callback) pairs; one operation may need
+        several writes. An ordered bulk stops at the first failing write. The
+        operation owning that write is reported as failed and the bulk is
+        resubmitted from the next operation, so the result matches what
+        serial apply calls would have produced.
+        """
+        collection = self.target_db[collection_name]
+        start = 0
+        
+        while start < len(entries):
+            writes = []
+            owners = []  # Write index -> entry index
+            for index in range(start, len(entries)):
+                writes.extend(entries[index][0])
+                owners.extend([index] * len(entries[index][0]))
+                
+            try:
+                if writes:
+                    collection.bulk_write(writes, ordered=True)
+                    
+            except BulkWriteError as e:
+                write_errors = e.details.get('writeErrors', [])
+                if not write_errors:
+                    self.logger.error(f"Failed to apply batch to target: {str(e)}")
+                    self._complete(entries[start:], {'success': False, 'error': str(e), 'retryable': True})
+                    return
+                    
+                failed = owners[write_errors[0]['index']]
+                self._complete(entries[start:failed], {'success': True})
+                self._complete(entries[failed:failed + 1], self.write_error_result(write_errors[0], str(e)))
+                start = failed + 1
+                continue
+                
+            except PyMongoError as e:
+                # Connection, timeout and server state errors; nothing about
+                # the operations themselves was rejected
+                self.logger.error(f"Failed to apply batch to target: {str(e)}")
+                self._complete(entries[start:], {'success': False, 'error': str(e), 'retryable': True})
+                return
+                
+            except Exception as e:
+                # Not a server error, e.g.
+                # DocumentTooLarge (a bson InvalidDocument) once the metadata
+                # pushes a document over 16MB; retrying cannot help
+                self.logger.error(f"Failed to apply batch to target: {type(e).__name__}: {str(e)}")
+                self._complete(entries[start:], {'success': False, 'error': str(e)})
+                return
+                
+            self._complete(entries[start:], {'success': True})
+            return
+            
+    def write_error_result(self, write_error, default_message):
+        """
+        Result of the operation owning a failed write of an ordered bulk
+        
+        In idempotent mode a duplicate _id can only come from a guarded
+        upsert that did not match because the target document is newer;
+        the event is reported as applied and skipped.
+        """
+        message = write_error.get('errmsg', default_message)
+        if self.idempotent and write_error.get('code') == DUPLICATE_KEY and _is_id_index(write_error):
+            self.logger.debug(f"Skipped stale operation: {message}")
+            return {'success': True, 'skipped': True}
+            
+        self.logger.error(f"Failed to apply operation to target: {message}")
+        return {'success': False, 'error': message}
+        
+    def _complete(self, entries, result):
+        """Report a result to the callbacks of a slice of entries"""
+        for _, callback in entries:
+            try:
+                callback(result)
+            except Exception as e:
+                self.logger.error(f"Apply callback failed: {str(e)}")
+                
+    def _complete_callbacks(self, callbacks, result):
+        """Report the result of a coalesced write to each merged event"""
+        self._complete([(None, callback) for callback in callbacks], result)
+        
+    def route(self, collection_name, operation):
+        """
+        Name of the target collection an operation is written to
+        
+        Partitioned collections route by the partition field of the full
+        document. A delta update can only be routed when it sets that field.
+        """
+        partitioner = self.partitioners.get(collection_name)
+        if not partitioner:
+            return collection_name
+            
+        if operation['operationType'] == 'update' and operation.get('fullDocument') is None:
+            updated_fields = operation['updateDescription'].get('updatedFields') or {}
+            if partitioner.field not in updated_fields:
+                raise ValueError(f"Cannot route update of {collection_name} without its full document")
+            return partitioner.bucket_for(updated_fields)
+            
+        return partitioner.bucket_for(operation.get('fullDocument'))
+        
+    def build_writes(self, collection_name, operation):
+        """Translate a transformed operation into bulk write models"""
+        operation_type = operation['operationType']
+        
+        if operation_type == 'insert':
+            if self.idempotent:
+                return [ReplaceOne(self._filter(operation), operation['fullDocument'], upsert=True)]
+            return [InsertOne(operation['fullDocument'])]
+            
+        elif operation_type == 'update':
+            # fullDocument is None when the document was deleted before the
+            # lookup ran; the delta is still correct in that case. Checked
+            # with "is not None", which leaves a RawBSONDocument undecoded.
+            if collection_name in self.full_document_collections and operation.get('fullDocument') is not None:
+                return [ReplaceOne(self._filter(operation), operation['fullDocument'], upsert=self.idempotent)]
+                
+            return self._build_delta_writes(self._filter(operation), operation['updateDescription'])
+            
+        elif operation_type == 'replace':
+            return [ReplaceOne(self._filter(operation), operation['fullDocument'], upsert=self.idempotent)]
+            
+        # Note: We explicitly don't handle 'delete' here since it's filtered out
+        raise ValueError(f"Unsupported operation type: {operation_type}")
+        
+    def _filter(self, operation):
+        """
+        Filter selecting the target document of an operation
+        
+        In idempotent mode the filter also requires the document's
+        source_timestamp to be missing (never replicated, or copied by the
+        initial sync) or not newer than the event's clusterTime. Events of
+        one transaction share a clusterTime, so equal timestamps still apply.
+        """
+        document_filter = {'_id': operation['documentKey']['_id']}
+        cluster_time = operation.get('clusterTime')
+        if self.idempotent and cluster_time is not None:
+            document_filter['$or'] = [
+                {SOURCE_TIMESTAMP_FIELD: None},
+                {SOURCE_TIMESTAMP_FIELD: {'$lte': cluster_time}}
+            ]
+        return document_filter
+        
+    def _build_delta_writes(self, document_filter, description):
+        """
+        Reproduce an update from its updateDescription
+        
+        Array truncations are written first as a separate update: the
+        updatedFields of the same event may set elements of the truncated
+        array, which would conflict with the $push inside one update.
+        """
+        writes = []
+        
+        truncated_arrays = description.get('truncatedArrays') or []
+        if truncated_arrays:
+            writes.append(UpdateOne(
+                document_filter,
+                {'$push': {t['field']: {'$each': [], '$slice': t['newSize']} for t in truncated_arrays}}
+            ))
+            
+        update = {}
+        if description.get('updatedFields'):
+            update['$set'] = description['updatedFields']
+        if description.get('removedFields'):
+            update['$unset'] = {field: '' for field in description['removedFields']}
+        if update:
+            writes.append(UpdateOne(document_filter, update))
+            
+        return writes
+
+
+class _Lane:
+    """Pending writes for one collection lane"""
+    
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self.pending = []  # List of (write models, callback)
+        self.documents = {}  # Encoded _id -> (pending index, operation, callbacks), when coalescing
+        self.events = 0  # Operations submitted to the pending batch, including coalesced ones
+        self.first_queued_at = 0.0
+        self.flush_lock = threading.Lock()
+        
+    def append(self, writes, callback):
+        if not self.pending:
+            self.first_queued_at = time.monotonic()
+        self.pending.append((writes, callback))
+        self.events += 1
+
+
+def _is_id_index(write_error):
+    """True when a duplicate key error is on the _id index"""
+    key_pattern = write_error.get('keyPattern')
+    if key_pattern is not None:
+        return list(key_pattern) == ['_id']
+    # Servers before 4.4 only name the index in the message
+    return 'index: _id_ ' in write_error.get('errmsg', '')
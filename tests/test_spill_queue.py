@@ -0,0 +1,102 @@
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+# The Iris modules import each other relatively, so they are loaded as
+# submodules of a package rooted at the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if 'iris' not in sys.modules:
+    package = types.ModuleType('iris')
+    package.__path__ = [ROOT]
+    sys.modules['iris'] = package
+
+from iris.spill_queue import SpillQueue
+
+
+class HeldStage:
+    """Apply stage that keeps every operation in flight until it is finished by hand"""
+    def __init__(self):
+        self.in_flight = []
+        
+    def submit(self, collection_name, operation, callback, lane=0):
+        self.in_flight.append((operation, callback))
+        
+    def finish(self, name, result):
+        for index, (operation, callback) in enumerate(self.in_flight):
+            if operation['name'] == name:
+                del self.in_flight[index]
+                callback(result)
+                return
+        raise AssertionError(f"{name} is not in flight")
+
+
+def operation(name, document_id=1):
+    return {'name': name, 'operationType': 'update', 'documentKey': {'_id': document_id}}
+
+
+class SpillQueueOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.stage = HeldStage()
+        self.queue = SpillQueue(
+            {'path': self.directory.name, 'max_in_flight': 1, 'fsync': False},
+            self.stage,
+            mock.Mock(),
+            mock.Mock()
+        )
+        # Only the log is needed; the drainer would replay it concurrently
+        os.makedirs(self.queue.path, exist_ok=True)
+        self.queue._open_segment(1)
+        self.results = {}
+        
+    def tearDown(self):
+        self.queue.writer.close()
+        self.directory.cleanup()
+        
+    def submit(self, op):
+        self.queue.submit('orders', op, lambda result, name=op['name']: self.results.__setitem__(name, result))
+        
+    def replay_order(self):
+        return [record['operation']['name'] for _, record, _ in self.queue._read(100)]
+        
+    def test_acknowledged_operation_is_not_spilled_behind_a_later_one(self):
+        self.submit(operation('E1'))
+        self.submit(operation('E2'))  # max_in_flight reached
+        self.stage.finish('E1', {'success': True})
+        
+        self.assertEqual(self.replay_order(), ['E2'])
+        self.assertEqual(self.results['E1'], {'success': True})
+        self.assertEqual(self.results['E2'], {'spilled': True})
+        
+    def test_retryable_failure_is_spilled_ahead_of_a_later_one(self):
+        self.submit(operation('E1'))
+        self.submit(operation('E2'))
+        self.assertNotIn('E2', self.results)  # Waits for E1
+        self.stage.finish('E1', {'success': False, 'retryable': True, 'error': 'timeout'})
+        
+        self.assertEqual(self.replay_order(), ['E1', 'E2'])
+        self.assertEqual(self.results, {'E1': {'spilled': True}, 'E2': {'spilled': True}})
+        
+    def test_other_documents_are_spilled_right_away(self):
+        self.submit(operation('E1'))
+        self.submit(operation('F1', document_id=2))
+        
+        self.assertEqual(self.replay_order(), ['F1'])
+        self.assertEqual(self.results['F1'], {'spilled': True})
+        
+    def test_failed_spill_still_reports_a_result(self):
+        self.submit(operation('E1'))
+        with mock.patch('os.fsync', side_effect=OSError('disk full')):
+            self.queue.fsync = True
+            self.submit(operation('E2'))
+            self.stage.finish('E1', {'success': True})
+            
+        self.assertEqual(self.results['E1'], {'success': True})
+        self.assertFalse(self.results['E2']['success'])
+
+
+if __name__ == '__main__':
+    unittest.main()